@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from url_monitor import commons
+from url_monitor import configuration
+from url_monitor import jpath
+from url_monitor import zbxsend
+
+__doc__ = """Microbenchmarks for the url_monitor hot paths.
+
+Results are written as JSON so runs can be compared:
+
+    python benchmarks/bench_hotpaths.py -o before.json
+    python benchmarks/bench_hotpaths.py -o after.json --compare before.json
+"""
+
+BENCHMARKS = []
+
+
+def benchmark(name, **params):
+    """
+    Registers a benchmark setup function. The setup function receives the
+    params and returns a zero-argument callable that is timed.
+    """
+    def register(setup):
+        BENCHMARKS.append((name, params, setup))
+        return setup
+    return register
+
+
+def make_document(width, depth):
+    """
+    Builds a nested JSON document `depth` levels deep with `width` keys
+    (and a list of `width` items) on every level.
+    """
+    node = {'value': 42, 'items': list(range(width))}
+    for level in range(depth):
+        node = dict(('key{0}'.format(i), node) for i in range(width))
+        node['value'] = level
+    return json.dumps(node)
+
+
+def make_config(testsets, elements=3):
+    """
+    Builds a synthetic config dict with the given number of testSets.
+    """
+    config = {
+        'config': {
+            'pidfile': 'url_monitor.pid',
+            'request_timeout': 30,
+            'request_verify_ssl': True,
+            'logging': {
+                'level': 'error',
+                'outputs': '',
+                'logformat': '%(message)s',
+            },
+            'identity_providers': {
+                'basicProvider': {
+                    'HTTPBasicAuth': {'username': 'u', 'password': 'p'}
+                }
+            },
+            'zabbix': {
+                'host': 'url_monitor',
+                'server': 'localhost:10051',
+                'item_key_format': 'url_monitor[{datatype}, {metricname}, {uri}]',
+                'checksummary_key_format': 'url_monitor[EXECUTION_STATUS]',
+            },
+        },
+        'testSet': {},
+    }
+    for t in range(testsets):
+        config['testSet']['testSet{0}'.format(t)] = {
+            'uri': 'http://api{0}.example.com/status'.format(t % 50),
+            'response_type': 'json',
+            'identity_provider': 'basicProvider',
+            'ok_http_code': 200,
+            'testElements': [
+                {'key': 'element{0}'.format(e),
+                 'jsonvalue': './key0/value',
+                 'datatype': 'integer',
+                 'response_type': 'json',
+                 'metricname': 'metric{0}'.format(e),
+                 'unit_of_measure': 'events'}
+                for e in range(elements)
+            ],
+        }
+    return config
+
+
+class _FakeResponse(object):
+
+    content = b'{}'
+    elapsed = datetime.timedelta(0)
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class _FakeSession(object):
+
+    def __init__(self, status_code):
+        self.response = _FakeResponse(status_code)
+
+    def get(self, url, **kwargs):
+        return self.response
+
+
+class _OfflineWebCaller(commons.WebCaller):
+    """
+    WebCaller that never touches the network, so only the request
+    bookkeeping and status code matching in run() is measured.
+    """
+
+    def __init__(self, logging, status_code):
+        super(_OfflineWebCaller, self).__init__(logging)
+        self.status_code = status_code
+
+    def auth(self, config, identity_provider):
+        self.session = _FakeSession(self.status_code)
+        self.session_headers = {}
+
+    def read_body(self, request, max_bytes=None):
+        return len(request.content)
+
+
+for size, (width, depth) in (('small', (3, 2)),
+                             ('medium', (8, 3)),
+                             ('huge', (12, 4))):
+    @benchmark('jpath.jpath', document=size)
+    def bench_jpath(params, width=width, depth=depth):
+        document = make_document(width, depth)
+        path = './' + '/'.join(['key0'] * depth) + '/items[1]'
+        return lambda: jpath.jpath(document, path)
+
+    @benchmark('commons.omnipath', document=size)
+    def bench_omnipath(params, width=width, depth=depth):
+        document = make_document(width, depth)
+        element = {'jsonvalue': './' + '/'.join(['key0'] * depth) + '/value'}
+        return lambda: commons.omnipath(document, 'json', element)
+
+
+for expected in ('200', '200,204,301', 'any'):
+    @benchmark('WebCaller.run', ok_http_code=expected)
+    def bench_webcaller(params, expected=expected):
+        logger = logging.getLogger('benchmark')
+        webcaller = _OfflineWebCaller(logger, 204)
+
+        def run():
+            return webcaller.run(
+                None, 'http://localhost/', verify=True,
+                expected_http_status=expected, identity_provider='none',
+                timeout=1)
+        # measure the status code matching, not an exception path
+        assert bool(run()) == (expected != '200')
+        assert webcaller.timings['status_code'] == 204
+        return run
+
+
+for count in (1000, 10000, 100000):
+    @benchmark('zbxsend.build_packet', metrics=count)
+    def bench_build_packet(params, count=count):
+        metrics = [
+            zbxsend.Metric('url_monitor',
+                           'url_monitor[integer, metric{0}, uri]'.format(i),
+                           i, clock=1477958400)
+            for i in range(count)
+        ]
+        return lambda: zbxsend.build_packet(metrics)
+
+
+for count in (10, 1000, 10000):
+    @benchmark('ConfigObject.load', testsets=count)
+    def bench_config_load(params, count=count):
+        path = os.path.join(params['tmpdir'], 'load{0}.yaml'.format(count))
+        with open(path, 'w') as f:
+            yaml.safe_dump(make_config(count), f)
+
+        def run():
+            configinstance = configuration.ConfigObject()
+            configinstance.load_yaml_file(path)
+            return configinstance.load()
+        return run
+
+    @benchmark('ConfigObject.datatypes_valid', testsets=count)
+    def bench_datatypes_valid(params, count=count):
+        configinstance = configuration.ConfigObject()
+        configinstance.config = make_config(count)
+        last = 'testSet{0}'.format(count - 1)
+        return lambda: configinstance.datatypes_valid(last)
+
+
+def measure(func, min_time, repeat):
+    """
+    Times func, calibrating the loop count so one sample takes at least
+    min_time seconds. Returns per-call seconds for each sample.
+    """
+    loops = 1
+    while True:
+        started = time.time()
+        for _ in range(loops):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= min_time or loops >= 1000000:
+            break
+        loops *= 10
+
+    samples = [elapsed / loops]
+    for _ in range(repeat - 1):
+        started = time.time()
+        for _ in range(loops):
+            func()
+        samples.append((time.time() - started) / loops)
+    return loops, samples
+
+
+def run_benchmarks(selected=None, min_time=0.2, repeat=5):
+    """
+    Runs every registered benchmark and returns the results document.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='url_monitor_bench')
+    results = []
+    try:
+        for name, params, setup in BENCHMARKS:
+            if selected and not any(s in name for s in selected):
+                continue
+            func = setup(dict(params, tmpdir=tmpdir))
+            loops, samples = measure(func, min_time, repeat)
+            results.append({
+                'name': name,
+                'params': params,
+                'loops': loops,
+                'min': min(samples),
+                'mean': sum(samples) / len(samples),
+                'max': max(samples),
+            })
+            print("{0:<32} {1:<28} {2:>12.3f} us".format(
+                name, json.dumps(params, sort_keys=True), min(samples) * 1e6),
+                file=sys.stderr)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results,
+    }
+
+
+def compare(baseline, current):
+    """
+    Prints the change of each benchmark's best time against a baseline.
+    """
+    def index(document):
+        return dict(((r['name'], json.dumps(r['params'], sort_keys=True)), r)
+                    for r in document['results'])
+
+    before = index(baseline)
+    for key, result in sorted(index(current).items()):
+        if key not in before:
+            continue
+        ratio = result['min'] / before[key]['min']
+        print("{0:<32} {1:<28} {2:>7.2f}x".format(key[0], key[1], ratio),
+              file=sys.stderr)
+
+
+def main(arguments=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument(
+        "-o", "--output", default=None,
+        help="Write JSON results to this file instead of stdout")
+    arg_parser.add_argument(
+        "--compare", default=None,
+        help="JSON results from an earlier run to compare against")
+    arg_parser.add_argument(
+        "-k", "--select", action='append', default=None,
+        help="Only run benchmarks whose name contains this string")
+    arg_parser.add_argument(
+        "--min-time", type=float, default=0.2,
+        help="Minimum seconds per sample")
+    arg_parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Samples taken per benchmark")
+    inputflag = arg_parser.parse_args(arguments)
+
+    logging.getLogger('benchmark').setLevel(logging.CRITICAL)
+
+    document = run_benchmarks(inputflag.select, inputflag.min_time,
+                              inputflag.repeat)
+    if inputflag.output:
+        with open(inputflag.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(document, indent=2, sort_keys=True))
+
+    if inputflag.compare:
+        with open(inputflag.compare) as f:
+            compare(json.load(f), document)
+
+
+if __name__ == '__main__':
+    main()
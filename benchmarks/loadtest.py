@@ -0,0 +1,449 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer, BaseRequestHandler
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer, BaseRequestHandler
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from url_monitor import main as url_monitor_main
+
+__doc__ = """End-to-end load harness for url_monitor.
+
+Starts a fake JSON API and a fake Zabbix trapper in a child process, writes
+a synthetic config pointing at both and runs `url_monitor check` against
+them in this process:
+
+    python benchmarks/loadtest.py --testsets 1000 --latency 0.05 \\
+        --payload-bytes 4096 --error-rate 0.01 --auth basic
+"""
+
+USERNAME = 'loadtest'
+PASSWORD = 'loadtest'
+REALM = 'url_monitor-loadtest'
+ITEM_KEY_FORMAT = 'url_monitor[{datatype}, {metricname}, {uri}]'
+SUMMARY_KEY = 'url_monitor[EXECUTION_STATUS]'
+ZABBIX_HOST = 'url_monitor-loadtest'
+
+
+def expected_document(checkid):
+    """
+    The values the fake API serves for a testSet, before padding.
+    """
+    return {'id': checkid,
+            'status': {'jobs': checkid * 7, 'state': 'ok'}}
+
+
+def expected_metrics(testsets, base_url):
+    """
+    Maps every item key the harness config produces to its expected value.
+    """
+    metrics = {}
+    for checkid in range(testsets):
+        uri = "{0}/check/{1}".format(base_url, checkid)
+        document = expected_document(checkid)
+        for metricname, datatype, value in (
+                ('id', 'integer', document['id']),
+                ('jobs', 'integer', document['status']['jobs']),
+                ('state', 'string', document['status']['state'])):
+            key = ITEM_KEY_FORMAT.format(datatype=datatype,
+                                         metricname=metricname, uri=uri)
+            metrics[key] = value
+    return metrics
+
+
+def generate_config(path, testsets, base_url, trapper, workdir, auth,
+                    timeout=30):
+    """
+    Writes a synthetic url_monitor config with `testsets` testSets.
+    """
+    providers = {
+        'none': None,
+        'basic': {'HTTPBasicAuth': {'username': USERNAME,
+                                    'password': PASSWORD}},
+        'digest': {'HTTPDigestAuth': {'username': USERNAME,
+                                      'password': PASSWORD}},
+    }
+    config = {
+        'config': {
+            'pidfile': os.path.join(workdir, 'url_monitor.pid'),
+            'state_dir': workdir,
+            'request_timeout': timeout,
+            'request_verify_ssl': False,
+            'logging': {
+                'level': 'error',
+                'outputs': 'file',
+                'logfile': os.path.join(workdir, 'url_monitor.log'),
+                'logformat': '%(asctime)s - %(name)s - %(levelname)s - '
+                             '%(message)s',
+            },
+            'identity_providers': {
+                'loadtestProvider': providers[auth] or {'none': {}},
+            },
+            'zabbix': {
+                'host': ZABBIX_HOST,
+                'server': '{0}:{1}'.format(*trapper),
+                'send_timeout': timeout,
+                'item_key_format': ITEM_KEY_FORMAT,
+                'checksummary_key_format': SUMMARY_KEY,
+            },
+        },
+        'testSet': {},
+    }
+    for checkid in range(testsets):
+        config['testSet']['loadtest{0}'.format(checkid)] = {
+            'uri': '{0}/check/{1}'.format(base_url, checkid),
+            'response_type': 'json',
+            'identity_provider': 'loadtestProvider',
+            'ok_http_code': 200,
+            'testElements': [
+                {'key': 'id', 'jsonvalue': './id', 'datatype': 'integer',
+                 'metricname': 'id', 'response_type': 'json'},
+                {'key': 'jobs', 'jsonvalue': './status/jobs',
+                 'datatype': 'integer', 'metricname': 'jobs',
+                 'response_type': 'json'},
+                {'key': 'state', 'jsonvalue': './status/state',
+                 'datatype': 'string', 'metricname': 'state',
+                 'response_type': 'json'},
+            ],
+        }
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, default_flow_style=False)
+    return config
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    """
+    Serves /check/<n> with the expected document for testSet n after the
+    configured latency, or a 500 at the configured error rate.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _authorized(self):
+        scheme = self.server.options['auth']
+        header = self.headers.get('Authorization', '')
+        if scheme == 'none':
+            return True
+        if scheme == 'basic':
+            expected = base64.b64encode(
+                '{0}:{1}'.format(USERNAME, PASSWORD).encode('ascii'))
+            return header == 'Basic ' + expected.decode('ascii')
+        if scheme == 'digest' and header.startswith('Digest '):
+            fields = {}
+            for part in header[len('Digest '):].split(','):
+                name, _, value = part.strip().partition('=')
+                fields[name] = value.strip('"')
+
+            def md5(text):
+                return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+            ha1 = md5('{0}:{1}:{2}'.format(USERNAME, REALM, PASSWORD))
+            ha2 = md5('GET:{0}'.format(fields.get('uri')))
+            response = md5(':'.join([ha1, fields.get('nonce', ''),
+                                     fields.get('nc', ''),
+                                     fields.get('cnonce', ''),
+                                     fields.get('qop', ''), ha2]))
+            return response == fields.get('response')
+        return False
+
+    def _reply(self, code, body, headers=None):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stats = self.server.stats
+        options = self.server.options
+        with self.server.lock:
+            stats['requests'] += 1
+
+        if not self._authorized():
+            with self.server.lock:
+                stats['challenges'] += 1
+            challenge = {}
+            if options['auth'] == 'digest':
+                challenge['WWW-Authenticate'] = (
+                    'Digest realm="{0}", qop="auth", nonce="{1}", '
+                    'opaque="loadtest"'.format(
+                        REALM, hashlib.md5(self.path.encode('utf-8'))
+                        .hexdigest()))
+            elif options['auth'] == 'basic':
+                challenge['WWW-Authenticate'] = 'Basic realm="{0}"'.format(
+                    REALM)
+            return self._reply(401, b'{}', challenge)
+
+        if options['latency']:
+            time.sleep(options['latency'])
+
+        try:
+            checkid = int(self.path.rstrip('/').split('/')[-1])
+        except ValueError:
+            return self._reply(404, b'{}')
+
+        if self.server.random.random() < options['error_rate']:
+            with self.server.lock:
+                stats['errors'] += 1
+                stats['failed_checks'].append(checkid)
+            return self._reply(500, b'{"error": "injected"}')
+
+        document = expected_document(checkid)
+        document['padding'] = 'x' * options['payload_bytes']
+        body = json.dumps(document).encode('utf-8')
+        with self.server.lock:
+            stats['bytes_out'] += len(body)
+        return self._reply(200, body)
+
+
+class FakeTrapperHandler(BaseRequestHandler):
+    """
+    Speaks the ZBXD\\1 sender protocol and records every metric received.
+    """
+
+    def _recv_all(self, count):
+        buf = b''
+        while len(buf) < count:
+            chunk = self.request.recv(count - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+        return buf
+
+    def handle(self):
+        header = self._recv_all(13)
+        if len(header) != 13 or not header.startswith(b'ZBXD\x01'):
+            return
+        length = struct.unpack('<Q', header[5:])[0]
+        payload = json.loads(self._recv_all(length).decode('utf-8'))
+        data = payload.get('data', [])
+        with self.server.lock:
+            self.server.stats['batches'] += 1
+            self.server.stats['metrics'].extend(
+                [(m['host'], m['key'], m['value']) for m in data])
+        body = json.dumps({
+            'response': 'success',
+            'info': 'processed: {0}; failed: 0; total: {0}; '
+                    'seconds spent: 0.000001'.format(len(data))
+        }).encode('utf-8')
+        self.request.sendall(b'ZBXD\x01' + struct.pack('<Q', len(body)) +
+                             body)
+
+
+def serve(options, conn):
+    """
+    Child process body: runs both fake servers until told to stop, then
+    sends back what they saw.
+    """
+    api = ThreadingHTTPServer(('127.0.0.1', 0), FakeApiHandler)
+    api.options = options
+    api.lock = threading.Lock()
+    api.random = random.Random(options['seed'])
+    api.stats = {'requests': 0, 'errors': 0, 'challenges': 0,
+                 'bytes_out': 0, 'failed_checks': []}
+
+    trapper = ThreadingTCPServer(('127.0.0.1', 0), FakeTrapperHandler)
+    trapper.lock = threading.Lock()
+    trapper.stats = {'batches': 0, 'metrics': []}
+
+    for server in (api, trapper):
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    conn.send((api.server_address, trapper.server_address))
+    while True:
+        command = conn.recv()
+        if command == 'reset':
+            with api.lock:
+                api.stats.update(requests=0, errors=0, challenges=0,
+                                 bytes_out=0, failed_checks=[])
+            with trapper.lock:
+                trapper.stats.update(batches=0, metrics=[])
+            conn.send(True)
+        elif command == 'stats':
+            with api.lock:
+                with trapper.lock:
+                    conn.send({'api': dict(api.stats),
+                               'trapper': dict(trapper.stats)})
+        else:
+            break
+    api.shutdown()
+    trapper.shutdown()
+
+
+def check_delivery(expected, received):
+    """
+    Compares the metrics received by the trapper to the expected values.
+    """
+    delivered = {}
+    for host, key, value in received:
+        if host == ZABBIX_HOST and key in expected:
+            delivered[key] = value
+    wrong = dict((key, (expected[key], value))
+                 for key, value in delivered.items()
+                 if str(value) != str(expected[key]))
+    missing = [key for key in expected if key not in delivered]
+    return {'expected': len(expected),
+            'delivered': len(delivered),
+            'correct': len(delivered) - len(wrong),
+            'wrong': len(wrong),
+            'wrong_examples': sorted(wrong.items())[:10],
+            'missing': len(missing)}
+
+
+def run_once(config_path, processes=None):
+    """
+    Runs url_monitor check in-process and returns (exit code, seconds).
+    """
+    started = time.time()
+    code = 0
+    arguments = ['url_monitor', 'check', '-c', config_path]
+    if processes is not None:
+        arguments += ['--workers', str(processes)]
+    try:
+        url_monitor_main.main(arguments)
+    except SystemExit as exc:
+        code = exc.code
+    return code, time.time() - started
+
+
+def main(arguments=None):
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--testsets", type=int, default=100)
+    arg_parser.add_argument("--runs", type=int, default=1)
+    arg_parser.add_argument("--latency", type=float, default=0.0,
+                            help="Seconds the fake API waits per request")
+    arg_parser.add_argument("--payload-bytes", type=int, default=256,
+                            help="Padding added to every API response")
+    arg_parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Fraction of requests answered with a 500")
+    arg_parser.add_argument("--auth", choices=['none', 'basic', 'digest'],
+                            default='none')
+    arg_parser.add_argument("--workers", default=None,
+                            help="Passed to url_monitor check --workers")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--keep", action='store_true',
+                            help="Keep the generated config and logs")
+    arg_parser.add_argument("-o", "--output", default=None,
+                            help="Write the JSON report to this file")
+    inputflag = arg_parser.parse_args(arguments)
+
+    workdir = tempfile.mkdtemp(prefix='url_monitor_loadtest')
+    parent_conn, child_conn = multiprocessing.Pipe()
+    servers = multiprocessing.Process(target=serve, args=(
+        {'latency': inputflag.latency,
+         'payload_bytes': inputflag.payload_bytes,
+         'error_rate': inputflag.error_rate,
+         'auth': inputflag.auth,
+         'seed': inputflag.seed},
+        child_conn))
+    servers.daemon = True
+    servers.start()
+
+    runs = []
+    try:
+        api_address, trapper_address = parent_conn.recv()
+        base_url = 'http://{0}:{1}'.format(*api_address)
+        config_path = os.path.join(workdir, 'url_monitor.yaml')
+        generate_config(config_path, inputflag.testsets, base_url,
+                        trapper_address, workdir, inputflag.auth)
+        expected = expected_metrics(inputflag.testsets, base_url)
+
+        for run in range(inputflag.runs):
+            parent_conn.send('reset')
+            parent_conn.recv()
+            code, wall = run_once(config_path, inputflag.workers)
+            parent_conn.send('stats')
+            stats = parent_conn.recv()
+
+            failed = set(stats['api']['failed_checks'])
+            reachable = dict(
+                (key, value) for key, value in expected.items()
+                if int(key.split('/check/')[1].rstrip(']')) not in failed)
+            summary = [m[2] for m in stats['trapper']['metrics']
+                       if m[1] == SUMMARY_KEY]
+            runs.append({
+                'run': run,
+                'exit_code': code,
+                'wall_seconds': wall,
+                'http_requests': stats['api']['requests'],
+                'requests_per_second': stats['api']['requests'] / wall,
+                'http_errors_injected': stats['api']['errors'],
+                'http_auth_challenges': stats['api']['challenges'],
+                'http_bytes': stats['api']['bytes_out'],
+                'sender_batches': stats['trapper']['batches'],
+                'metrics_received': len(stats['trapper']['metrics']),
+                'execution_status': summary[-1] if summary else None,
+                'delivery': check_delivery(reachable,
+                                           stats['trapper']['metrics']),
+            })
+            print("run {run}: {wall_seconds:.2f}s {requests_per_second:.1f}"
+                  " req/s, {sender_batches} batches, {delivery[correct]}/"
+                  "{delivery[expected]} metrics correct".format(**runs[-1]),
+                  file=sys.stderr)
+    finally:
+        parent_conn.send('stop')
+        servers.join(5)
+        if inputflag.keep:
+            print("kept workdir {0}".format(workdir), file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'options': vars(inputflag),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'runs': runs,
+    }
+    if inputflag.output:
+        with open(inputflag.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    ok = all(r['delivery']['wrong'] == 0 and r['delivery']['missing'] == 0
+             for r in runs)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.ERROR)
+    sys.exit(main())
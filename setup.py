@@ -42,7 +42,7 @@ if __name__ == "__main__":
             'Topic :: System :: Systems Administration ',
         ],
         entry_points={
-            'console_scripts': ['url_monitor = url_monitor.main:main'],
+            'console_scripts': ['url_monitor = url_monitor.client:main'],
         },
         data_files=[('/etc', ['url_monitor.yaml'])],
         install_requires=[
@@ -51,5 +51,9 @@ if __name__ == "__main__":
             'oauthlib',
             'argparse',
             'facterpy'
-        ]
+        ],
+        extras_require={
+            'dns': ['dnspython'],
+            'aggregate': ['numpy'],
+        }
     )
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+import collections
+import json
+import logging
+
+import pytest
+
+from url_monitor import action
+from url_monitor import breaker
+
+Response = collections.namedtuple('Response', 'content status_code')
+
+TESTSET = {
+    'key': 'jobs',
+    'data': {
+        'uri': 'https://api.example:8443/jobs',
+        'response_type': 'json',
+        'testElements': [{'key': 'total', 'jsonvalue': './total',
+                          'datatype': 'integer', 'metricname': 'total'}],
+    },
+}
+
+
+class Config(object):
+    """
+    Stands in for a loaded configuration.ConfigObject.
+    """
+
+    def __init__(self, **zabbix):
+        self.config = {'config': {'zabbix': dict(
+            host='url_monitor',
+            server='127.0.0.1',
+            item_key_format='url_monitor[{datatype}, {metricname}, {uri}]',
+            **zabbix)}}
+
+    def load(self):
+        return self.config
+
+    def get_test_set(self, testSet):
+        return testSet
+
+    def get_token_cache(self):
+        return None
+
+    def datatypes_valid(self, check):
+        return True
+
+
+class Sender(object):
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, configinstance, metrics, logger):
+        self.batches.append(metrics)
+        return True
+
+    def keys(self):
+        return [[(m.key, m.value) for m in batch] for batch in self.batches]
+
+
+@pytest.fixture
+def breakers(tmpdir, monkeypatch):
+    breakers = breaker.CircuitBreakers(logging.getLogger('test'),
+                                       str(tmpdir), failures=1)
+    monkeypatch.setattr(action.breaker, 'get_breakers',
+                        lambda configinstance, logger: breakers)
+    return breakers
+
+
+STATUS = 'url_monitor[CHECKSTATS, status, {checkname}]'
+
+
+class TestCheckStatus(object):
+    def test_status_goes_with_the_items(self, breakers, monkeypatch):
+        monkeypatch.setattr(
+            action, 'webfacade', lambda *args: Response(
+                json.dumps({'total': 3}), 200))
+        sender = Sender()
+        assert action.check(TESTSET, Config(checkstatus_key_format=STATUS),
+                            logging.getLogger('test'), sender)[0] == 0
+        assert sender.keys() == [[
+            ('url_monitor[integer, total, https://api.example:8443/jobs]', 3),
+            ('url_monitor[CHECKSTATS, status, jobs]', 'ok')]]
+
+        # the status is optional
+        sender = Sender()
+        action.check(TESTSET, Config(), logging.getLogger('test'), sender)
+        assert sender.keys() == [[
+            ('url_monitor[integer, total, https://api.example:8443/jobs]', 3)]]
+
+    def test_open_breaker_reports_unreachable(self, breakers, monkeypatch):
+        def webfacade(*args):
+            raise AssertionError("no request to an open breaker's host")
+        monkeypatch.setattr(action, 'webfacade', webfacade)
+        breakers.record('api.example', False)
+        sender = Sender()
+        assert action.check(TESTSET, Config(checkstatus_key_format=STATUS),
+                            logging.getLogger('test'), sender)[0] == 1
+        assert sender.keys() == [
+            [('url_monitor[CHECKSTATS, status, jobs]', 'unreachable')]]
+
+        # a custom key, or none at all
+        sender = Sender()
+        action.check(TESTSET, Config(checkstatus_key_format='up[{checkname}]'),
+                     logging.getLogger('test'), sender)
+        assert sender.keys() == [[('up[jobs]', 'unreachable')]]
+        sender = Sender()
+        action.check(TESTSET, Config(), logging.getLogger('test'), sender)
+        assert sender.keys() == []
+
+    def test_too_large_without_checkstats(self, breakers, monkeypatch):
+        def webfacade(testSet, configinstance, webcaller, config, deadline):
+            webcaller.too_large = True
+            return False
+        monkeypatch.setattr(action, 'webfacade', webfacade)
+        sender = Sender()
+        assert action.check(TESTSET, Config(checkstatus_key_format=STATUS),
+                            logging.getLogger('test'), sender)[0] == 1
+        assert sender.keys() == [
+            [('url_monitor[CHECKSTATS, status, jobs]', 'too_large')]]
+
+    def test_checkstats_include_the_status(self):
+        config = Config(
+            checkstats_key_format='stats[{stat}, {checkname}]').load()
+        metrics = action.checkstats_metrics(
+            TESTSET, config, {'status': 'too_large', 'download': 0.5})
+        assert sorted((m.key, m.value) for m in metrics) == [
+            ('stats[download, jobs]', 0.5),
+            ('stats[status, jobs]', 'too_large')]
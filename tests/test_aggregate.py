@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from url_monitor import aggregate
+
+VALUES = [4, '9', 2, None, 'down', True, 5]
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(aggregate, 'numpy', None)
+    return request.param
+
+
+class TestAggregate(object):
+    def test_counts(self, backend):
+        assert aggregate.aggregate(VALUES, 'count') == 7
+        assert aggregate.aggregate([1, 1, {'a': 1}, {'a': 1}],
+                                   'distinct') == 2
+
+    def test_numeric(self, backend):
+        assert aggregate.aggregate(VALUES, 'sum') == 20
+        assert aggregate.aggregate(VALUES, 'min') == 2
+        assert aggregate.aggregate(VALUES, 'max') == 9
+        assert aggregate.aggregate(VALUES, 'mean') == 5.0
+        assert aggregate.aggregate([1.5, 2], 'sum') == 3.5
+
+    def test_percentiles(self, backend):
+        values = list(range(1, 101))
+        assert aggregate.aggregate(values, 'p50') == pytest.approx(50.5)
+        assert aggregate.aggregate(values, 'p95') == pytest.approx(95.05)
+        assert aggregate.aggregate(values, 'p100') == 100
+
+    def test_no_numbers(self, backend):
+        assert aggregate.aggregate(['down'], 'max') is None
+        assert aggregate.aggregate(None, 'count') == 0
+
+    def test_unknown_function(self):
+        assert not aggregate.is_valid('median')
+        assert not aggregate.is_valid('p101')
+        with pytest.raises(ValueError):
+            aggregate.aggregate([1], 'median')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from url_monitor import breaker
+
+
+def _breakers(tmpdir, **kwargs):
+    return breaker.CircuitBreakers(logging.getLogger('test'), str(tmpdir),
+                                   **kwargs).load()
+
+
+class TestCircuitBreakers(object):
+    def test_opens_after_consecutive_failures(self, tmpdir):
+        breakers = _breakers(tmpdir, failures=3)
+        for _ in range(2):
+            breakers.record('api', False)
+            assert breakers.allow('api')
+        breakers.record('api', True)
+        for _ in range(3):
+            assert breakers.allow('api')
+            breakers.record('api', False)
+        assert not breakers.allow('api')
+        assert breakers.allow('other')
+
+    def test_half_open_probe(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(breaker.time, 'time', lambda: now[0])
+        breakers = _breakers(tmpdir, failures=1, backoff=10, max_backoff=30)
+        breakers.record('api', False)
+        assert not breakers.allow('api')
+
+        now[0] += 10
+        assert breakers.allow('api')
+        assert not breakers.allow('api')  # only one probe
+        breakers.record('api', False)
+        assert breakers.hosts['api']['backoff'] == 20
+
+        now[0] += 20
+        assert breakers.allow('api')
+        breakers.record('api', False)
+        assert breakers.hosts['api']['backoff'] == 30
+
+        now[0] += 30
+        assert breakers.allow('api')
+        breakers.record('api', True)
+        assert 'api' not in breakers.hosts
+        assert breakers.allow('api')
+
+    def test_release_gives_back_the_probe(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(breaker.time, 'time', lambda: now[0])
+        breakers = _breakers(tmpdir, failures=1, backoff=10)
+        breakers.record('api', False)
+        now[0] += 10
+        assert breakers.allow('api')
+        breakers.release('api')
+        assert breakers.allow('api')
+
+    def test_persisted_and_merged(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(breaker.time, 'time', lambda: now[0])
+        first = _breakers(tmpdir, failures=1)
+        second = _breakers(tmpdir, failures=1)
+        first.record('a', False)
+        second.record('b', False)
+        first.save()
+        second.save()
+
+        later = _breakers(tmpdir, failures=1)
+        assert not later.allow('a')
+        assert not later.allow('b')
+
+        now[0] += 60
+        assert later.allow('a')
+        later.record('a', True)
+        later.save()
+        assert sorted(_breakers(tmpdir).hosts) == ['b']
+
+    def test_one_probe_across_processes(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(breaker.time, 'time', lambda: now[0])
+        first = _breakers(tmpdir, failures=1, backoff=10)
+        first.record('api', False)
+        first.save()
+        # another worker process, with the state the first one wrote
+        second = _breakers(tmpdir, failures=1, backoff=10)
+        assert not second.allow('api')
+
+        now[0] += 10
+        assert first.allow('api')
+        assert not second.allow('api')
+        # the claim runs out if the prober goes away
+        now[0] += breaker.PROBE_LEASE
+        assert second.allow('api')
+
+        # an outcome written back releases the claim
+        second.record('api', False)
+        second.save()
+        now[0] += 20
+        assert _breakers(tmpdir, failures=1).allow('api')
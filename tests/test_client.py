@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import socket
+import sys
+import threading
+import types
+
+import pytest
+
+from url_monitor import client
+from url_monitor import control
+
+
+class TestParse(object):
+    def test_check(self, monkeypatch):
+        monkeypatch.delenv('URL_MONITOR_SOCKET', raising=False)
+        path, request = client.parse(['check', '-c', '/etc/a.yaml'])
+        assert request == {'command': 'check'}
+        assert path == client.default_socket_path(['/etc/a.yaml'])
+        assert path != client.default_socket_path(None)
+        assert client.parse(['check', '--config=/etc/a.yaml',
+                             '--socket', '/tmp/s'])[0] == '/tmp/s'
+
+    def test_discover(self):
+        request = client.parse(['discover', '-t', 'integer'])[1]
+        assert request == {'command': 'discover', 'datatype': 'integer',
+                           'testsets': False}
+        assert client.parse(['discover', '--testsets'])[1]['testsets']
+
+    @pytest.mark.parametrize('arguments', [
+        ['check', '--key', 'api'],
+        ['check', '--workers', '2'],
+        ['check', '-c'],
+        ['discover'],
+        ['daemon'],
+        ['--help'],
+        [],
+    ])
+    def test_full_run(self, arguments):
+        assert client.parse(arguments) is None
+
+
+@pytest.fixture
+def full_run(monkeypatch):
+    """
+    Stands in for url_monitor.main, recording the full runs started.
+    """
+    import url_monitor
+    runs = []
+    module = types.ModuleType('url_monitor.main')
+    module.main = lambda arguments: runs.append(arguments) or 0
+    monkeypatch.setitem(sys.modules, 'url_monitor.main', module)
+    monkeypatch.setattr(url_monitor, 'main', module, raising=False)
+    return runs
+
+
+class TestMain(object):
+    def test_no_daemon_is_a_full_run(self, tmpdir, full_run):
+        arguments = ['url_monitor', 'check', '--socket',
+                     str(tmpdir.join('missing.sock'))]
+        assert client.main(arguments) == 0
+        # a socket left behind by a daemon that is gone
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(str(tmpdir.join('stale.sock')))
+        stale.close()
+        stale_arguments = ['url_monitor', 'check', '--socket',
+                           str(tmpdir.join('stale.sock'))]
+        assert client.main(stale_arguments) == 0
+        assert full_run == [arguments, stale_arguments]
+
+    def test_hung_daemon_fails(self, tmpdir, full_run, monkeypatch, capsys):
+        monkeypatch.setattr(client, 'TIMEOUT', 0.2)
+        path = str(tmpdir.join('hung.sock'))
+        hung = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        hung.bind(path)
+        hung.listen(1)
+        try:
+            assert client.main(['url_monitor', 'check', '--socket',
+                                path]) == 1
+        finally:
+            hung.close()
+        out, err = capsys.readouterr()
+        assert out == "1\n"
+        assert "did not answer" in err
+        assert full_run == []
+
+
+class TestControl(object):
+    def test_request_response(self, tmpdir):
+        path = str(tmpdir.join('ctl.sock'))
+        listener = control.ControlListener(
+            path, lambda request: {'rc': 0, 'output': request['command']},
+            logging.getLogger('test')).start()
+        try:
+            assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+            assert client.call(path, {'command': 'check'}) == \
+                {'rc': 0, 'output': 'check'}
+        finally:
+            listener.stop()
+        assert not os.path.exists(path)
+        with pytest.raises(socket.error):
+            client.call(path, {'command': 'check'})
+
+    def test_errors_are_answered(self, tmpdir):
+        def answer(request):
+            raise KeyError('command')
+        path = str(tmpdir.join('ctl.sock'))
+        listener = control.ControlListener(path, answer,
+                                           logging.getLogger('test')).start()
+        try:
+            assert 'error' in client.call(path, {})
+        finally:
+            listener.stop()
+
+
+class TestRuns(object):
+    def test_waits_for_the_first_run(self):
+        runs = control.Runs()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            runs.result(timeout=5)))
+        thread.start()
+        assert runs.wait_for_trigger(5)
+        runs.started()
+        runs.finished(2)
+        thread.join()
+        assert result == [2]
+
+    def test_last_result_and_trigger(self):
+        runs = control.Runs()
+        runs.started()
+        runs.finished(0)
+        runs.started()
+        # a run is going on, it is fresh enough
+        assert runs.result() == 0
+        assert not runs.wait_for_trigger(0)
+        runs.finished(1)
+        assert runs.result() == 1
+        assert runs.wait_for_trigger(0)
+        assert runs.result(timeout=0) == 1
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import logging
+import threading
+import zlib
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import pytest
+import requests
+
+from url_monitor import commons
+from url_monitor import configuration
+from url_monitor.exception import ResponseTooLarge
+
+BODY = b'{"total": 3, "jobs": ["a", "b", "c"]}' * 10
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves BODY gzipped, with a Content-Length at /length and chunked
+    at /chunked, a gzip body that doesn't decode at /corrupt and a
+    chunked body that never ends at /endless.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = _gzip(BODY)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if self.path == '/endless':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            chunk = b'x' * 65536
+            try:
+                while True:
+                    self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            except (IOError, OSError):
+                return
+        self.send_header('Content-Encoding', 'gzip')
+        if self.path == '/corrupt':
+            body = body[:10] + b'x' * (len(body) - 10)
+        if self.path == '/chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 16):
+                chunk = body[start:start + 16]
+                self.wfile.write(b'%x\r\n' % len(chunk) + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{0}'.format(httpd.server_address[1])
+    httpd.shutdown()
+    httpd.server_close()
+
+
+class Records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    records = Records()
+    logger.handlers = [records]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger, records
+
+
+class TestSkipConditions(object):
+    def test_cache_expires(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(commons.time, 'time', lambda: now[0])
+        cache = commons.SkipConditionCache(str(tmpdir))
+        argv = ('/opt/ha_state.sh', 'standby', 0)
+        assert cache.get('shell', argv, 60) is None
+        cache.set('shell', argv, True)
+        assert cache.get('shell', argv, 60) is True
+        assert cache.get('shell', ('/opt/other.sh', 'standby', 0), 60) is None
+        assert cache.get('shell', argv, 0) is None
+        now[0] += 61
+        assert cache.get('shell', argv, 60) is None
+
+    def test_concurrent_conditions(self, tmpdir, monkeypatch):
+        def condition(logging, condition, argv):
+            return argv[0] == 'standby'
+        monkeypatch.setattr(commons, 'skip_on_external_condition', condition)
+        logger, records = _logger('test.skip.concurrent')
+        cache = commons.SkipConditionCache(str(tmpdir))
+        monitor = commons.SkipConditionMonitor(logger, cache).start(
+            [('shell', ('active',), 60), ('facter', ('standby',), 60)])
+        assert monitor.should_skip()
+        assert cache.get('facter', ('standby',), 60) is True
+        assert cache.get('shell', ('active',), 60) is False
+
+    def test_errors_are_logged_and_not_cached(self, tmpdir, monkeypatch):
+        def condition(logging, condition, argv):
+            raise OSError(2, 'No such file or directory')
+        monkeypatch.setattr(commons, 'skip_on_external_condition', condition)
+        logger, records = _logger('test.skip.errors')
+        cache = commons.SkipConditionCache(str(tmpdir))
+        monitor = commons.SkipConditionMonitor(logger, cache).start(
+            [('shell', ('/opt/missing.sh', 'standby', 0), 60)])
+        assert not monitor.should_skip()
+        errors = [record for record in records.records
+                  if record.levelno == logging.ERROR]
+        assert len(errors) == 1
+        assert 'No such file' in errors[0].getMessage()
+        assert cache.get('shell', ('/opt/missing.sh', 'standby', 0),
+                         60) is None
+
+    def test_environment_is_never_cached(self):
+        configinstance = configuration.ConfigObject()
+        configinstance.config = {'config': {'skip_run_when': {
+            'cache_ttl': 300,
+            'shell': {'script': '/opt/ha_state.sh', 'stdout': 'standby',
+                      'cache_ttl': 900},
+            'environment': {'variable': 'ZABBIX_HA_STATE',
+                            'value': 'hot_spare', 'cache_ttl': 900}}}}
+        assert configinstance.get_skip_cache_ttl('shell') == 900
+        assert configinstance.get_skip_cache_ttl('facter') == 300
+        assert configinstance.get_skip_cache_ttl('env') == 0
+
+
+class TestReadBody(object):
+    def _get(self, url):
+        return requests.get(url, stream=True, timeout=5)
+
+    def test_wire_bytes(self, server):
+        webcaller = commons.WebCaller(logging.getLogger('test'))
+        for path in ('/length', '/chunked'):
+            request = self._get(server + path)
+            wire_bytes = webcaller.read_body(request)
+            assert request.content == BODY
+            assert wire_bytes == len(_gzip(BODY)) < len(BODY)
+
+    def test_corrupt_body(self, server):
+        webcaller = commons.WebCaller(logging.getLogger('test'))
+        request = self._get(server + '/corrupt')
+        with pytest.raises(requests.exceptions.ContentDecodingError):
+            webcaller.read_body(request)
+
+    def test_content_length_over_the_limit(self, server):
+        webcaller = commons.WebCaller(logging.getLogger('test'))
+        request = self._get(server + '/length')
+        with pytest.raises(ResponseTooLarge) as err:
+            webcaller.read_body(request, len(_gzip(BODY)) - 1)
+        assert 'Content-Length' in str(err.value)
+        # the body was left unread
+        assert request.raw.tell() == 0
+
+    def test_streamed_body_over_the_limit(self, server):
+        webcaller = commons.WebCaller(logging.getLogger('test'))
+        # the limit is on the decoded body
+        request = self._get(server + '/chunked')
+        with pytest.raises(ResponseTooLarge):
+            webcaller.read_body(request, len(BODY) - 1)
+        request = self._get(server + '/chunked')
+        webcaller.read_body(request, len(BODY))
+        assert request.content == BODY
+
+        # the connection is dropped rather than drained
+        request = self._get(server + '/endless')
+        with pytest.raises(ResponseTooLarge):
+            webcaller.read_body(request, 1000000)
+
+
+class TestContentDecoder(object):
+    def _decode(self, content_encoding, data):
+        decoder = commons.ContentDecoder(content_encoding)
+        return b''.join([decoder.decompress(data[start:start + 7])
+                         for start in range(0, len(data), 7)] +
+                        [decoder.flush()])
+
+    def test_codings(self):
+        assert self._decode('gzip', _gzip(BODY)) == BODY
+        # more than one gzip member
+        assert self._decode('gzip', _gzip(BODY) + _gzip(BODY)) == BODY * 2
+        # deflate is sent zlib wrapped and raw
+        assert self._decode('deflate', zlib.compress(BODY)) == BODY
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        assert self._decode(
+            'deflate', raw.compress(BODY) + raw.flush()) == BODY
+        # decoded last applied first
+        assert self._decode('deflate, gzip',
+                            _gzip(zlib.compress(BODY))) == BODY
+        assert self._decode('identity', BODY) == BODY
+
+    def test_unknown_coding_is_kept(self):
+        assert self._decode('compress', BODY) == BODY
+        assert self._decode('gzip, compress', BODY) == BODY
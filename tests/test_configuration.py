@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+
+from url_monitor import configuration
+
+CONFIG = """config:
+  pidfile: "{tmpdir}/url_monitor.pid"
+  zabbix:
+    server: "127.0.0.1"
+    host: "url_monitor"
+    item_key_format: "url_monitor[{{datatype}}, {{metricname}}, {{uri}}]"
+    checksummary_key_format: "url_monitor[SUMMARY, {{checkname}}]"
+  identity_providers:
+    none: {{}}
+testSet:
+  jobs:
+    uri: "https://api.example/jobs"
+    response_type: "json"
+    identity_provider: "none"
+    ok_http_code: 200
+    testElements:
+      - key: "latency"
+        jsonvalue: "./jobs[*]/latency"
+        datatype: "float"
+        aggregate: "{aggregate}"
+"""
+
+
+def _config(tmpdir, aggregate='p95'):
+    path = tmpdir.join('url_monitor.yaml')
+    path.write(CONFIG.format(tmpdir=tmpdir, aggregate=aggregate))
+    configinstance = configuration.ConfigObject()
+    configinstance.load_yaml_file(config=str(path))
+    configinstance.logger = logging.getLogger('test')
+    return configinstance
+
+
+class TestPreFlightCheck(object):
+    def test_ok(self, tmpdir):
+        _config(tmpdir).pre_flight_check()
+
+    def test_http2_is_not_supported(self, tmpdir, caplog):
+        configinstance = _config(tmpdir)
+        configinstance.config['config']['http2'] = {
+            'origins': ['api.example']}
+        configinstance.pre_flight_check()
+        assert 'http2 is not supported' in caplog.text
+
+    def test_unknown_aggregate(self, tmpdir):
+        configinstance = _config(tmpdir, aggregate='median')
+        with pytest.raises(SystemExit):
+            configinstance.pre_flight_check()
+
+
+    def test_sharded_summary_needs_node(self, tmpdir):
+        configinstance = _config(tmpdir)
+        configinstance.config['config']['sharding'] = {'node_count': 2}
+        with pytest.raises(SystemExit):
+            configinstance.pre_flight_check()
+        configinstance.config['config']['zabbix'][
+            'checksummary_key_format'] = 'url_monitor[SUMMARY, {node}]'
+        configinstance.pre_flight_check()
+
+
+class TestConfigPaths(object):
+    def test_default(self):
+        assert configuration.config_paths(None) == [None]
+        assert configuration.config_paths([]) == [None]
+
+    def test_directories_are_expanded(self, tmpdir):
+        confd = tmpdir.mkdir('url_monitor.d')
+        for name in ('b.yml', 'a.yaml', 'c.yaml.orig', 'README'):
+            confd.join(name).write('')
+        single = str(tmpdir.join('url_monitor.yaml'))
+        assert configuration.config_paths([single, str(confd)]) == [
+            single, str(confd.join('a.yaml')), str(confd.join('b.yml'))]
+        # a file is taken as given, whatever its name
+        assert configuration.config_paths(['/etc/monitor.conf']) == [
+            '/etc/monitor.conf']
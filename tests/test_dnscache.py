@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from url_monitor import dnscache
+
+Record = collections.namedtuple('Record', 'address')
+
+
+class Answer(list):
+    def __init__(self, ttl, addresses):
+        list.__init__(self, [Record(address) for address in addresses])
+        self.rrset = collections.namedtuple('RRset', 'ttl')(ttl)
+
+
+def _addresses(address, port=443):
+    return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, '',
+             (address, port))]
+
+
+class Resolver(object):
+    """
+    Stands in for DNSCache._query, counting the lookups made.
+    """
+
+    def __init__(self, ttl=60, wait=None):
+        self.ttl = ttl
+        self.wait = wait
+        self.lookups = []
+
+    def __call__(self, host, port):
+        self.lookups.append(host)
+        if self.wait is not None:
+            self.wait.wait(5)
+        return _addresses('192.0.2.{0}'.format(len(self.lookups)), port), \
+            self.ttl
+
+
+@pytest.mark.skipif(dnscache.dns is None, reason="needs dnspython")
+class TestTTL(object):
+    def _cache(self, monkeypatch, answers):
+        def query(host, rdtype):
+            if rdtype not in answers:
+                raise dnscache.dns.resolver.NoAnswer()
+            return answers[rdtype]
+        monkeypatch.setattr(dnscache, '_dns_query', query)
+        return dnscache.DNSCache(logging.getLogger('test'), min_ttl=10,
+                                 max_ttl=300)
+
+    def test_records_and_lowest_ttl(self, monkeypatch):
+        cache = self._cache(monkeypatch, {
+            'A': Answer(120, ['192.0.2.1', '192.0.2.2']),
+            'AAAA': Answer(60, ['2001:db8::1'])})
+        addresses = cache.resolve('api.example', 443)
+        assert [address[4] for address in addresses] == [
+            ('192.0.2.1', 443), ('192.0.2.2', 443),
+            ('2001:db8::1', 443, 0, 0)]
+        assert cache.entries[('api.example', 443)][1] == 60
+
+    def test_clamped(self, monkeypatch):
+        cache = self._cache(monkeypatch, {'A': Answer(1, ['192.0.2.1'])})
+        cache.resolve('short.example', 443)
+        assert cache.entries[('short.example', 443)][1] == 10
+        cache = self._cache(monkeypatch, {'A': Answer(86400, ['192.0.2.1'])})
+        cache.resolve('long.example', 443)
+        assert cache.entries[('long.example', 443)][1] == 300
+
+    def test_unresolved_names_use_the_system_resolver(self, monkeypatch):
+        cache = self._cache(monkeypatch, {})
+        monkeypatch.setattr(dnscache.socket, 'getaddrinfo',
+                            lambda host, port, *args: _addresses('127.0.0.1'))
+        assert cache.resolve('localhost', 443) == _addresses('127.0.0.1')
+        assert cache.entries[('localhost', 443)][1] == 60
+
+
+class TestDNSCache(object):
+    def test_without_dnspython(self, monkeypatch):
+        monkeypatch.setattr(dnscache, 'dns', None)
+        queried = []
+
+        def getaddrinfo(host, port, *args):
+            queried.append(host)
+            return _addresses('192.0.2.7' if host == '192.0.2.7' else
+                              '192.0.2.1', port)
+        monkeypatch.setattr(dnscache.socket, 'getaddrinfo', getaddrinfo)
+        cache = dnscache.DNSCache(logging.getLogger('test'), default_ttl=45)
+        assert cache.resolve('api.example', 443) == _addresses('192.0.2.1')
+        assert cache.entries[('api.example', 443)][1] == 45
+        # addresses go straight to getaddrinfo and aren't cached
+        assert cache.resolve('192.0.2.7', 80)[0][4] == ('192.0.2.7', 80)
+        assert queried == ['api.example', '192.0.2.7']
+        assert list(cache.entries) == [('api.example', 443)]
+
+    def test_expiry(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(dnscache.time, 'time', lambda: now[0])
+        cache = dnscache.DNSCache(logging.getLogger('test'))
+        cache._query = resolver = Resolver(ttl=30)
+        first = cache.resolve('api.example', 443)
+        now[0] += 29
+        assert cache.resolve('api.example', 443) == first
+        assert cache.resolve('api.example', 80) != first
+        now[0] += 2
+        assert cache.resolve('api.example', 443) != first
+        assert resolver.lookups == ['api.example'] * 3
+
+    def test_concurrent_lookups_share_one(self):
+        wait = threading.Event()
+        cache = dnscache.DNSCache(logging.getLogger('test'))
+        cache._query = resolver = Resolver(wait=wait)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(cache.resolve('api.example', 443)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        wait.set()
+        for thread in threads:
+            thread.join(5)
+        assert resolver.lookups == ['api.example']
+        assert results == [_addresses('192.0.2.1')] * 5
+
+    def test_prefetch_refreshes(self):
+        cache = dnscache.DNSCache(logging.getLogger('test'), min_ttl=1,
+                                  max_ttl=1, prefetch=True, idle=3)
+        cache._query = resolver = Resolver(ttl=1)
+        first = cache.resolve('api.example', 443)
+        deadline = time.time() + 5
+        while len(resolver.lookups) < 2 and time.time() < deadline:
+            time.sleep(0.1)
+        # refreshed in the background, without another resolve()
+        assert len(resolver.lookups) >= 2
+        assert cache.resolve('api.example', 443) != first
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import logging
+
+import pytest
+
+from url_monitor import includes
+
+TEST_SET = """testSet:
+  {name}:
+    uri: "http://{name}.example/health"
+    response_type: "json"
+    identity_provider: "none"
+    ok_http_code: 200
+    testElements:
+      - key: "status"
+        jsonvalue: "./status"
+        datatype: "string"
+"""
+
+
+def _includes(tmpdir, cache=True):
+    return includes.Includes(logging.getLogger('test'),
+                             [str(tmpdir.join('conf.d'))],
+                             str(tmpdir) if cache else None)
+
+
+def _keys(checks):
+    return [check['key'] for check in checks]
+
+
+@pytest.fixture
+def confd(tmpdir):
+    directory = tmpdir.mkdir('conf.d')
+    directory.join('a.yaml').write(TEST_SET.format(name='alpha'))
+    directory.join('b.yml').write(TEST_SET.format(name='beta'))
+    directory.join('README').write('not a fragment')
+    return directory
+
+
+class TestIncludes(object):
+    def test_only_changed_fragments_are_compiled(self, tmpdir, confd):
+        fragments = _includes(tmpdir)
+        assert fragments.refresh() == [str(confd.join('a.yaml')),
+                                       str(confd.join('b.yml'))]
+        assert _keys(fragments.checks) == ['alpha', 'beta']
+        beta = fragments.checks[1]
+
+        assert fragments.refresh() == []
+        confd.join('a.yaml').write(TEST_SET.format(name='gamma'))
+        assert fragments.refresh() == [str(confd.join('a.yaml'))]
+        assert _keys(fragments.checks) == ['gamma', 'beta']
+        assert fragments.checks[1] is beta
+
+    def test_added_and_removed_fragments(self, tmpdir, confd):
+        fragments = _includes(tmpdir)
+        fragments.refresh()
+        confd.join('a.yaml').remove()
+        confd.join('c.yaml').write(TEST_SET.format(name='gamma'))
+        assert fragments.refresh() == [str(confd.join('c.yaml')),
+                                       str(confd.join('a.yaml'))]
+        assert _keys(fragments.checks) == ['beta', 'gamma']
+
+    def test_cached_between_runs(self, tmpdir, confd, monkeypatch):
+        _includes(tmpdir).refresh()
+
+        def compile_fragment(text, path):
+            raise AssertionError("{0} compiled again".format(path))
+        monkeypatch.setattr(includes, 'compile_fragment', compile_fragment)
+        fragments = _includes(tmpdir)
+        fragments.refresh()
+        assert _keys(fragments.checks) == ['alpha', 'beta']
+
+    def test_invalid_fragment(self, tmpdir, confd):
+        confd.join('b.yml').write(TEST_SET.format(name='beta').replace(
+            'uri', 'url'))
+        with pytest.raises(ValueError) as err:
+            _includes(tmpdir).refresh()
+        assert 'Missing uri under testSet item beta' in str(err.value)
+
+        confd.join('b.yml').write(TEST_SET.format(name='beta') +
+                                  '        aggregate: "median"\n')
+        with pytest.raises(ValueError) as err:
+            _includes(tmpdir).refresh()
+        assert 'Unknown aggregate median under testSet item beta' in \
+            str(err.value)
+
+    def test_reload_keeps_previous_testsets(self, tmpdir, confd):
+        fragments = _includes(tmpdir, cache=False)
+        fragments.refresh()
+        confd.join('b.yml').write('testSet: [')
+        assert fragments.refresh(strict=False) == []
+        assert _keys(fragments.checks) == ['alpha', 'beta']
+
+    def test_duplicate_testsets(self, tmpdir, confd):
+        confd.join('c.yaml').write(TEST_SET.format(name='alpha'))
+        with pytest.raises(ValueError):
+            _includes(tmpdir).refresh()
+        confd.join('c.yaml').remove()
+        with pytest.raises(ValueError):
+            _includes(tmpdir).refresh(reserved=['beta'])
+
+    def test_only_test_sets_may_be_included(self):
+        with pytest.raises(ValueError):
+            includes.compile_fragment('config:\n  pidfile: x\n', 'x.yaml')
+        assert includes.compile_fragment('', 'empty.yaml') == []
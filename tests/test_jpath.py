@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import json
+
+from url_monitor.jpath import jpath
+
+DOCUMENT = json.dumps({
+    'status': 'ok',
+    'elements': [10, 20, 30],
+    'workers': [
+        {'name': 'a', 'queue': {'depth': 4}, 'jobs': [1, 2]},
+        {'name': 'b', 'queue': {'depth': 9}, 'jobs': [3]},
+        {'name': 'c'},
+    ],
+    'pools': {'db': {'size': 5}, 'cache': {'size': 2}},
+})
+
+
+class TestJpath(object):
+    def test_plain_paths(self):
+        assert jpath(DOCUMENT, './status') == 'ok'
+        assert jpath(DOCUMENT, './elements[1]') == 20
+        assert jpath(DOCUMENT, './workers[1]/queue/depth') == 9
+        assert jpath(DOCUMENT, './missing') is None
+
+    def test_list_wildcard(self):
+        assert jpath(DOCUMENT, './elements[*]') == [10, 20, 30]
+        # workers without a queue are left out
+        assert jpath(DOCUMENT, './workers[*]/queue/depth') == [4, 9]
+        assert jpath(DOCUMENT, './workers/*/name') == ['a', 'b', 'c']
+
+    def test_object_wildcard(self):
+        assert sorted(jpath(DOCUMENT, './pools/*/size')) == [2, 5]
+
+    def test_nested_wildcards_flatten(self):
+        assert jpath(DOCUMENT, './workers[*]/jobs[*]') == [1, 2, 3]
+
+    def test_wildcard_on_missing_key(self):
+        assert jpath(DOCUMENT, './missing[*]/depth') is None
+        assert jpath(DOCUMENT, './status/*') == []
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+import pytest
+
+from url_monitor import logqueue
+from url_monitor import stats
+
+
+class Records(logging.Handler):
+    """
+    Log output recording the lines it is handed and the thread writing them.
+    """
+
+    def __init__(self, blocked=None):
+        logging.Handler.__init__(self)
+        self.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        self.lines = []
+        self.threads = set()
+        self.blocked = blocked
+
+    def emit(self, record):
+        if self.blocked is not None:
+            self.blocked.wait(5)
+        self.threads.add(threading.current_thread())
+        self.lines.append(self.format(record))
+
+
+def _logger(name, handler):
+    logger = logging.getLogger(name)
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    return logger
+
+
+class TestQueueHandler(object):
+    def setup_method(self, method):
+        stats.reset()
+
+    def test_written_from_the_background(self):
+        output = Records()
+        output.setLevel(logging.INFO)
+        handler = logqueue.QueueHandler([output])
+        logger = _logger('test.logqueue.background', handler)
+        metrics = ['a']
+        logger.debug("Summary: %s", metrics)
+        logger.info("Summary: %s", metrics)
+        # the arguments are formatted when they are logged
+        metrics.append('b')
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            logger.exception("Failed")
+        handler.close()
+        assert output.lines[0] == "INFO Summary: ['a']"
+        assert output.lines[1].startswith("ERROR Failed\nTraceback")
+        assert len(output.lines) == 2
+        assert threading.current_thread() not in output.threads
+
+    def test_full_queue_drops(self):
+        blocked = threading.Event()
+        output = Records(blocked)
+        handler = logqueue.QueueHandler([output], queue_size=1)
+        logger = _logger('test.logqueue.full', handler)
+        for index in range(5):
+            logger.info("line %d", index)
+        # one record being written, at most one waiting
+        assert stats.get('log_records_dropped') >= 3
+        blocked.set()
+        handler.close()
+        assert len(output.lines) + stats.get('log_records_dropped') == 5
+
+    def test_record_of_other_handlers(self):
+        output = Records()
+        direct = Records()
+        logger = _logger('test.logqueue.direct',
+                         logqueue.QueueHandler([output]))
+        logger.addHandler(direct)
+        logger.warning("%s of %s", 1, 2)
+        logqueue.close_handlers(logger)
+        assert output.lines == direct.lines == ["WARNING 1 of 2"]
+
+    @pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+    def test_forked_process(self, tmpdir):
+        path = str(tmpdir.join('url_monitor.log'))
+        output = logging.FileHandler(path)
+        handler = logqueue.QueueHandler([output])
+        logger = _logger('test.logqueue.fork', handler)
+        logger.info("parent")
+        pid = os.fork()
+        if pid == 0:
+            logger.info("child")
+            logqueue.close_handlers(logger)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        handler.close()
+        output.close()
+        with open(path) as log:
+            assert sorted(log.read().split()) == ['child', 'parent']
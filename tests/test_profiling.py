@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import logging
+import pstats
+import threading
+
+from url_monitor import action
+from url_monitor import profiling
+
+
+class TestProfiler(object):
+    def test_memory_without_tracemalloc(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(profiling, 'tracemalloc', None)
+        profiler = profiling.Profiler(logging.getLogger('test'), ['mem'],
+                                      ['check'], str(tmpdir))
+        original = action.check
+        profiler.start()
+        assert action.check is not original
+        profiler.boundary('config')
+        profiler.stop()
+        assert action.check is original
+
+        rss, = tmpdir.listdir('*.rss')
+        lines = rss.read().splitlines()
+        assert [line.split()[0] for line in lines] == [
+            'boundary', 'start', 'config', 'end']
+        current, peak = profiling.rss_kb()
+        assert peak > 0
+        assert current is None or current > 0
+
+    def test_check_threads_are_profiled(self, tmpdir):
+        profiler = profiling.Profiler(logging.getLogger('test'), ['cpu'],
+                                      ['run'], str(tmpdir))
+
+        def in_check_thread():
+            return sum(range(1000))
+
+        profiler.start()
+        thread = threading.Thread(target=in_check_thread)
+        thread.start()
+        thread.join()
+        profiler.stop()
+
+        assert len(profiler.profiles['run']) == 2
+        prof, = tmpdir.listdir('*.run.prof')
+        functions = [name for _, _, name in pstats.Stats(str(prof)).stats]
+        assert 'in_check_thread' in functions
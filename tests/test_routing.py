@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+
+import pytest
+
+from url_monitor import routing
+
+Metric = collections.namedtuple('Metric', 'host key value')
+
+
+class Servers(object):
+    """
+    Fake send callable recording which server got which metrics.
+    """
+
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.received = collections.defaultdict(list)
+        self.attempts = []
+
+    def __call__(self, metrics, host, port):
+        server = "{0}:{1}".format(host, port)
+        self.attempts.append(server)
+        if server in self.down:
+            return False
+        self.received[server].extend(metrics)
+        return True
+
+
+def _metrics(hosts=1, keys=3):
+    return [Metric('host{0}'.format(h), 'key{0}'.format(k), k)
+            for h in range(hosts) for k in range(keys)]
+
+
+def _zabbix(**kwargs):
+    zabbix = {'server': ['a:10051', 'b:10051', 'c:10052']}
+    zabbix.update(kwargs)
+    return zabbix
+
+
+class TestRouting(object):
+    def test_settings(self):
+        servers, strategy, cooldown, distribute_by = routing.settings(
+            {'server': 'zabbix.example'})
+        assert servers == [('zabbix.example', 10051)]
+        assert (strategy, cooldown, distribute_by) == ('failover', 30.0,
+                                                       'host')
+        with pytest.raises(ValueError):
+            routing.settings(_zabbix(server_strategy='random'))
+        with pytest.raises(ValueError):
+            routing.settings(_zabbix(server=[]))
+
+    def test_failover_with_cooldown(self, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(routing.time, 'time', lambda: now[0])
+        router = routing.Router(logging.getLogger('test'))
+        servers = Servers(down=['a:10051'])
+        assert router.send(_zabbix(), _metrics(), servers)
+        assert servers.attempts == ['a:10051', 'b:10051']
+        assert len(servers.received['b:10051']) == 3
+
+        # a cooling down server is tried last
+        servers.down = set()
+        assert router.send(_zabbix(), _metrics(), servers)
+        assert servers.attempts[2:] == ['b:10051']
+        now[0] += 31
+        assert router.send(_zabbix(), _metrics(), servers)
+        assert servers.attempts[3:] == ['a:10051']
+
+    def test_all_servers_down(self):
+        router = routing.Router(logging.getLogger('test'))
+        servers = Servers(down=['a:10051', 'b:10051', 'c:10052'])
+        assert not router.send(_zabbix(), _metrics(), servers)
+        assert sorted(servers.attempts) == ['a:10051', 'b:10051', 'c:10052']
+
+    def test_distribute_by_host(self):
+        router = routing.Router(logging.getLogger('test'))
+        zabbix = _zabbix(server_strategy='distribute')
+        servers = Servers()
+        assert router.send(zabbix, _metrics(hosts=30), servers)
+        assert len(servers.received) == 3
+        owners = {}
+        for server, metrics in servers.received.items():
+            for metric in metrics:
+                assert owners.setdefault(metric.host, server) == server
+
+        # the metrics of a server that is down go elsewhere, the others
+        # stay where they were
+        down = owners['host0']
+        servers = Servers(down=[down])
+        assert router.send(zabbix, _metrics(hosts=30), servers)
+        for server, metrics in servers.received.items():
+            for metric in metrics:
+                if owners[metric.host] != down:
+                    assert owners[metric.host] == server
+
+    def test_distribute_by_key(self):
+        router = routing.Router(logging.getLogger('test'))
+        servers = Servers()
+        assert router.send(_zabbix(server_strategy='distribute',
+                                   distribute_by='key'),
+                           _metrics(hosts=2, keys=30), servers)
+        keys = {}
+        for server, metrics in servers.received.items():
+            for metric in metrics:
+                assert keys.setdefault(metric.key, server) == server
+        assert len(servers.received) == 3
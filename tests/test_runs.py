@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import argparse
+import logging
+import time
+
+import pytest
+
+from url_monitor import action
+from url_monitor import main
+from url_monitor import sharding
+from url_monitor import stats
+
+
+class Config(object):
+    """
+    Stands in for a loaded configuration.ConfigObject.
+    """
+
+    def __init__(self, host, server='zabbix-a', deadline=None, checks=(),
+                 sharding=None):
+        self.path = '/etc/url_monitor.d/{0}.yaml'.format(host)
+        self.deadline = deadline
+        self.config = {
+            'checks': [{'key': key, 'data': {}} for key in checks],
+            'config': {'sharding': sharding, 'zabbix': {
+                'host': host, 'server': server,
+                'checksummary_key_format': 'url_monitor[EXECUTION_STATUS]'}}}
+
+    def load(self):
+        return self.config
+
+    def get_run_deadline(self):
+        return self.deadline
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    def transmitfacade(configinstance, metrics, logger):
+        sent.append((configinstance['config']['zabbix']['server'],
+                     [(m.host, m.value) for m in metrics]))
+        return True
+    monkeypatch.setattr(action, 'transmitfacade', transmitfacade)
+    stats.reset()
+    return sent
+
+
+def _run_checks(monkeypatch, configinstances, completed_runs):
+    monkeypatch.setattr(action, 'check_all',
+                        lambda *args, **kwargs: completed_runs)
+    return main.run_checks([], configinstances, logging.getLogger('test'),
+                           time.time())
+
+
+def _keys(checks):
+    return [(check['key'], check['config']) for check in checks]
+
+
+class TestSelectChecks(object):
+    def test_tagged_with_their_config(self):
+        configs = [Config('a', checks=['a1', 'a2']), Config('b', checks=[]),
+                   Config('c', checks=['c1'])]
+        selected = main.select_checks(argparse.Namespace(key=None), configs)
+        assert _keys(selected) == [('a1', 0), ('a2', 0), ('c1', 2)]
+        # the loaded testSets are left untagged
+        assert 'config' not in configs[0].load()['checks'][0]
+
+    def test_key(self):
+        configs = [Config('a', checks=['a1', 'shared']),
+                   Config('b', checks=['shared'])]
+        selected = main.select_checks(argparse.Namespace(key='shared'),
+                                      configs)
+        assert _keys(selected) == [('shared', 0), ('shared', 1)]
+
+
+class TestAssignedChecks(object):
+    def _configs(self):
+        keys = ['check{0}'.format(n) for n in range(20)]
+        return [Config('a', checks=keys,
+                       sharding={'node_count': 2, 'node_id': 1}),
+                Config('b', checks=keys)], keys
+
+    def test_sharded_per_config(self):
+        configs, keys = self._configs()
+        inputflag = argparse.Namespace(key=None)
+        selected = main.select_checks(inputflag, configs)
+        assigned = main.assigned_checks(inputflag, selected, configs, [0, 1],
+                                        logging.getLogger('test'))
+        owned = [key for key in keys if sharding.owner(key, ['0', '1']) == '1']
+        assert 0 < len(owned) < len(keys)
+        assert _keys(assigned) == [(key, 0) for key in owned] + \
+            [(key, 1) for key in keys]
+
+    def test_skipped_configs_and_key(self):
+        configs, keys = self._configs()
+        inputflag = argparse.Namespace(key=None)
+        selected = main.select_checks(inputflag, configs)
+        assigned = main.assigned_checks(inputflag, selected, configs, [1],
+                                        logging.getLogger('test'))
+        assert _keys(assigned) == [(key, 1) for key in keys]
+
+        # an explicit --key runs whichever node owns it
+        key = [key for key in keys
+               if sharding.owner(key, ['0', '1']) == '0'][0]
+        inputflag = argparse.Namespace(key=key)
+        selected = main.select_checks(inputflag, configs)
+        assigned = main.assigned_checks(inputflag, selected, configs, [0, 1],
+                                        logging.getLogger('test'))
+        assert _keys(assigned) == [(key, 0), (key, 1)]
+
+
+class TestRunChecks(object):
+    def test_partial_only_where_cancelled(self, sent, monkeypatch):
+        configs = [Config('a'), Config('b'), Config('c')]
+        rc = _run_checks(monkeypatch, configs, [
+            (0, 'a1', None, 0), (2, 'a2', None, 0),
+            (1, 'b1', None, 1), (2, 'b2', None, 1),
+            (0, 'c1', None, 2)])
+        assert sent == [('zabbix-a', [('a', 2), ('b', 1), ('c', 0)])]
+        assert rc == 1
+
+    def test_partial_run(self, sent, monkeypatch):
+        rc = _run_checks(monkeypatch, [Config('a'), Config('b')], [
+            (0, 'a1', None, 0), (2, 'b1', None, 1)])
+        assert sent == [('zabbix-a', [('a', 0), ('b', 2)])]
+        assert rc == 2
+
+    def test_return_code_per_config(self, sent, monkeypatch):
+        rc = _run_checks(monkeypatch, [Config('a'), Config('b')], [
+            (0, 'a1', None, 0), (0, 'a2', None, 0), (0, 'b1', None, 1)])
+        assert sent == [('zabbix-a', [('a', 0), ('b', 0)])]
+        assert rc == 0
+        assert stats.get('checks_failed') == 0
+
+        del sent[:]
+        rc = _run_checks(monkeypatch, [Config('a'), Config('b')], [
+            (0, 'a1', None, 0), (1, 'b1', None, 1), (1, 'b2', None, 1)])
+        assert sent == [('zabbix-a', [('a', 0), ('b', 1)])]
+        assert rc == 1
+        assert stats.get('checks_failed') == 2
+
+    def test_summaries_grouped_by_server(self, sent, monkeypatch):
+        configs = [Config('a', 'zabbix-a'), Config('b', 'zabbix-b'),
+                   Config('c', 'zabbix-a'), Config('d', 'zabbix-b')]
+        rc = _run_checks(monkeypatch, configs, [
+            (0, 'a1', None, 0), (1, 'b1', None, 1), (0, 'c1', None, 2)])
+        assert sent == [('zabbix-a', [('a', 0), ('c', 0)]),
+                        ('zabbix-b', [('b', 1), ('d', 0)])]
+        assert rc == 1
+
+    def test_failed_summary_fails_its_configs(self, sent, monkeypatch):
+        def transmitfacade(configinstance, metrics, logger):
+            server = configinstance['config']['zabbix']['server']
+            sent.append((server, [(m.host, m.value) for m in metrics]))
+            return server != 'zabbix-b'
+        monkeypatch.setattr(action, 'transmitfacade', transmitfacade)
+        configs = [Config('a', 'zabbix-a'), Config('b', 'zabbix-b')]
+        logger = logging.getLogger('test.runs.summary')
+        monkeypatch.setattr(action, 'check_all', lambda *args, **kwargs: [
+            (0, 'a1', None, 0), (0, 'b1', None, 1)])
+        assert main.run_checks([], configs, logger, time.time()) == 1
+        assert [server for server, metrics in sent] == [
+            'zabbix-a', 'zabbix-b']
+
+    def test_only_active_configs_report(self, sent, monkeypatch):
+        monkeypatch.setattr(action, 'check_all', lambda *args, **kwargs: [
+            (0, 'b1', None, 1)])
+        rc = main.run_checks([], [Config('a'), Config('b')],
+                             logging.getLogger('test'), time.time(),
+                             active=[1])
+        assert sent == [('zabbix-a', [('b', 0)])]
+        assert rc == 0
+
+    def test_summary_per_node(self, sent, monkeypatch):
+        keys = []
+
+        def transmitfacade(configinstance, metrics, logger):
+            keys.extend(m.key for m in metrics)
+            return True
+        monkeypatch.setattr(action, 'transmitfacade', transmitfacade)
+        config = Config('a', sharding={'node_count': 3, 'node_id': 2})
+        config.config['config']['zabbix'].update(
+            checksummary_key_format='url_monitor[EXECUTION_STATUS, {node}]',
+            selfstats_key_format='url_monitor[SELFSTATS, {stat}, {node}]')
+        assert _run_checks(monkeypatch, [config], [(0, 'a1', None, 0)]) == 0
+        assert keys[0] == 'url_monitor[EXECUTION_STATUS, 2]'
+        assert 'url_monitor[SELFSTATS, run_seconds, 2]' in keys
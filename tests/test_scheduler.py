@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from url_monitor.scheduler import OriginScheduler, TokenBucket
+from url_monitor.scheduler import origin_host
+
+
+class TestOriginHost(object):
+    def test_origin_host(self):
+        assert origin_host(
+            {'data': {'uri': 'https://api.example:8443/x'}}) == 'api.example'
+        assert origin_host({'data': {}}) == ''
+
+
+class TestTokenBucket(object):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, burst=3, now=0.0)
+        for _ in range(3):
+            assert bucket.wait_time(0.0) == 0
+            bucket.take(0.0)
+        assert bucket.wait_time(0.0) == 0.5
+        assert bucket.wait_time(0.5) == 0
+
+
+class TestOriginScheduler(object):
+    def _run(self, scheduler, tasks, seconds=0.02):
+        lock = threading.Lock()
+        state = {'running': {}, 'peak': {}, 'started': []}
+
+        def func(item):
+            origin = item[0]
+            with lock:
+                running = state['running'].get(origin, 0) + 1
+                state['running'][origin] = running
+                state['peak'][origin] = max(state['peak'].get(origin, 0),
+                                            running)
+                state['started'].append((origin, time.time()))
+            time.sleep(seconds)
+            with lock:
+                state['running'][origin] -= 1
+            return item
+
+        results = scheduler.run([(item[0], item) for item in tasks], func)
+        return results, state
+
+    def test_results_in_task_order(self):
+        tasks = [('a', n) for n in range(5)] + [('b', n) for n in range(5)]
+        results, _ = self._run(OriginScheduler(4), tasks)
+        assert results == tasks
+
+    def test_max_concurrent_per_origin(self):
+        tasks = [('busy', n) for n in range(12)] + [('idle', n)
+                                                     for n in range(4)]
+        scheduler = OriginScheduler(8, {'busy': {'max_concurrent': 2}})
+        _, state = self._run(scheduler, tasks)
+        assert state['peak']['busy'] == 2
+        assert state['peak']['idle'] > 1
+
+    def test_shared_origin_divides_limits(self):
+        scheduler = OriginScheduler(8, {'default': {'max_concurrent': 4}},
+                                    shared={'a': 2})
+        tasks = [('a', n) for n in range(8)]
+        _, state = self._run(scheduler, tasks)
+        assert state['peak']['a'] == 2
+
+    def test_throttled_origin_does_not_block_others(self):
+        tasks = [('slow', n) for n in range(4)] + [('fast', n)
+                                                    for n in range(8)]
+        scheduler = OriginScheduler(
+            2, {'slow': {'requests_per_second': 10, 'burst': 1}})
+        started = time.time()
+        _, state = self._run(scheduler, tasks, seconds=0.001)
+        slow = [t for origin, t in state['started'] if origin == 'slow']
+        fast = [t for origin, t in state['started'] if origin == 'fast']
+        assert slow[-1] - slow[0] >= 0.25
+        assert fast[-1] - started < 0.1
+
+    def test_inline_when_concurrency_is_one(self):
+        threads = []
+        OriginScheduler(1).run(
+            [('a', 1), ('b', 2)],
+            lambda item: threads.append(threading.current_thread()))
+        assert threads == [threading.current_thread()] * 2
+
+    def test_deadline_skips_tasks_not_started(self):
+        scheduler = OriginScheduler(
+            2, {'slow': {'requests_per_second': 10, 'burst': 1}},
+            deadline=time.time() + 0.15)
+        tasks = [('slow', n) for n in range(10)] + [('fast', 0)]
+        results, _ = self._run(scheduler, tasks, seconds=0.001)
+        assert ('fast', 0) in results
+        assert 2 <= len(scheduler.skipped) <= 9
+        assert all(item in results for item in tasks
+                   if item not in scheduler.skipped)
+        assert all(results[tasks.index(item)] is None
+                   for item in scheduler.skipped)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from url_monitor import sharding
+
+KEYS = ['testSet{0}'.format(n) for n in range(2000)]
+
+
+def _assignment(nodes):
+    return dict((key, sharding.owner(key, nodes)) for key in KEYS)
+
+
+class TestSharding(object):
+    def test_every_key_has_one_owner(self):
+        config = {'config': {'sharding': {'node_count': 3}}}
+        checks = [{'key': key} for key in KEYS]
+        owned = []
+        for node in range(3):
+            config['config']['sharding']['node_id'] = node
+            owned.extend(check['key'] for check in sharding.assigned_checks(
+                config, checks, logging.getLogger('test')))
+        assert sorted(owned) == sorted(KEYS)
+
+    def test_spread_is_roughly_even(self):
+        counts = {}
+        for owner in _assignment(['0', '1', '2', '3']).values():
+            counts[owner] = counts.get(owner, 0) + 1
+        assert min(counts.values()) > len(KEYS) / 4 * 0.8
+
+    def test_node_leaving_only_moves_its_keys(self):
+        before = _assignment(['a', 'b', 'c'])
+        after = _assignment(['a', 'c'])
+        moved = [key for key in KEYS if before[key] != after[key]]
+        assert all(before[key] == 'b' for key in moved)
+
+    def test_node_joining_only_takes_keys(self):
+        before = _assignment(['a', 'b', 'c'])
+        after = _assignment(['a', 'b', 'c', 'd'])
+        moved = [key for key in KEYS if before[key] != after[key]]
+        assert all(after[key] == 'd' for key in moved)
+
+    def test_node_count(self):
+        config = {'config': {'sharding': {'node_id': 1, 'node_count': 3}}}
+        checks = [{'key': key} for key in KEYS]
+        mine = sharding.assigned_checks(config, checks,
+                                        logging.getLogger('test'))
+        assert mine
+        assert all(sharding.owner(c['key'], ['0', '1', '2']) == '1'
+                   for c in mine)
+
+    def test_membership_file(self, tmpdir):
+        members = tmpdir.join('nodes')
+        members.write('# zabbix nodes\nzbx-a\n\nzbx-b\n')
+        config = {'config': {'sharding': {'node_id': 'zbx-c',
+                                          'membership_file': str(members)}}}
+        checks = [{'key': key} for key in KEYS]
+        logger = logging.getLogger('test')
+        assert sharding.assigned_checks(config, checks, logger) == []
+
+        config['config']['sharding']['node_id'] = 'zbx-a'
+        mine = sharding.assigned_checks(config, checks, logger)
+        assert 0 < len(mine) < len(checks)
+
+    def test_unconfigured_runs_everything(self):
+        checks = [{'key': key} for key in KEYS]
+        assert sharding.assigned_checks(
+            {'config': {}}, checks, logging.getLogger('test')) == checks
+
+
+    def test_node_name(self, monkeypatch):
+        monkeypatch.setattr(sharding.socket, 'gethostname', lambda: 'zbx-a')
+        assert sharding.node_name(None) == ''
+        assert sharding.node_name({'node_count': 3}) == '0'
+        assert sharding.node_name({'node_count': 3, 'node_id': 2}) == '2'
+        assert sharding.node_name({'membership_file': '/missing'}) == 'zbx-a'
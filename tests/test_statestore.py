@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+
+import pytest
+
+from url_monitor import statestore
+
+
+def _store(tmpdir, **kwargs):
+    return statestore.StateStore(logging.getLogger('test'), str(tmpdir),
+                                 **kwargs)
+
+
+def _fill(directory, name):
+    store = statestore.StateStore(logging.getLogger('test'), directory,
+                                  capacity=16)
+    for n in range(300):
+        store.update(u'{0}{1}'.format(name, n), n, n)
+
+
+class TestStateStore(object):
+    def test_update_returns_previous(self, tmpdir):
+        store = _store(tmpdir)
+        assert store.get('item') is None
+        assert store.update('item', 5, 100.0) is None
+        assert store.update('item', 7, 110.0) == (5.0, 100.0)
+        # a later run opens the same file
+        assert _store(tmpdir).get('item') == (7.0, 110.0)
+
+    def test_grows(self, tmpdir):
+        store = _store(tmpdir, capacity=16)
+        for n in range(1000):
+            store.update(u'item{0}'.format(n), n, n)
+        assert store.capacity == 2048
+        other = _store(tmpdir)
+        assert all(other.get(u'item{0}'.format(n)) == (n, n)
+                   for n in range(1000))
+
+    def test_torn_record_reads_as_missing(self, tmpdir):
+        store = _store(tmpdir)
+        store.update('item', 5, 100.0)
+        offset, _ = store._find(statestore._key_hash('item'))
+        store.map[offset + 8:offset + 9] = b'\xff'
+        assert store.get('item') is None
+        assert store.update('item', 6, 101.0) is None
+        assert store.get('item') == (6.0, 101.0)
+
+    def test_invalid_file_starts_over(self, tmpdir):
+        tmpdir.join(statestore.STATE_FILE).write('garbage')
+        store = _store(tmpdir)
+        assert store.get('item') is None
+        store.update('item', 1, 1)
+        assert store.get('item') == (1.0, 1.0)
+
+    def test_processes_share_the_file(self, tmpdir):
+        # every process grows the table while the others write to it
+        processes = [multiprocessing.Process(target=_fill,
+                                             args=(str(tmpdir), name))
+                     for name in ('a', 'b', 'c')]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        store = _store(tmpdir)
+        assert all(store.get(u'{0}{1}'.format(name, n)) == (n, n)
+                   for name in ('a', 'b', 'c') for n in range(300))
+
+
+class TestDerive(object):
+    def test_rate_and_delta(self, tmpdir):
+        store = _store(tmpdir)
+        assert statestore.derive(store, 'rate', 100, 1000.0) is None
+        assert statestore.derive(store, 'rate', 160, 1060.0) == 1.0
+        assert statestore.derive(store, 'delta', 3, 1000.0, False) is None
+        assert statestore.derive(store, 'delta', '10', 1060.0, False) == 7.0
+
+    def test_counter_reset(self, tmpdir):
+        store = _store(tmpdir)
+        statestore.derive(store, 'rate', 100, 1000.0)
+        assert statestore.derive(store, 'rate', 4, 1060.0) is None
+        assert statestore.derive(store, 'rate', 10, 1063.0) == 2.0
+
+    def test_not_a_number(self, tmpdir):
+        with pytest.raises(ValueError):
+            statestore.derive(_store(tmpdir), 'rate', 'down', 1000.0)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import stat
+import threading
+
+import pytest
+
+from url_monitor import tokencache
+
+
+def _cache(tmpdir, **kwargs):
+    return tokencache.TokenCache(logging.getLogger('test'), str(tmpdir),
+                                 **kwargs)
+
+
+class Fetcher(object):
+    def __init__(self, expires_in=3600):
+        self.calls = 0
+        self.expires_in = expires_in
+
+    def __call__(self):
+        self.calls += 1
+        return 'token{0}'.format(self.calls), self.expires_in
+
+
+class TestTokenCache(object):
+    def test_shared_between_processes(self, tmpdir):
+        fetch = Fetcher()
+        assert _cache(tmpdir).get('api', 'creds', fetch) == 'token1'
+        # a later run reads the token from disk
+        assert _cache(tmpdir).get('api', 'creds', fetch) == 'token1'
+        assert fetch.calls == 1
+        mode = os.stat(str(tmpdir.join(tokencache.TOKEN_FILE))).st_mode
+        assert stat.S_IMODE(mode) == 0o600
+
+    def test_refresh_ahead_of_expiry(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(tokencache.time, 'time', lambda: now[0])
+        cache = _cache(tmpdir, refresh_ahead=60)
+        fetch = Fetcher(expires_in=300)
+        assert cache.get('api', 'creds', fetch) == 'token1'
+        now[0] += 239
+        assert cache.get('api', 'creds', fetch) == 'token1'
+        now[0] += 2
+        assert cache.get('api', 'creds', fetch) == 'token2'
+
+    def test_credentials_change(self, tmpdir):
+        fetch = Fetcher()
+        cache = _cache(tmpdir)
+        assert cache.get('api', 'old', fetch) == 'token1'
+        assert cache.get('api', 'new', fetch) == 'token2'
+        assert cache.get('other', 'new', fetch) == 'token3'
+
+    def test_failed_refresh_uses_valid_token(self, tmpdir, monkeypatch):
+        now = [1000.0]
+        monkeypatch.setattr(tokencache.time, 'time', lambda: now[0])
+        cache = _cache(tmpdir, refresh_ahead=60)
+        cache.get('api', 'creds', Fetcher(expires_in=100))
+
+        def broken():
+            raise IOError("token endpoint down")
+        now[0] += 50
+        assert cache.get('api', 'creds', broken) == 'token1'
+        now[0] += 50
+        with pytest.raises(IOError):
+            cache.get('api', 'creds', broken)
+
+    def test_concurrent_refreshes_collapse(self, tmpdir):
+        cache = _cache(tmpdir)
+        fetch = Fetcher()
+        threads = [threading.Thread(target=cache.get,
+                                    args=('api', 'creds', fetch))
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert fetch.calls == 1
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+import collections
+import logging
+import os
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import pytest
+
+from url_monitor import action
+from url_monitor import stats
+from url_monitor import workers
+
+Metric = collections.namedtuple('Metric', 'host key value')
+
+ZABBIX = {'host': 'url_monitor', 'server': '127.0.0.1:10051'}
+CONFIG = {'config': {'zabbix': ZABBIX}}
+
+
+def _checks(hosts):
+    return [{'key': 'testSet{0}'.format(n),
+             'data': {'uri': 'https://{0}:8443/{1}'.format(host, n)}}
+            for n, host in enumerate(hosts)]
+
+
+def check_all(checks, configinstance, logger, sender, shared, deadline,
+              configinstances):
+    """
+    Stands in for action.check_all() in the workers: one metric per check,
+    checks against the host slow never finish.
+    """
+    runs = []
+    for check in checks:
+        if '//slow:' in check['data']['uri']:
+            time.sleep(60)
+        sender(configinstance, [Metric('url_monitor', check['key'],
+                                       os.getpid())], logger)
+        runs.append((0, check['key'], check, check.get('config', 0)))
+    return runs
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    sent = []
+
+    def transmitfacade(configinstance, metrics, logger):
+        sent.append((configinstance['config']['zabbix'], metrics))
+        return True
+    monkeypatch.setattr(action, 'transmitfacade', transmitfacade)
+    monkeypatch.setattr(action, 'check_all', check_all)
+    stats.reset()
+    return sent
+
+
+class TestPartition(object):
+    def test_origins_stay_together(self):
+        checks = _checks(['api{0}'.format(n % 7) for n in range(70)])
+        chunks = workers.partition(checks, 3)
+        assert sorted(c['key'] for chunk in chunks for c in chunk) == \
+            sorted(c['key'] for c in checks)
+        hosts = [set(c['data']['uri'].split('/')[2] for c in chunk)
+                 for chunk in chunks]
+        assert sum(len(h) for h in hosts) == len(set.union(*hosts)) == 7
+        assert max(len(chunk) for chunk in chunks) <= 30
+
+    def test_single_origin_is_split(self):
+        chunks = workers.partition(_checks(['api'] * 10), 4)
+        assert sorted(len(chunk) for chunk in chunks) == [1, 3, 3, 3]
+
+    def test_more_workers_than_checks(self):
+        chunks = workers.partition(_checks(['a', 'b']), 4)
+        assert sorted(len(chunk) for chunk in chunks) == [0, 0, 1, 1]
+
+
+class TestWorkerPool(object):
+    def test_transmit_coalesces_queued_metrics(self, sent):
+        pool = workers.WorkerPool(2, CONFIG, logging.getLogger('test'))
+        pool.results = queue.Queue()
+        other = dict(ZABBIX, host='other')
+        pool.results.put(('metrics', ZABBIX, [Metric('h', 'b', 2)]))
+        pool.results.put(('metrics', ZABBIX, [Metric('h', 'c', 3)]))
+        pool.results.put(('metrics', other, [Metric('h', 'd', 4)]))
+        pool.results.put(('metrics', ZABBIX, [Metric('h', 'e', 5)]))
+        following = pool._transmit(ZABBIX, [Metric('h', 'a', 1)])
+        assert sent == [(ZABBIX, [Metric('h', key, value) for key, value in
+                                  (('a', 1), ('b', 2), ('c', 3))])]
+        # coalescing stops at the metrics of another server, which are
+        # handed back rather than queued again
+        assert following == ('metrics', other, [Metric('h', 'd', 4)])
+        assert pool.results.get_nowait()[2] == [Metric('h', 'e', 5)]
+        assert pool.results.empty()
+
+    def test_sections_interleaved_with_done(self, sent):
+        pool = workers.WorkerPool(2, CONFIG, logging.getLogger('test'))
+        pool.results = queue.Queue()
+        other = dict(ZABBIX, host='other')
+        pool.results.put(('metrics', other, [Metric('h', 'b', 2)]))
+        exported = ({}, {}, {})
+        pool.results.put(('done', 0, [(0, 'testSet0', None, 0)], exported))
+        pool.results.put(('done', 1, [(0, 'testSet1', None, 1)], exported))
+        pending = {0: ['testSet0'], 1: ['testSet1']}
+        completed_runs = []
+        pool._handle(('metrics', ZABBIX, [Metric('h', 'a', 1)]), pending,
+                     completed_runs)
+        pool._handle(pool.results.get_nowait(), pending, completed_runs)
+        # the other server's batch went out before the workers were done
+        assert sent == [(ZABBIX, [Metric('h', 'a', 1)]),
+                        (other, [Metric('h', 'b', 2)])]
+        assert pending == {}
+        assert [run[1] for run in completed_runs] == ['testSet0',
+                                                      'testSet1']
+        assert pool.results.empty()
+
+    def test_metrics_are_forwarded(self, sent):
+        pool = workers.WorkerPool(2, CONFIG,
+                                  logging.getLogger('test')).start()
+        try:
+            checks = _checks(['a', 'a', 'b', 'c'])
+            runs = pool.run(checks)
+        finally:
+            pool.stop()
+        assert sorted(run[1] for run in runs) == \
+            sorted(check['key'] for check in checks)
+        metrics = [metric for zabbix, batch in sent for metric in batch]
+        assert sorted(m.key for m in metrics) == \
+            sorted(check['key'] for check in checks)
+        assert all(zabbix == ZABBIX for zabbix, batch in sent)
+        # the work was spread over both processes, none in this one
+        pids = set(m.value for m in metrics)
+        assert len(pids) == 2 and os.getpid() not in pids
+
+    def test_deadline_kills_and_restarts(self, sent, monkeypatch):
+        monkeypatch.setattr(workers, 'DEADLINE_GRACE', 0.5)
+        pool = workers.WorkerPool(2, CONFIG,
+                                  logging.getLogger('test')).start()
+        try:
+            before = set(process.pid for process, tasks in pool.workers)
+            started = time.time()
+            runs = pool.run(_checks(['slow', 'fast', 'fast']),
+                            deadline=time.time())
+            assert time.time() - started < 10
+            # the checks of the killed worker come back as cancelled
+            assert sorted(run[:2] for run in runs) == [
+                (0, 'testSet1'), (0, 'testSet2'), (2, 'testSet0')]
+            assert stats.get('checks_cancelled') == 1
+            after = set(process.pid for process, tasks in pool.workers)
+            assert len(after) == 2 and not before & after
+
+            # the restarted pool takes the next run
+            del sent[:]
+            assert len(pool.run(_checks(['a', 'b']))) == 2
+            assert len([m for zabbix, batch in sent for m in batch]) == 2
+        finally:
+            pool.stop()
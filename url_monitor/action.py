@@ -6,26 +6,40 @@ import commons
 import sys
 import json
 import requests
+import time
 from urlparse import urlparse
 
+import breaker
+import routing
+import scheduler
+import sharding
+import statestore
+import stats
+import tokencache
+import transport
 import zbxsend
 
 __doc__ = """Action on backends after entry points are handled in main"""
 
-
-def webfacade(testSet, configinstance, webcaller, config):
+def webfacade(testSet, configinstance, webcaller, config, deadline=None):
     """
     Perform the web request for a check.
     (Called upon by check())
 
     :param testSet: Name of testset to pull values
     :param configinstance: config class object
+    :param deadline: time.time() of the run_deadline, the request timeout
+        is cut down to what is left of the run
     :return requests output:
     """
 
     # config getters
     tmout = configinstance.get_request_timeout(testSet)
+    if deadline is not None:
+        tmout = max(0.1, min(tmout, deadline - time.time()))
     vfyssl = configinstance.get_verify_ssl(testSet)
+    encodings = configinstance.get_accept_encoding(testSet)
+    max_bytes = configinstance.get_max_response_bytes(testSet)
     testset = configinstance.get_test_set(testSet)
 
     # dispatch request
@@ -36,7 +50,9 @@ def webfacade(testSet, configinstance, webcaller, config):
                             testset['data']['ok_http_code']),
                         identity_provider=testset[
                             'data']['identity_provider'],
-                        timeout=tmout)
+                        timeout=tmout,
+                        accept_encoding=encodings,
+                        max_response_bytes=max_bytes)
 
     if out == False:  # webcaller.run has requests.exceptions
         logging.error("Spawn request failed, skipping."
@@ -52,16 +68,16 @@ def transmitfacade(configinstance, metrics, logger):
     Send a list of Metric objects to zabbix.
     Called by check()
 
+    With several servers configured the metrics go to them as set by
+    server_strategy, see routing.Router.
+
     param configinstance: The current configinstance object
     param metrics: list of Metrics for zbxsend
     Returns True if succcess.
     """
-    constant_zabbix_port = 10051
     try:
-        z_host, z_port = commons.get_hostport_tuple(
-            constant_zabbix_port,
-            configinstance['config']['zabbix']['server']
-        )
+        zabbix = configinstance['config']['zabbix']
+        zabbix['server']
     except:
         logging.error('Could not reference config: zabbix: server in conf')
         return False
@@ -75,53 +91,158 @@ def transmitfacade(configinstance, metrics, logger):
         return False
 
     msg = "Transmitting metrics to zabbix"
-    logging.debug(
-        "{m}: {telem}".format(
-            m=msg, telem=metrics
-        )
-    )
-    logging.info(
-        "{m} host {zbxhost}:{zbxport}".format(
-            m=msg, metrics=metrics, zbxhost=z_host, zbxport=z_port, logger=logger
-        )
-    )
+    logging.debug("%s: %s", msg, metrics)
+    logging.info("%s server %s", msg, zabbix['server'])
+
+    def send(batch, z_host, z_port):
+        # Send metrics to zabbix
+        try:
+            return zbxsend.send_to_zabbix(
+                metrics=batch,
+                zabbix_host=z_host,
+                zabbix_port=z_port,
+                timeout=timeout,
+                logger=logger
+            )
+        except:
+            logging.debug("event.send_to_zabbix(%s,%s,%s,%s) failed in"
+                          " transmitfacade()", batch, z_host, z_port, timeout)
+            return False
 
-    # Send metrics to zabbix
     try:
-        zbxsend.send_to_zabbix(
-            metrics=metrics,
-            zabbix_host=z_host,
-            zabbix_port=z_port,
-            timeout=timeout,
-            logger=logger
-        )
-    except:
-        logging.debug("event.send_to_zabbix({0},{1},{2},{3}) failed in"
-                      " transmitfacade()".format(metrics, z_host, z_port, timeout))
+        return routing.get_router(logger).send(zabbix, metrics, send)
+    except ValueError as err:
+        logging.error("Invalid config: zabbix: {0}".format(err))
         return False
-    # success
-    return True
 
 
-def check(testSet, configinstance, logger):
+def checkstats_metrics(testSet, config, timings):
+    """
+    Build Metrics for the per check statistics (phase timings, response
+    size and status code) of a testSet.
+    Called by check()
+
+    Without checkstats_key_format only the status (ok, failed, unreachable,
+    too_large, cancelled or skipped) is sent, when checkstatus_key_format
+    is set. Returns an empty list if neither is configured.
+    """
+    zabbix = config['config']['zabbix']
+    key_format = zabbix.get('checkstats_key_format')
+    if not key_format:
+        key_format = zabbix.get('checkstatus_key_format')
+        if not key_format or 'status' not in timings:
+            return []
+        timings = {'status': timings['status']}
+
+    uri = testSet['data']['uri']
+    substitutes = {'checkname': testSet['key'],
+                   'uri': uri,
+                   'originhost': urlparse(uri).netloc.split(':')[0]}
+    return [
+        zbxsend.Metric(config['config']['zabbix']['host'],
+                       key_format.format(stat=stat, **substitutes),
+                       value)
+        for stat, value in sorted(timings.items())
+    ]
+
+
+def transmit_checkstats(testSet, config, timings, logger, sender=None):
+    """
+    Send the per check statistics to zabbix if they are configured.
+    Called by check()
+    """
+    sender = sender or transmitfacade
+    metrics = checkstats_metrics(testSet, config, timings)
+    if metrics and not sender(configinstance=config,
+                              metrics=metrics, logger=logger):
+        logger.critical("Sending check statistics to zabbix failed!")
+
+
+def selfstats_metrics(config):
+    """
+    Build Metrics for url_monitor's own run statistics.
+    Called by main() with the execution summary.
+
+    Returns an empty list if selfstats_key_format is not configured.
+    """
+    key_format = config['config']['zabbix'].get('selfstats_key_format')
+    if not key_format:
+        return []
+
+    counters = stats.snapshot()
+    node = sharding.node_name(config['config'].get('sharding'))
+    return [
+        zbxsend.Metric(config['config']['zabbix']['host'],
+                       key_format.format(stat=stat, node=node),
+                       counters.get(stat, 0))
+        for stat in stats.RUN_STATS
+    ]
+
+
+def check(testSet, configinstance, logger, sender=None, deadline=None):
     """
     Perform the checks when called upon by argparse in main()
 
     :param testSet:
     :param configinstance:
     :param logger:
-    :return: tuple (statcode, check)
+    :param sender: replaces transmitfacade, used by worker processes
+    :param deadline: time.time() of the run_deadline
+    :return: tuple (statcode, check), statcode 2 when the request was cut
+        short by the run_deadline
     """
+    sender = sender or transmitfacade
 
     testset = configinstance.get_test_set(testSet)
 
     config = configinstance.load()
-    webinstance = commons.WebCaller(logger)
+    webinstance = commons.WebCaller(logger,
+                                    tokencache.get_tokens(configinstance,
+                                                          logger))
+
+    # Don't wait on hosts that have been failing, report them right away
+    originhost = scheduler.origin_host(testSet)
+    breakers = breaker.get_breakers(configinstance, logger)
+    if breakers and not breakers.allow(originhost):
+        logger.warning("Circuit breaker for {0} is open, not checking "
+                       "{1}".format(originhost, testSet['key']))
+        stats.incr('checks_skipped')
+        transmit_checkstats(testSet, config, {'status': 'unreachable'},
+                            logger, sender)
+        return (1, None)
 
     # Make a request and check a resource
-    response = webfacade(testSet, configinstance, webinstance, config)
+    try:
+        response = webfacade(testSet, configinstance, webinstance, config,
+                             deadline)
+    except Exception:
+        if breakers:
+            breakers.release(originhost)
+        raise
+    # a request cut short by the run_deadline says nothing about the host
+    cancelled = not response and deadline is not None and \
+        time.time() >= deadline
+    if breakers:
+        if cancelled:
+            breakers.release(originhost)
+        else:
+            breakers.record(originhost, not webinstance.unreachable)
+    timings = webinstance.timings
     if not response:
+        if cancelled:
+            timings['status'] = 'cancelled'
+            stats.incr('checks_cancelled')
+        elif webinstance.unreachable:
+            timings['status'] = 'unreachable'
+        elif webinstance.too_large:
+            timings['status'] = 'too_large'
+        else:
+            timings['status'] = 'failed'
+        transmit_checkstats(testSet, config, timings, logger, sender)
+        if cancelled:
+            return (2, None)
         return (1, None)  # caught request exception!
+    timings['parse'] = 0.0
 
     # This is the host defined in your metric.
     # This matches the name of your host in zabbix.
@@ -132,7 +253,10 @@ def check(testSet, configinstance, logger):
 
     # For each testElement do our path check and capture results
 
-    for check in testSet['data']['testElements']:
+    for element in testSet['data']['testElements']:
+        # the results are added to a copy, the config is used again by
+        # later runs of a daemon
+        check = dict(element)
         if not configinstance.datatypes_valid(check):
             return (1, check)
 
@@ -144,12 +268,14 @@ def check(testSet, configinstance, logger):
         # We need to make a metric for each explicit data type
         # (string,int,count)
         for datatype in datatypes:
+            parse_started = time.time()
             try:
                 api_res_value = commons.omnipath(response.content, testSet[
                     'data']['response_type'], check)
             except KeyError as err:
                 logging.error("Uncaught unknown error")
                 return (1, check)
+            timings['parse'] += time.time() - parse_started
 
             # Append to the check things like response, statuscode, and
             # the request url, I'd like to monitor status codes but don't
@@ -184,8 +310,8 @@ def check(testSet, configinstance, logger):
                 report_bad_health = True
 
             # Print out each k,v
-            logging.debug(" Found resource {uri}||{k} value ({v})".format(
-                uri=check['uri'], k=check['key'], v=check['api_response']))
+            logging.debug(" Found resource %s||%s value (%s)", check['uri'],
+                          check['key'], check['api_response'])
 
             # Applies a key format from the configuration file, allowing
             # custom zabbix keys for your items reporting to zabbix. Any
@@ -194,14 +320,51 @@ def check(testSet, configinstance, logger):
             metrickey = config['config']['zabbix'][
                 'item_key_format'].format(**check)
 
+            # rate and delta items are sent as the change since the last
+            # run, there is nothing to send for the first value
+            if datatype in statestore.DERIVED_DATATYPES and \
+                    api_res_value is not None:
+                try:
+                    api_res_value = statestore.derive(
+                        statestore.get_store(configinstance, logger),
+                        u"{0}\0{1}".format(zabbix_metric_host, metrickey),
+                        api_res_value, time.time(),
+                        per_second=datatype == 'rate')
+                except (TypeError, ValueError):
+                    logging.warning("{0} value {1!r} is not a number, can't "
+                                    "send its {2}".format(
+                                        check['key'], check['api_response'],
+                                        datatype))
+                    report_bad_health = True
+                    continue
+                except (IOError, OSError) as err:
+                    logging.error("Could not use the state store: "
+                                  "{0}".format(err))
+                    report_bad_health = True
+                    continue
+                if api_res_value is None:
+                    continue
+                check['api_response'] = api_res_value
+
             zabbix_telemetry.append(
                 zbxsend.Metric(zabbix_metric_host, metrickey, check['api_response'])
             )
 
+    timings['status'] = 'failed' if report_bad_health else 'ok'
+    checkstats = config['config']['zabbix'].get('checkstats_key_format')
+    if not checkstats:
+        # just the status, it goes out with the items
+        zabbix_telemetry += checkstats_metrics(testSet, config, timings)
+
     logger.info("Sending telemetry to zabbix server as Metrics objects")
-    logger.debug("Telemetry: {0}".format(zabbix_telemetry))
-    if not transmitfacade(configinstance=config, metrics=zabbix_telemetry, logger=logger):
+    logger.debug("Telemetry: %s", zabbix_telemetry)
+    send_started = time.time()
+    if not sender(configinstance=config, metrics=zabbix_telemetry, logger=logger):
         logger.critical("Sending telemetry to zabbix failed!")
+    timings['send'] = time.time() - send_started
+
+    if checkstats:
+        transmit_checkstats(testSet, config, timings, logger, sender)
 
     if report_bad_health:
         return (1, check)
@@ -209,19 +372,128 @@ def check(testSet, configinstance, logger):
         return (0, check)
 
 
-def discover(args, configinstance, logger):
+def check_all(checks, configinstance, logger, sender=None, shared=None,
+              deadline=None, configinstances=None):
+    """
+    Run check() for a list of testSets, concurrently when config:
+    concurrency is above 1, and within the origin_limits of each host.
+    Called by main() and by worker processes.
+
+    :param shared: dict of origin host to the number of worker processes
+        its checks are split across, see scheduler.OriginScheduler
+    :param deadline: time.time() of the run_deadline, checks that haven't
+        started by then are skipped and reported with the status skipped
+    :param configinstances: every config of a job running several, a
+        testSet tagged with 'config' runs with configinstances[config].
+        configinstance still sets the concurrency and origin_limits.
+    :return: list of (statcode, testSet key, check, config) for the checks
+        that completed, checks raising an exception are logged and left
+        out. Checks skipped by the run_deadline are in it with statcode 2.
+    """
+    def config_of(thisscheck):
+        if configinstances:
+            return configinstances[thisscheck.get('config', 0)]
+        return configinstance
+
+    def run(thisscheck):
+        try:
+            rc, checkobj = check(thisscheck, config_of(thisscheck), logger,
+                                 sender, deadline)
+            return (rc, thisscheck['key'], checkobj,
+                    thisscheck.get('config', 0))
+        except Exception as e:
+            stats.incr('checks_failed')
+            logger.exception(e)
+        finally:
+            stats.incr('checks_run')
+
+    concurrency = configinstance.get_concurrency()
+    transport.get_adapter(pool_maxsize=concurrency)
+    origin_scheduler = scheduler.OriginScheduler(
+        concurrency,
+        configinstance.get_origin_limits(),
+        shared,
+        deadline)
+
+    # pick up what earlier runs and other workers learned about hosts
+    breakers = breaker.get_breakers(configinstance, logger)
+    if breakers:
+        breakers.load()
+    try:
+        results = origin_scheduler.run(
+            [(scheduler.origin_host(thisscheck), thisscheck)
+             for thisscheck in checks],
+            run)
+    finally:
+        if breakers:
+            breakers.save()
+
+    skipped = origin_scheduler.skipped
+    if skipped:
+        logger.warning("run_deadline reached, skipped {0} checks".format(
+            len(skipped)))
+        stats.incr('checks_skipped', len(skipped))
+        stats.incr('checks_cancelled', len(skipped))
+        # one send per config, each has its own zabbix host and keys
+        by_config = {}
+        for thisscheck in skipped:
+            by_config.setdefault(thisscheck.get('config', 0), []).append(
+                thisscheck)
+        for index, config_checks in sorted(by_config.items()):
+            config = config_of(config_checks[0]).load()
+            metrics = []
+            for thisscheck in config_checks:
+                metrics += checkstats_metrics(thisscheck, config,
+                                              {'status': 'skipped'})
+            if metrics and not (sender or transmitfacade)(
+                    configinstance=config, metrics=metrics, logger=logger):
+                logger.critical("Sending check statistics to zabbix "
+                                "failed!")
+    return [result for result in results if result is not None] + [
+        (2, thisscheck['key'], None, thisscheck.get('config', 0))
+        for thisscheck in skipped]
+
+
+def discover(args, configinstances, logger):
     """
     Perform the discovery when called upon by argparse in main()
 
     :param args:
-    :param configinstance:
+    :param configinstances: loaded configs, discovered together
     :param logger:
     :return:
     """
-    configinstance.load_yaml_file(args.config)
-    config = configinstance.load()
+    discovery_dict = discovery(args, configinstances, logger)
+    # Print discovery dict.
+    if discovery_dict is not None:
+        print(json.dumps(discovery_dict, indent=3))
+
+
+def discovery(args, configinstances, logger):
+    """
+    Builds the low level discovery data of the configs, also used by the
+    daemon to answer thin clients.
+
+    :param args: with the datatype and testsets options of discover
+    :return dict: None when there is nothing to discover without a
+        datatype
+    """
+    checks = [testSet for configinstance in configinstances
+              for testSet in configinstance.load()['checks']]
+
+    if args.testsets:
+        # One discovery item per testSet, used for per check items
+        # such as the checkstats_key_format statistics.
+        discovery_dict = {'data': []}
+        for testSet in checks:
+            uri = testSet['data']['uri']
+            discovery_dict['data'].append(
+                {'{#CHECKNAME}': testSet['key'],
+                 '{#RESOURCE_URI}': uri,
+                 '{#ORIGINHOST}': urlparse(uri).netloc.split(':')[0]}
+            )
+        return discovery_dict
 
-    discover = True
     if not args.datatype:
         logging.error(
             "\nError: Invalid options\n"
@@ -232,23 +504,26 @@ def discover(args, configinstance, logger):
             "       testSet->your_test_name->testElements->datatype->"
             "your_datatype"
             "\n\n".format(
-                configinstance.get_datatypes_list()
+                ", ".join(configinstance.get_datatypes_list()
+                          for configinstance in configinstances)
             )
         )
-        discover = False
+        return None
 
     discovery_dict = {'data': []}
 
-    for testSet in config['checks']:
+    for testSet in checks:
         checkname = testSet['key']
 
         uri = testSet['data']['uri']
 
-        for discoveryitem in testSet['data']['testElements']:  # For every item
-            datatypes = discoveryitem['datatype'].split(',')
+        for element in testSet['data']['testElements']:  # For every item
+            datatypes = element['datatype'].split(',')
             for datatype in datatypes:  # For each datatype in testElements
                 if datatype == args.datatype:  # Only add if datatype relevant
-                    # Add more useful properties to the discovery discoveryitem
+                    # Add more useful properties to the discovery item, a
+                    # copy as a daemon discovers from the same config again
+                    discoveryitem = dict(element)
                     discoveryitem.update(
                         {'checkname': checkname,
                          'resource_uri': uri}
@@ -256,13 +531,11 @@ def discover(args, configinstance, logger):
 
                     # Apply Zabbix low level discovery formating to key names
                     #  (shift to uppercase)
-                    for old_key in discoveryitem.keys():
+                    for old_key in list(discoveryitem.keys()):
                         new_key = "{#" + old_key.upper() + "}"
                         discoveryitem[new_key] = discoveryitem.pop(old_key)
 
                     # Add this test discoveryitem to the discovery dict.
-                    logger.debug('Item discovered ' + str(discoveryitem))
+                    logger.debug('Item discovered %s', discoveryitem)
                     discovery_dict['data'].append(discoveryitem)
-    # Print discovery dict.
-    if discover:
-        print(json.dumps(discovery_dict, indent=3))
+    return discovery_dict
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import math
+import numbers
+
+try:
+    import numpy
+except ImportError:  # aggregates are computed in pure python
+    numpy = None
+
+__doc__ = """Aggregates over the values a wildcard jsonvalue selects"""
+
+FUNCTIONS = ('count', 'distinct', 'sum', 'min', 'max', 'mean')
+
+
+def percentile_rank(function):
+    """
+    Returns the rank of a pNN percentile function (p95 is 95.0, p99.9 is
+    99.9), None if function isn't one.
+    """
+    if not function.startswith('p'):
+        return None
+    try:
+        rank = float(function[1:])
+    except ValueError:
+        return None
+    if not 0 <= rank <= 100:
+        return None
+    return rank
+
+
+def is_valid(function):
+    return function in FUNCTIONS or percentile_rank(function) is not None
+
+
+def _numbers(values):
+    """
+    Returns (numbers, integral) for the values that are numbers or numeric
+    strings, integral when all of them are integers.
+    """
+    found = []
+    integral = True
+    for value in values:
+        if isinstance(value, bool):
+            continue
+        if not isinstance(value, numbers.Number):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+        if isinstance(value, float):
+            if math.isnan(value):
+                continue
+            integral = integral and value.is_integer()
+        found.append(value)
+    return found, integral
+
+
+def _percentile(ordered, rank):
+    # linear interpolation between the closest ranks, like numpy
+    position = (len(ordered) - 1) * rank / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * \
+        (position - lower)
+
+
+def aggregate(values, function):
+    """
+    Aggregates a list of values.
+
+    count and distinct count every value, the numeric functions (sum, min,
+    max, mean and pNN percentiles) only numbers and numeric strings. They
+    are computed on a numpy array when numpy is installed.
+
+    :param values: list, as returned by jpath for a wildcard path
+    :param function: name of the aggregate
+    :raise ValueError: for an unknown function
+    :return: the aggregate, None when there are no numbers to aggregate
+    """
+    if not is_valid(function):
+        raise ValueError("Unknown aggregate {0}".format(function))
+    if values is None:
+        values = []
+    elif not isinstance(values, list):
+        values = [values]
+
+    if function == 'count':
+        return len(values)
+    if function == 'distinct':
+        return len(set(json.dumps(value, sort_keys=True)
+                       for value in values))
+
+    found, integral = _numbers(values)
+    if not found:
+        return None
+    rank = percentile_rank(function)
+
+    if numpy is not None:
+        array = numpy.array(found, dtype=float)
+        if rank is not None:
+            result = numpy.percentile(array, rank)
+        else:
+            result = getattr(numpy, function)(array)
+        result = float(result)
+    elif rank is not None:
+        result = float(_percentile(sorted(found), rank))
+    elif function == 'mean':
+        result = float(sum(found)) / len(found)
+    else:
+        result = {'sum': sum, 'min': min, 'max': max}[function](found)
+
+    if function in ('sum', 'min', 'max'):
+        return int(result) if integral else float(result)
+    return result
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+import os
+import threading
+import time
+
+__doc__ = """Per origin host circuit breakers persisted between runs"""
+
+STATE_FILE = 'url_monitor.breakers.json'
+# Seconds the half-open probe of a host stays claimed by the process that
+# took it, another process may probe once it runs out
+PROBE_LEASE = 60.0
+
+
+class CircuitBreakers(object):
+    """
+    Tracks consecutive request failures per origin host.
+
+    After `failures` consecutive failures the breaker of a host opens and
+    its checks are not attempted for `backoff` seconds. Once that window is
+    over a single half-open probe request is let through: if it succeeds
+    the breaker closes, if it fails the breaker opens again for twice as
+    long, up to `max_backoff`.
+
+    State is kept in a JSON file in the state_dir so it carries over
+    between cron invocations. Only the hosts this process touched are
+    written back, merged under a lock with what other processes wrote.
+    The half-open probe is claimed in the same file, so worker processes
+    and overlapping runs don't all probe a host at once.
+    """
+
+    def __init__(self, logging, directory, failures=3, backoff=60.0,
+                 max_backoff=3600.0):
+        self.logging = logging
+        self.path = os.path.join(directory, STATE_FILE)
+        self.failures = int(failures)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+
+        self.hosts = {}
+        self.dirty = set()
+        self.probing = set()
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self):
+        """
+        Reads the breaker state written by earlier runs and other workers.
+        """
+        hosts = self._read()
+        with self.lock:
+            self.hosts = hosts
+            self.dirty = set()
+        return self
+
+    def _write(self, hosts):
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(hosts, f)
+        os.rename(tmp_path, self.path)
+
+    def save(self):
+        """
+        Writes back the state of the hosts this process touched.
+        """
+        with self.lock:
+            changes = dict((host, self.hosts.get(host))
+                           for host in self.dirty)
+            self.dirty = set()
+        if not changes:
+            return
+        try:
+            with open(self.path + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                hosts = self._read()
+                for host, state in changes.items():
+                    if state is None:
+                        hosts.pop(host, None)
+                    else:
+                        hosts[host] = state
+                self._write(hosts)
+        except (IOError, OSError) as err:
+            self.logging.warning("Could not save circuit breaker state to "
+                                 "{0}: {1}".format(self.path, err))
+
+    def _claim_probe(self, host):
+        """
+        Claims the half-open probe of host in the state file for
+        PROBE_LEASE seconds.
+
+        :return: False if another process reopened the breaker or holds
+            the probe
+        """
+        try:
+            with open(self.path + '.lock', 'a') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                hosts = self._read()
+                state = hosts.get(host)
+                if state is None:
+                    # closed by another process since we loaded
+                    return True
+                now = time.time()
+                if now < state.get('open_until', 0) or \
+                        now < state.get('probe_until', 0):
+                    return False
+                state['probe_until'] = now + PROBE_LEASE
+                self._write(hosts)
+                return True
+        except (IOError, OSError) as err:
+            self.logging.warning("Could not claim the circuit breaker probe "
+                                 "in {0}: {1}".format(self.path, err))
+            return True
+
+    def allow(self, host):
+        """
+        Returns True if a request to host may be made now. Claims the
+        half-open probe when the backoff window of an open breaker is over.
+        """
+        with self.lock:
+            state = self.hosts.get(host)
+            if not state or not state.get('open_until'):
+                return True
+            if time.time() < state['open_until'] or host in self.probing:
+                return False
+            if not self._claim_probe(host):
+                return False
+            self.probing.add(host)
+            self.logging.info("Circuit breaker for {0} is half-open, "
+                              "probing".format(host))
+            return True
+
+    def release(self, host):
+        """
+        Gives up the half-open probe of host without an outcome, for
+        checks that failed before making their request.
+        """
+        with self.lock:
+            if host in self.probing:
+                self.probing.discard(host)
+                # written back without the claim by save()
+                self.dirty.add(host)
+
+    def record(self, host, ok):
+        """
+        Records the outcome of a request to host.
+
+        :param ok: False if the host could not be reached
+        """
+        with self.lock:
+            probe = host in self.probing
+            self.probing.discard(host)
+            state = self.hosts.get(host)
+            if ok:
+                if state:
+                    if state.get('open_until'):
+                        self.logging.info("Circuit breaker for {0} "
+                                          "closed".format(host))
+                    self.hosts.pop(host)
+                    self.dirty.add(host)
+                return
+
+            state = self.hosts.setdefault(
+                host, {'failures': 0, 'open_until': 0, 'backoff': 0})
+            state['failures'] += 1
+            self.dirty.add(host)
+            if probe:
+                state['backoff'] = min(self.max_backoff,
+                                       state['backoff'] * 2 or self.backoff)
+            elif state['failures'] >= self.failures and \
+                    not state['open_until']:
+                state['backoff'] = self.backoff
+            else:
+                return
+            state['open_until'] = time.time() + state['backoff']
+            self.logging.warning("Circuit breaker for {0} opened for {1:.0f}s "
+                                 "after {2} consecutive failures".format(
+                                     host, state['backoff'],
+                                     state['failures']))
+
+
+_breakers = None
+_breakers_lock = threading.Lock()
+
+
+def get_breakers(configinstance, logger):
+    """
+    Returns the circuit breakers of this process, or None when
+    config: circuit_breaker is not configured.
+    """
+    global _breakers
+    settings = configinstance.get_circuit_breaker()
+    if settings is None:
+        return None
+    with _breakers_lock:
+        if _breakers is None:
+            _breakers = CircuitBreakers(
+                logger, configinstance.get_state_dir(),
+                failures=settings.get('failures', 3),
+                backoff=settings.get('backoff', 60),
+                max_backoff=settings.get('max_backoff', 3600))
+        return _breakers
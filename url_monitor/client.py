@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import errno
+import hashlib
+import json
+import os
+import socket
+import sys
+
+__doc__ = """Thin client asking a resident daemon for check and discover"""
+
+DEFAULT_CONFIG = "/etc/url_monitor.yaml"
+SOCKET_DIR = "/var/lib/zabbixsrv/"
+# Zabbix gives up on external checks after 30 seconds at most
+TIMEOUT = 25.0
+
+_OPTIONS = {'-c': 'config', '--config': 'config',
+            '-t': 'datatype', '--datatype': 'datatype',
+            '--socket': 'socket', '--loglevel': 'loglevel'}
+
+
+class NoDaemon(socket.error):
+    """
+    Raised by call() when no daemon listens on the control socket.
+    """
+    pass
+
+
+def default_socket_path(configs):
+    """
+    Returns the control socket of the daemon started with the given -c
+    arguments, so a daemon and its clients find each other from the
+    command line alone.
+
+    :param configs: values of -c, None for the system default
+    """
+    paths = [os.path.abspath(path) for path in configs or [DEFAULT_CONFIG]]
+    digest = hashlib.sha1('\0'.join(paths).encode('utf-8')).hexdigest()
+    return os.path.join(SOCKET_DIR, "url_monitor-{0}.sock".format(
+        digest[:12]))
+
+
+def parse(arguments):
+    """
+    Turns command line arguments into a request for the daemon.
+
+    :return: (socket path, request dict), None for anything but a plain
+        check or discover, which is left to a full run
+    """
+    options = {'config': []}
+    flags = set()
+    positional = []
+    arguments = list(arguments)
+    while arguments:
+        argument = arguments.pop(0)
+        name, inline, value = argument.partition('=')
+        if name in _OPTIONS:
+            if not inline:
+                if not arguments:
+                    return None
+                value = arguments.pop(0)
+            if _OPTIONS[name] == 'config':
+                options['config'].append(value)
+            else:
+                options[_OPTIONS[name]] = value
+        elif argument == '--testsets':
+            flags.add('testsets')
+        elif argument.startswith('-'):
+            return None
+        else:
+            positional.append(argument)
+    if len(positional) != 1:
+        return None
+
+    command = positional[0]
+    if command == 'check':
+        if flags:
+            return None
+        request = {'command': 'check'}
+    elif command == 'discover':
+        if not options.get('datatype') and 'testsets' not in flags:
+            return None
+        request = {'command': 'discover',
+                   'datatype': options.get('datatype'),
+                   'testsets': 'testsets' in flags}
+    else:
+        return None
+    path = options.get('socket') or os.environ.get('URL_MONITOR_SOCKET') or \
+        default_socket_path(options['config'])
+    return path, request
+
+
+def call(path, request, timeout=TIMEOUT):
+    """
+    Sends a request to the daemon listening on path.
+
+    :raise NoDaemon: when there is no daemon listening on path
+    :raise socket.error: when the daemon doesn't answer in time
+    :return dict: the response
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        try:
+            client.connect(path)
+        except socket.error as err:
+            if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                raise NoDaemon(err.errno, "No daemon listening on {0}: "
+                               "{1}".format(path, err.strerror))
+            raise
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        response = client.makefile('rb').readline()
+    finally:
+        client.close()
+    if not response:
+        raise socket.error("{0} closed the connection".format(path))
+    return json.loads(response.decode('utf-8'))
+
+
+def main(arguments=None):
+    """
+    Entry point of the url_monitor command. A check or discover is answered
+    by the daemon listening on the control socket when there is one,
+    without loading the rest of url_monitor. Everything else, and any
+    command when no daemon is listening, is a full run. A daemon that
+    doesn't answer in time fails the command rather than starting a full
+    run that would take Zabbix's timeout past its limit.
+    """
+    parsed = parse((arguments or sys.argv)[1:])
+    if parsed is not None:
+        path, request = parsed
+        try:
+            response = call(path, request, TIMEOUT)
+        except NoDaemon:
+            response = None
+        except (socket.error, ValueError) as err:
+            response = {'error': "The daemon on {0} did not answer: "
+                                 "{1}".format(path, err)}
+        if response is not None:
+            if 'error' in response:
+                sys.stderr.write("{0}\n".format(response['error']))
+                print("1")
+                return 1
+            sys.stdout.write(response['output'])
+            sys.stdout.flush()
+            return response['rc']
+
+    from url_monitor import main as url_monitor_main
+    return url_monitor_main.main(arguments)
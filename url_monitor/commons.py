@@ -11,12 +11,38 @@ import requests
 from requests.auth import HTTPBasicAuth
 from requests.auth import HTTPDigestAuth
 from requests_oauthlib import OAuth1
+from requests.packages.urllib3.exceptions import ProtocolError
+from requests.packages.urllib3.exceptions import ReadTimeoutError
+try:
+    import brotli
+except ImportError:  # br is not offered
+    brotli = None
+import hashlib
+import itertools
+import json
 import os.path
 from os import environ
 import subprocess
+import threading
+import time
+from urlparse import urlparse
+import zlib
 
+import aggregate
 from exception import PidlockConflict
+from exception import ResponseTooLarge
 from jpath import jpath
+import stats
+import tokencache
+import transport
+
+# Content codings responses are decoded from as they are read, br only
+# when a brotli module is installed
+DECODABLE_ENCODINGS = set(['identity', 'gzip', 'deflate'] +
+                          (['br'] if brotli else []))
+
+# Bytes read off the connection at a time
+READ_CHUNK_SIZE = 16384
 
 
 def run_command(command):
@@ -96,6 +122,127 @@ def skip_on_external_condition(logging, condition, argv):
     return False
 
 
+class SkipConditionCache(object):
+    """
+    Keeps the result of each skip_run_when condition on disk so slow
+    conditions (facter, shell scripts) are not re-evaluated on every run.
+    """
+
+    def __init__(self, statedir):
+        """
+        :param statedir: directory cache files are written to
+        """
+        self.statedir = statedir
+
+    def path(self, condition, argv):
+        """
+        Returns the cache file used for a condition and its arguments.
+        """
+        digest = hashlib.sha1(
+            json.dumps([condition, list(argv)], sort_keys=True)
+        ).hexdigest()
+        return os.path.join(
+            self.statedir, "url_monitor.skip.{0}.json".format(digest))
+
+    def get(self, condition, argv, ttl):
+        """
+        Returns the cached result, or None if missing or older than ttl.
+        """
+        if ttl <= 0:
+            return None
+        try:
+            with open(self.path(condition, argv)) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - cached.get('evaluated', 0) > ttl:
+            return None
+        return cached.get('skip')
+
+    def set(self, condition, argv, skip):
+        """
+        Stores a result. Written to a temp file then renamed so concurrent
+        runs never read a partial file.
+        """
+        cachefile = self.path(condition, argv)
+        tmpfile = "{0}.{1}".format(cachefile, os.getpid())
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump({'skip': skip, 'evaluated': time.time()}, f)
+            os.rename(tmpfile, cachefile)
+        except (IOError, OSError):
+            pass
+
+
+class SkipConditionMonitor(object):
+    """
+    Evaluates skip_run_when conditions concurrently in background threads,
+    so the program can load config and prepare checks in the meantime.
+    """
+
+    def __init__(self, logging, cache=None):
+        """
+        :param logging: logger instance
+        :param cache: optional SkipConditionCache
+        """
+        self.logging = logging
+        self.cache = cache
+        self.threads = []
+        self.results = []
+
+    def start(self, conditions):
+        """
+        Spawns one thread per condition.
+
+        :param conditions: list of (condition, argv, ttl) tuples
+        """
+        for condition, argv, ttl in conditions:
+            thread = threading.Thread(
+                target=self._evaluate, args=(condition, argv, ttl))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def _evaluate(self, condition, argv, ttl):
+        """
+        Thread body, checks the cache before running the condition.
+        """
+        started = time.time()
+        skip = None
+        if self.cache and ttl > 0:
+            skip = self.cache.get(condition, argv, ttl)
+            stats.cache_event('skip_condition', skip is not None)
+        if skip is not None:
+            self.logging.info("Skip condition {0} served from cache"
+                              " (ttl {1}s) skip={2}".format(
+                                  condition, ttl, skip))
+        else:
+            try:
+                skip = skip_on_external_condition(
+                    self.logging, condition, argv)
+            except Exception as err:
+                # not cached, the next run evaluates it again
+                self.logging.error("Skip condition {0} could not be "
+                                   "evaluated, running the checks: "
+                                   "{1}".format(condition, err))
+                skip = False
+            else:
+                if self.cache and ttl > 0:
+                    self.cache.set(condition, argv, skip)
+        self.logging.info("Skip condition {0} evaluated in {1:.3f}s".format(
+            condition, time.time() - started))
+        self.results.append(skip)
+
+    def should_skip(self):
+        """
+        Waits for every condition and returns True if any wants a skip.
+        """
+        for thread in self.threads:
+            thread.join()
+        return any(self.results)
+
+
 class AcquireRunLock(object):
     """
     Establishes a lockfile to avoid duplicate runs for same config.
@@ -150,6 +297,116 @@ class AcquireRunLock(object):
         return self.pidfile.is_locked()
 
 
+def accept_encoding_header(encodings, logging):
+    """
+    Builds an Accept-Encoding value from the configured content codings,
+    leaving out any the response could not be decoded from.
+    :param encodings: list of codings, e.g. ['gzip', 'br']
+    :return: header value
+    """
+    offered = []
+    for coding in encodings:
+        if coding in DECODABLE_ENCODINGS:
+            offered.append(coding)
+        else:
+            logging.debug("Not offering content coding {0}, it can't be "
+                          "decoded here".format(coding))
+    return ', '.join(offered) or 'identity'
+
+
+class GzipDecoder(object):
+    """
+    Decodes gzip, including bodies of more than one gzip member.
+    """
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        decoded = self.decompressor.decompress(data)
+        while self.decompressor.unused_data:
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            decoded += self.decompressor.decompress(data)
+        return decoded
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+class DeflateDecoder(object):
+    """
+    Decodes deflate, which servers send both zlib wrapped and raw.
+    """
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        # what has been read until the first output, to retry as raw
+        self.read = b''
+
+    def decompress(self, data):
+        if self.read is None:
+            return self.decompressor.decompress(data)
+        self.read += data
+        try:
+            decoded = self.decompressor.decompress(data)
+        except zlib.error:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self.decompressor.decompress(self.read)
+        if decoded:
+            self.read = None
+        return decoded
+
+    def flush(self):
+        return self.decompressor.flush()
+
+
+class BrotliDecoder(object):
+    """
+    Decodes br with either the brotli or the brotlipy module.
+    """
+    def __init__(self):
+        decompressor = brotli.Decompressor()
+        self.decompress = getattr(decompressor, 'process', None) or \
+            decompressor.decompress
+
+    def flush(self):
+        return b''
+
+
+CONTENT_DECODERS = {
+    'gzip': GzipDecoder,
+    'deflate': DeflateDecoder,
+    'br': BrotliDecoder,
+}
+
+
+class ContentDecoder(object):
+    """
+    Decodes a response body a chunk at a time from the content codings in
+    its Content-Encoding, last applied first. A body in a coding that
+    can't be decoded here is kept as it is.
+    """
+    def __init__(self, content_encoding):
+        codings = [coding.strip().lower()
+                   for coding in content_encoding.split(',')
+                   if coding.strip()]
+        self.decoders = []
+        if all(coding in DECODABLE_ENCODINGS for coding in codings):
+            self.decoders = [CONTENT_DECODERS[coding]()
+                             for coding in reversed(codings)
+                             if coding != 'identity']
+
+    def decompress(self, data):
+        for decoder in self.decoders:
+            data = decoder.decompress(data)
+        return data
+
+    def flush(self):
+        data = b''
+        for decoder in self.decoders:
+            data = decoder.decompress(data) + decoder.flush()
+        return data
+
+
 def get_hostport_tuple(dport, dhost):
     """
     Tool to take a hostport combination 'localhost:22' string
@@ -184,7 +441,8 @@ def string2bool(allegedstring):
 
 def omnipath(data_object, type, element, throw_error_or_mark_none='none'):
     """
-    Used to pull path expressions out of json or java path.
+    Used to pull path expressions out of json or java path, and aggregate
+    the values of wildcard paths when the element has an aggregate.
     :param data_object:
     :param type:
     :param element:
@@ -195,6 +453,8 @@ def omnipath(data_object, type, element, throw_error_or_mark_none='none'):
     if type == 'json':
         try:
             value = jpath(data_object, element['jsonvalue'])
+            if element.get('aggregate'):
+                value = aggregate.aggregate(value, element['aggregate'])
 
         except:
             if throw_error_or_mark_none == 'none':
@@ -213,16 +473,21 @@ class WebCaller(object):
     Performs web functions for API's we're running check"s on
     """
 
-    def __init__(self, logging):
+    def __init__(self, logging, tokens=None):
         """
         Initialize web instance.
         Bring logging instance in.
         Set session.auth and session_headers to none by default
+        :param tokens: tokencache.TokenCache for token based providers
         """
         self.logging = logging
+        self.tokens = tokens
 
         self.session = None
         self.session_headers = None
+        self.timings = {}
+        self.unreachable = False
+        self.too_large = False
 
     def auth(self, config, identity_provider):
         """
@@ -233,6 +498,7 @@ class WebCaller(object):
         :return:
         """
         identity_providers = config['identity_providers']
+        alias = identity_provider
         try:
             identity_provider = identity_providers[identity_provider]
             auth_kwargs = identity_provider.values()[0]
@@ -247,7 +513,7 @@ class WebCaller(object):
         except TypeError:
             provider_name = "none"
 
-        self.session = requests.Session()
+        self.session = transport.mount(requests.Session())
         self.session_headers = {
             'content-type': 'application/json',
             'accept': 'application/json',
@@ -313,6 +579,18 @@ class WebCaller(object):
             # Set the external auth handler.
             self.session.auth = external_requests_auth_class(**auth_kwargs)
 
+            # Token based handlers get their token from the token cache
+            if self.tokens is not None and \
+                    hasattr(self.session.auth, 'fetch_token'):
+                try:
+                    self.session.auth.token = self.tokens.get(
+                        alias, tokencache.fingerprint(auth_kwargs),
+                        self.session.auth.fetch_token)
+                except Exception:
+                    # left to the handler, the request reports it
+                    self.logging.exception("Could not get a token for "
+                                           "{0}".format(alias))
+
             # Filters possibly exposing kwargs from debug logs
             LOGGING_BLACKLIST = [
                 'password',
@@ -328,15 +606,65 @@ class WebCaller(object):
                     filtered_kwargs[potential_breach] = unfiltered_input
 
             # Debug message
-            self.logging.debug("Spawn session.auth {pyobject}"
-                               " with kwargs {arglst} ".format(
-                                   pyobject=self.session.auth,
-                                   arglst=filtered_kwargs
-                               )
-                               )
+            self.logging.debug("Spawn session.auth %s with kwargs %s ",
+                               self.session.auth, filtered_kwargs)
+
+    def read_body(self, request, max_bytes=None):
+        """
+        Reads the body of a streamed response a chunk at a time, decoding
+        any content coding as each chunk arrives rather than from a fully
+        buffered compressed copy, and keeps it as request.content.
+        :param request: response from a stream=True request
+        :param max_bytes: largest decoded body to read, None for no limit
+        :raise ResponseTooLarge: once the body is larger than max_bytes,
+            the connection is closed rather than drained
+        :return: number of body bytes received on the wire
+        """
+        if max_bytes is not None:
+            length = request.headers.get('content-length', '')
+            if length.isdigit() and int(length) > max_bytes:
+                request.close()
+                raise ResponseTooLarge(
+                    "Content-Length {0} exceeds max_response_bytes "
+                    "{1}".format(length, max_bytes))
+
+        # read the body as it came off the wire, chunked or not, and decode
+        # it here: urllib3's tell() doesn't count chunked bodies
+        decoder = ContentDecoder(request.headers.get('content-encoding', ''))
+        chunks = []
+        wire = received = 0
+        try:
+            # None at the end flushes the decoder
+            for data in itertools.chain(
+                    request.raw.stream(READ_CHUNK_SIZE, decode_content=False),
+                    [None]):
+                if data is None:
+                    chunk = decoder.flush()
+                else:
+                    wire += len(data)
+                    chunk = decoder.decompress(data)
+                received += len(chunk)
+                if max_bytes is not None and received > max_bytes:
+                    request.close()
+                    raise ResponseTooLarge(
+                        "Response body exceeds max_response_bytes "
+                        "{0}".format(max_bytes))
+                chunks.append(chunk)
+        # the errors requests raises for these while reading a body
+        except ProtocolError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+        except ReadTimeoutError as e:
+            raise requests.exceptions.ConnectionError(e)
+        except zlib.error as e:
+            raise requests.exceptions.ContentDecodingError(e)
+
+        # as Response.content keeps a body it read itself
+        request._content = b''.join(chunks)
+        request._content_consumed = True
+        return wire
 
     def run(self, config, url, verify, expected_http_status, identity_provider,
-            timeout):
+            timeout, accept_encoding=None, max_response_bytes=None):
         """
         Executes a http request to gather the data.
         expected_http_status can be a list of expected codes.
@@ -346,28 +674,51 @@ class WebCaller(object):
         :param expected_http_status:
         :param identity_provider:
         :param timeout:
+        :param accept_encoding: list of content codings to offer, None for
+            the requests default
+        :param max_response_bytes: largest response body to read
         :return:
         """
 
         self.auth(config, identity_provider)
-
+        if accept_encoding is not None:
+            self.session_headers['accept-encoding'] = accept_encoding_header(
+                accept_encoding, self.logging)
+        self.unreachable = False
+        self.too_large = False
+
+        # dns/connect/tls are recorded by the transport as it connects
+        self.timings = transport.begin_phases()
+        origin = urlparse(url).netloc
+        stats.gauge_add('http_requests_in_flight', 1)
+        request_started = time.time()
         try:
             request = self.session.get(
                 url,
                 headers=self.session_headers,
                 verify=verify,
-                timeout=timeout
+                timeout=timeout,
+                stream=True
             )
-            self.logging.debug("Spawn request {pyobject} url={url}"
-                               " headers={head}".format(
-                                   pyobject=request,
-                                   head=self.session_headers,
-                                   url=url
-                               )
-                               )
+            download_started = time.time()
+            wire_bytes = self.read_body(request, max_response_bytes)
+            self.timings['download'] = time.time() - download_started
+            self.logging.debug("Spawn request %s url=%s headers=%s",
+                               request, url, self.session_headers)
         except requests.exceptions.ConnectTimeout as e:
             err = "requests.exceptions.ConnectTimeout: {e}".format(e=e)
             self.logging.exception(err)
+            self.unreachable = True
+            return False
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            err = "Host unreachable: {e}".format(e=e)
+            self.logging.exception(err)
+            self.unreachable = True
+            return False
+        except ResponseTooLarge as e:
+            self.logging.error("{url}: {e}".format(url=url, e=e))
+            self.too_large = True
             return False
         except requests.exceptions.RequestException as e:
             err = "requests.exceptions.RequestException: {e}".format(e=e)
@@ -377,6 +728,23 @@ class WebCaller(object):
             err = "Unhandled requests exception occured during web_request()"
             self.logging.exception(err)
             return False
+        finally:
+            stats.gauge_add('http_requests_in_flight', -1)
+            stats.observe('http_request_seconds',
+                          time.time() - request_started, origin=origin)
+
+        # Server think-time is whatever the time to headers doesn't
+        # explain by connection setup.
+        self.timings['server'] = max(
+            0.0,
+            request.elapsed.total_seconds() - self.timings['dns'] -
+            self.timings['connect'] - self.timings['tls']
+        )
+        self.timings['status_code'] = request.status_code
+        self.timings['response_bytes'] = len(request.content)
+        self.timings['response_wire_bytes'] = wire_bytes
+        stats.incr('http_bytes_in', self.timings['response_bytes'])
+        stats.incr('http_wire_bytes_in', wire_bytes)
 
         # Turns comma seperated string from config to a list, then lower it
         expected_codes = [c.lower() for c in expected_http_status.split(',')]
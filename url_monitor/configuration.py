@@ -2,17 +2,46 @@
 # -*- coding: utf-8 -*-
 import logging
 import logging.handlers
+import multiprocessing
+import os
 import socket
 
 import yaml
 import sys
 import logging.handlers
+import aggregate
 import commons
 
 import exception
+import includes
+import logqueue
+import routing
+import sharding
 from url_monitor import package as packagemacro
 
 
+def config_paths(paths):
+    """
+    Expands the config files and directories given with -c into the list
+    of config files to load. A directory stands for the *.yaml and *.yml
+    files in it, in name order.
+
+    :param paths: list of paths, None for the system default
+    :return list: None in place of the system default
+    """
+    if not paths:
+        return [None]
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(('.yaml', '.yml'))))
+        else:
+            files.append(path)
+    return files
+
+
 class baseConfig():
     """
     Base class for ConfigObject
@@ -21,6 +50,8 @@ class baseConfig():
     def __init__(self):
         self.config = None
         self.checks = None
+        self.includes = None
+        self.path = None
         self.constant_syslog_port = 514
 
     def load_yaml_file(self, config=None):
@@ -31,14 +62,49 @@ class baseConfig():
         """
         if config == None:
             config = "/etc/url_monitor.yaml"
+        self.path = config
 
         with open(config, 'r') as stream:
             try:
                 self.config = (yaml.load(stream))
-                return self.config
             except yaml.YAMLError as exc:
                 print("Exception: YAML Parse Error!\n{exc}".format(exc=exc))
                 sys.exit(1)
+        self.load_includes()
+        return self.config
+
+    def load_includes(self):
+        """
+        Loads the testSet fragments of the include directories. Unchanged
+        fragments are taken from the cache in the state_dir.
+        """
+        directories = self.get_include_dirs()
+        if not directories:
+            self.includes = None
+            return
+        self.includes = includes.Includes(logging.getLogger(packagemacro),
+                                          directories, self.get_state_dir())
+        try:
+            self.includes.refresh(self._own_test_set_keys())
+        except ValueError as err:
+            logging.error("Error: {0}".format(err))
+            sys.exit(1)
+
+    def reload_includes(self):
+        """
+        Picks up changes to the include directories, only the changed
+        fragments are compiled again. An invalid fragment is logged and its
+        previous testSets are kept.
+
+        :return list: paths of the fragments added, changed or removed
+        """
+        if self.includes is None:
+            return []
+        return self.includes.refresh(self._own_test_set_keys(),
+                                     strict=False)
+
+    def _own_test_set_keys(self):
+        return list((self.config.get('testSet') or {}).keys())
 
     def load(self):
         """ This is the main config load function to pull in
@@ -153,8 +219,10 @@ class configProperties():
         """
 
         checks = []
-        for k, v in self.config['testSet'].iteritems():
+        for k, v in (self.config.get('testSet') or {}).iteritems():
             checks.append({'key': k, 'data': v})
+        if self.includes is not None:
+            checks.extend(self.includes.checks)
 
         return checks
 
@@ -170,7 +238,8 @@ class configProperties():
         config = config['config']
 
         skip_conditions = []  # dict of skip conditions
-        config = config.get('skip_run_when')
+        # skip_run_when is optional
+        config = config.get('skip_run_when') or {}
 
         # Skip if puppet fact exists
         facter = config.get('puppet_facter', False)
@@ -365,6 +434,199 @@ class ConfigObject(baseConfig, configProperties):
 
         return require_ssl
 
+    def get_accept_encoding(self, testSet):
+        """
+        Getter for the content codings offered in Accept-Encoding.
+
+        Grab the testSet accept_encoding else defer to the global setting,
+        either a comma separated string or a list.
+
+        :param testSet:   name of the current testset
+        :return list: codings, or None for the requests default
+        """
+        config = self.load()
+        encodings = testSet['data'].get('accept_encoding',
+                                        config['config'].get('accept_encoding'))
+        if encodings is None:
+            return None
+        if isinstance(encodings, basestring):
+            encodings = encodings.split(',')
+        return [str(e).strip().lower() for e in encodings if str(e).strip()]
+
+    def get_max_response_bytes(self, testSet):
+        """
+        Getter for the largest response body a check may read.
+
+        Grab the testSet max_response_bytes else defer to the global
+        setting.
+
+        :param testSet:   name of the current testset
+        :return integer: bytes, or None for no limit
+        """
+        config = self.load()
+        limit = testSet['data'].get('max_response_bytes',
+                                    config['config'].get('max_response_bytes'))
+        if limit is None:
+            return None
+        return int(limit)
+
+    def get_state_dir(self):
+        """
+        Directory for files url_monitor keeps between runs (caches and
+        other state). Defaults to the same location as relative pidfiles.
+
+        :return str:
+        """
+        return self.config['config'].get('state_dir',
+                                         "/var/lib/zabbixsrv/")
+
+    def get_include_dirs(self):
+        """
+        Getter for the directories of testSet fragments to include, either
+        one path or a list. Relative paths are relative to the directory of
+        the config file.
+
+        :return list:
+        """
+        directories = (self.config.get('config') or {}).get('include') or []
+        if isinstance(directories, basestring):
+            directories = [directories]
+        base = os.path.dirname(os.path.abspath(self.path or "."))
+        return [os.path.normpath(os.path.join(base, directory))
+                for directory in directories]
+
+    def get_daemon_interval(self):
+        """
+        Getter for the seconds between check runs of the daemon command.
+
+        :return float:
+        """
+        daemon = self.config['config'].get('daemon') or {}
+        return float(daemon.get('interval', 60))
+
+    def get_control_socket(self):
+        """
+        Getter for the UNIX socket the daemon answers thin clients on. True
+        stands for the default path derived from the -c arguments.
+
+        :return: path, True, or None without a control socket
+        """
+        daemon = self.config['config'].get('daemon') or {}
+        return daemon.get('control_socket') or None
+
+    def get_worker_count(self, override=None):
+        """
+        Getter for the number of worker processes running checks.
+
+        The --workers argument wins over config: workers. auto (or 0) means
+        one per CPU core, 1 runs checks in the main process.
+
+        :param override: value of --workers if given
+        :return integer:
+        """
+        workers = override
+        if workers is None:
+            workers = self.config['config'].get('workers', 1)
+        if str(workers).lower() in ('auto', '0'):
+            return multiprocessing.cpu_count()
+        return max(1, int(workers))
+
+    def get_concurrency(self):
+        """
+        Getter for how many checks a process runs at the same time.
+
+        :return integer:
+        """
+        return max(1, int(self.config['config'].get('concurrency', 1)))
+
+    def get_origin_limits(self):
+        """
+        Getter for the per origin host request limits. Keys are origin
+        hosts or 'default', values may set max_concurrent,
+        requests_per_second and burst.
+
+        :return dict:
+        """
+        return self.config['config'].get('origin_limits') or {}
+
+    def get_circuit_breaker(self):
+        """
+        Getter for the circuit_breaker settings (failures, backoff and
+        max_backoff). None when circuit breakers are disabled.
+
+        :return dict:
+        """
+        settings = self.config['config'].get('circuit_breaker')
+        if settings is True:
+            return {}
+        if not settings:
+            return None
+        return settings
+
+    def get_token_cache(self):
+        """
+        Getter for the token_cache settings (refresh_ahead and
+        default_ttl). None when identity provider tokens are not cached.
+
+        :return dict:
+        """
+        settings = self.config['config'].get('token_cache')
+        if settings is True:
+            return {}
+        if not settings:
+            return None
+        return settings
+
+    def get_run_deadline(self):
+        """
+        Getter for the seconds a check run may take before checks that
+        haven't started are skipped. None when there is no deadline.
+
+        :return float:
+        """
+        deadline = self.config['config'].get('run_deadline')
+        if not deadline:
+            return None
+        return float(deadline)
+
+    def get_dns_cache(self):
+        """
+        Getter for the dns_cache settings (min_ttl, max_ttl, default_ttl
+        and prefetch). None when DNS lookups are not cached.
+
+        :return dict:
+        """
+        settings = self.config['config'].get('dns_cache')
+        if settings is True:
+            return {}
+        if not settings:
+            return None
+        return settings
+
+    def get_skip_cache_ttl(self, condition):
+        """
+        Getter for how long a skip_run_when result may be cached on disk.
+
+        Grab the ttl from the condition section else defer to the
+        skip_run_when setting. 0 disables caching. The environment condition
+        is never cached, it costs nothing to check and belongs to the
+        environment of the run.
+
+        :param condition: condition name as returned by skip_conditions
+        :return integer: seconds
+        """
+        sections = {'facter': 'puppet_facter',
+                    'shell': 'shell'}
+        if condition not in sections:
+            return 0
+        skip_config = self.config['config'].get('skip_run_when') or {}
+        section = skip_config.get(sections.get(condition)) or {}
+        try:
+            return int(section.get('cache_ttl',
+                                   skip_config.get('cache_ttl', 0)))
+        except (TypeError, ValueError):
+            return 0
+
     def datatypes_valid(self, check):
         """
         Lints datatypes out of the config file.
@@ -537,6 +799,10 @@ class ConfigObject(baseConfig, configProperties):
             logformat: "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 
         You can also enable both by setting outputs with commas.
+
+        The outputs are written by a background thread, see logqueue.py.
+        `queue_size` (default 10000) bounds the records waiting for them,
+        0 writes them from the logging thread as they come.
         """
         try:  # Basic config lint
             self.config['config']['logging']['outputs']
@@ -557,6 +823,7 @@ class ConfigObject(baseConfig, configProperties):
             self.config['config']['logging']['logformat'])
 
         log_outputs = self.config['config']['logging']['outputs'].split(',')
+        handlers = []
 
         if "file" in log_outputs:
             # Add handler for file outputs
@@ -571,7 +838,7 @@ class ConfigObject(baseConfig, configProperties):
                 )
                 exit(1)
             filehandler.setLevel(loglevel)
-            self.logger.addHandler(filehandler)
+            handlers.append(filehandler)
             filehandler.setFormatter(formatter)
 
         if "syslog" in log_outputs:
@@ -613,7 +880,7 @@ class ConfigObject(baseConfig, configProperties):
 
             try:
                 sysloghandler.setLevel(loglevel)
-                self.logger.addHandler(sysloghandler)
+                handlers.append(sysloghandler)
                 sysloghandler.setFormatter(formatter)
             except socket.error, err:
                 error = "Syslog error using socket.write() on host "
@@ -624,6 +891,16 @@ class ConfigObject(baseConfig, configProperties):
                 )
                 logging.exception(error)
 
+        queue_size = self.config['config']['logging'].get(
+            'queue_size', logqueue.DEFAULT_QUEUE_SIZE)
+        if not queue_size:
+            for handler in handlers:
+                self.logger.addHandler(handler)
+        elif handlers:
+            queuehandler = logqueue.QueueHandler(handlers, queue_size)
+            queuehandler.setLevel(loglevel)
+            self.logger.addHandler(queuehandler)
+
         logging.basicConfig(level=loglevel)
         self.logger.info("Logger initialized.")
         return self.logger
@@ -679,6 +956,25 @@ class ConfigObject(baseConfig, configProperties):
             logging.exception(error)
             exit(1)
 
+        # Ensure the server list and strategy are usable
+        try:
+            routing.settings(self.config['config']['zabbix'])
+        except ValueError, err:
+            logging.error("Error: config: zabbix: {0}".format(err))
+            exit(1)
+
+        # Sharded nodes must not overwrite each other's summaries
+        zabbix = self.config['config']['zabbix']
+        if sharding.node_name(self.config['config'].get('sharding')):
+            for key_format in ('checksummary_key_format',
+                               'selfstats_key_format'):
+                if zabbix.get(key_format) and \
+                        '{node}' not in zabbix[key_format]:
+                    logging.error("Error: config: zabbix: {0} needs a "
+                                  "{{node}} with sharding.".format(
+                                      key_format))
+                    exit(1)
+
         # Ensure identity items exist
         try:
             self.config['config']['identity_providers']
@@ -707,6 +1003,25 @@ class ConfigObject(baseConfig, configProperties):
                 for kwarg in kwargs:
                     kwarg
 
+        # Ensure the aggregates of testElements exist
+        for testSet in self._load_checks():
+            for element in (testSet.get('data') or {}).get(
+                    'testElements') or []:
+                function = element.get('aggregate')
+                if function and not aggregate.is_valid(str(function)):
+                    logging.error(
+                        "Error: Unknown aggregate `{0}` under testSet item "
+                        "{1}, expected one of {2} or a percentile such as "
+                        "p95. Can't continue.".format(
+                            function, testSet['key'],
+                            ', '.join(aggregate.FUNCTIONS)))
+                    exit(1)
+
+        # No released hyper can time out its requests, HTTP/1.1 it is
+        if self.config['config'].get('http2'):
+            logging.warning("Warning: config: http2 is not supported, "
+                            "requests use HTTP/1.1")
+
         self.logger.info("Pre-flight config test OK")
 
 
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import json
+import os
+import stat
+import threading
+import time
+
+try:
+    from SocketServer import StreamRequestHandler, ThreadingMixIn, \
+        UnixStreamServer
+except ImportError:
+    from socketserver import StreamRequestHandler, ThreadingMixIn, \
+        UnixStreamServer
+
+__doc__ = """Control socket of the daemon, answering thin clients"""
+
+# how long a client may wait for the first run of a daemon
+RUN_TIMEOUT = 20.0
+
+
+class Runs(object):
+    """
+    Coordinates the check runs of a daemon with the clients asking for
+    them: a client triggers a run and gets the return code of the last
+    completed one, or waits for the first.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.requested = False
+        self.running = False
+        self.completed = 0
+        self.rc = None
+
+    def trigger(self):
+        """
+        Asks for a run to start now, unless one is running.
+        """
+        with self.condition:
+            if not self.running:
+                self.requested = True
+                self.condition.notify_all()
+
+    def wait_for_trigger(self, timeout):
+        """
+        Waits up to timeout seconds (None for ever) for trigger().
+
+        :return: True if a run was triggered
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while not self.requested:
+                remaining = 1.0 if deadline is None else \
+                    deadline - time.time()
+                if remaining <= 0:
+                    return False
+                # short waits, so signals still reach the main thread
+                self.condition.wait(min(remaining, 1.0))
+            return True
+
+    def started(self):
+        with self.condition:
+            self.running = True
+            self.requested = False
+
+    def finished(self, rc):
+        with self.condition:
+            self.running = False
+            self.completed += 1
+            self.rc = rc
+            self.condition.notify_all()
+
+    def result(self, timeout=RUN_TIMEOUT):
+        """
+        Triggers a run and returns the return code of the last completed
+        one, waiting for the first run when none completed yet.
+
+        :return: None when no run completed within timeout
+        """
+        self.trigger()
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.rc is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.rc
+
+
+class _ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class _ControlHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            response = self.server.answer(request)
+        except Exception as err:
+            self.server.logger.exception("Control request failed")
+            response = {'error': "url_monitor daemon: {0}".format(err)}
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ControlListener(object):
+    """
+    Answers the requests of thin clients (see client.py) on a UNIX socket
+    from a background thread. Requests and responses are one line of JSON,
+    a response has the return code and output the command would have had
+    as a full run.
+    """
+
+    def __init__(self, path, answer, logger):
+        """
+        :param path: of the socket, readable by its owner only
+        :param answer: callable(request) returning the response dict
+        """
+        self.path = path
+        # a socket left behind by a daemon that is gone, the pidfile lock
+        # keeps two daemons of the same config from getting here
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except OSError:
+            pass
+        self.server = _ThreadingUnixServer(path, _ControlHandler,
+                                           bind_and_activate=False)
+        self.server.answer = answer
+        self.server.logger = logger
+        self.server.server_bind()
+        os.chmod(path, 0o600)
+        self.server.server_activate()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
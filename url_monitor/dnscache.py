@@ -0,0 +1,176 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import socket
+import threading
+import time
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:  # TTLs need dnspython, else default_ttl is used
+    dns = None
+
+import stats
+
+__doc__ = """In-process DNS resolution cache shared by every check"""
+
+# How long before expiry a recently used entry is refreshed by the
+# prefetcher, as a fraction of its ttl
+PREFETCH_LEAD = 0.1
+
+
+def _is_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+class DNSCache(object):
+    """
+    Caches getaddrinfo() style results per (host, port).
+
+    With dnspython installed the A and AAAA records are looked up directly
+    and cached for their TTL, clamped to [min_ttl, max_ttl]. Names it
+    can't resolve (such as /etc/hosts entries), and every name without
+    dnspython, go through the system resolver and are cached for
+    default_ttl. Concurrent misses for the same name share one lookup.
+
+    With prefetch, a background thread refreshes entries used within the
+    last `idle` seconds shortly before they expire, so a long lived process
+    doesn't wait on the resolver at all.
+    """
+
+    def __init__(self, logging, min_ttl=10, max_ttl=300, default_ttl=60,
+                 prefetch=False, idle=600):
+        self.logging = logging
+        self.min_ttl = float(min_ttl)
+        self.max_ttl = float(max_ttl)
+        self.default_ttl = float(default_ttl)
+        self.prefetch = prefetch
+        self.idle = float(idle)
+
+        # (host, port) -> [expires, ttl, last_used, addresses]
+        self.entries = {}
+        self.lookups = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _query(self, host, port):
+        """
+        Returns (addresses, ttl) for host.
+        """
+        if dns is not None:
+            addresses = []
+            ttl = None
+            for rdtype, family in (('A', socket.AF_INET),
+                                   ('AAAA', socket.AF_INET6)):
+                try:
+                    answer = _dns_query(host, rdtype)
+                except dns.exception.DNSException:
+                    continue
+                ttl = min(ttl or answer.rrset.ttl, answer.rrset.ttl)
+                for record in answer:
+                    address = (record.address, port) \
+                        if family == socket.AF_INET \
+                        else (record.address, port, 0, 0)
+                    addresses.append((family, socket.SOCK_STREAM,
+                                      socket.IPPROTO_TCP, '', address))
+            if addresses:
+                return addresses, ttl
+        return (socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM),
+                self.default_ttl)
+
+    def _lookup(self, key):
+        started = time.time()
+        addresses, ttl = self._query(*key)
+        elapsed = time.time() - started
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        stats.observe('dns_lookup_seconds', elapsed)
+        self.logging.debug("DNS lookup of %s took %.3fs, caching %d "
+                           "addresses for %.0fs", key[0], elapsed,
+                           len(addresses), ttl)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            last_used = entry[2] if entry else now
+            self.entries[key] = [now + ttl, ttl, last_used, addresses]
+        return addresses
+
+    def resolve(self, host, port):
+        """
+        Resolves host like socket.getaddrinfo(host, port, 0, SOCK_STREAM).
+        """
+        if _is_address(host):
+            return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+        key = (host, port)
+        now = time.time()
+        with self.lock:
+            if self.prefetch and self.thread is None:
+                self._start_prefetcher()
+            entry = self.entries.get(key)
+            if entry and entry[0] > now:
+                entry[2] = now
+                stats.cache_event('dns', True)
+                return entry[3]
+            stats.cache_event('dns', False)
+            # only one thread looks a name up, the others wait for it
+            done = self.lookups.get(key)
+            owner = done is None
+            if owner:
+                done = self.lookups[key] = threading.Event()
+
+        if not owner:
+            done.wait()
+            with self.lock:
+                entry = self.entries.get(key)
+            if entry:
+                return entry[3]
+            # the other lookup failed, surface our own error
+            return self._lookup(key)
+        try:
+            return self._lookup(key)
+        finally:
+            with self.lock:
+                self.lookups.pop(key, None)
+            done.set()
+
+    def _start_prefetcher(self):
+        # called with the lock held, once per process (threads don't
+        # survive the fork of worker processes)
+        self.thread = threading.Thread(target=self._prefetcher,
+                                       name="url_monitor-dns-prefetch")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _prefetcher(self):
+        while True:
+            now = time.time()
+            with self.lock:
+                due = [key for key, (expires, ttl, last_used, _) in
+                       self.entries.items()
+                       if expires - ttl * PREFETCH_LEAD <= now and
+                       now - last_used < self.idle]
+                for key in [key for key, entry in self.entries.items()
+                            if now - entry[2] >= self.idle]:
+                    del self.entries[key]
+            for key in due:
+                try:
+                    self._lookup(key)
+                except (socket.error, socket.gaierror) as err:
+                    self.logging.warning("DNS prefetch of {0} failed: "
+                                         "{1}".format(key[0], err))
+                    # keep the old addresses a little longer
+                    with self.lock:
+                        if key in self.entries:
+                            self.entries[key][0] = now + self.min_ttl
+            time.sleep(1)
+
+
+def _dns_query(host, rdtype):
+    resolve = getattr(dns.resolver, 'resolve', None) or dns.resolver.query
+    return resolve(host, rdtype)
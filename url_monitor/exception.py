@@ -20,3 +20,10 @@ class RequiredConfigMissing(UrlMonitorBaseException):
     Raise if an expected config setting is undefined
     """
     pass
+
+
+class ResponseTooLarge(UrlMonitorBaseException):
+    """
+    Raised if a response body exceeds max_response_bytes
+    """
+    pass
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import commons
+import stats
+
+__doc__ = """OpenMetrics exposition of url_monitor's internal counters"""
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+PREFIX = 'url_monitor_'
+DEFAULT_PORT = 9713
+
+# Per run counters that are also exposed as monotonic totals
+COUNTERS = {
+    'checks_run': 'testSets attempted',
+    'checks_failed': 'testSets that failed',
+    'checks_skipped': 'testSets that were not attempted',
+    'checks_cancelled': 'testSets skipped or cut short by run_deadline',
+    'http_bytes_in': 'Response body bytes read',
+    'http_wire_bytes_in': 'Response body bytes received before decoding',
+    'log_records_dropped': 'Log records dropped while the log outputs '
+                           'were behind',
+    'metrics_sent': 'Metrics accepted by Zabbix',
+    'sender_roundtrips': 'Zabbix sender connections',
+    'sender_failovers': 'Zabbix sender batches resent to another server',
+    'tls_handshakes': 'TLS handshakes',
+}
+
+GAUGES = {
+    'http_requests_in_flight': 'HTTP requests currently in flight',
+    'sender_queue_depth': 'Metrics currently being sent to Zabbix',
+}
+
+HISTOGRAMS = {
+    'dns_lookup_seconds': 'DNS lookups that missed the dns_cache',
+    'http_request_seconds': 'HTTP request latency by origin',
+    'run_seconds': 'Duration of check runs',
+}
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """
+    Renders every counter in the OpenMetrics text format.
+    """
+    totals, gauges, histograms, caches = stats.totals()
+    lines = []
+
+    for name, help_text in sorted(COUNTERS.items()):
+        lines.append('# TYPE {0}{1} counter'.format(PREFIX, name))
+        lines.append('# HELP {0}{1} {2}.'.format(PREFIX, name, help_text))
+        lines.append('{0}{1}_total {2}'.format(
+            PREFIX, name, _number(totals.get(name, 0))))
+
+    for name, help_text in sorted(GAUGES.items()):
+        lines.append('# TYPE {0}{1} gauge'.format(PREFIX, name))
+        lines.append('# HELP {0}{1} {2}.'.format(PREFIX, name, help_text))
+        lines.append('{0}{1} {2}'.format(
+            PREFIX, name, _number(gauges.get(name, 0))))
+
+    for name, help_text in sorted(HISTOGRAMS.items()):
+        lines.append('# TYPE {0}{1} histogram'.format(PREFIX, name))
+        lines.append('# HELP {0}{1} {2}.'.format(PREFIX, name, help_text))
+        for (hname, labels), histogram in sorted(histograms.items()):
+            if hname != name:
+                continue
+            cumulative = 0
+            bounds = list(histogram['buckets']) + [float('inf')]
+            for bound, count in zip(bounds, histogram['counts']):
+                cumulative += count
+                lines.append('{0}{1}_bucket{2} {3}'.format(
+                    PREFIX, name, _labels(labels + (('le', _number(bound)),)),
+                    cumulative))
+            lines.append('{0}{1}_count{2} {3}'.format(
+                PREFIX, name, _labels(labels), histogram['count']))
+            lines.append('{0}{1}_sum{2} {3}'.format(
+                PREFIX, name, _labels(labels), _number(histogram['sum'])))
+
+    # each family's samples have to be contiguous
+    for family, kind, value in (
+            ('cache_hits', 'counter', lambda hits, misses: hits),
+            ('cache_misses', 'counter', lambda hits, misses: misses),
+            ('cache_hit_ratio', 'gauge',
+             lambda hits, misses: float(hits) / (hits + misses))):
+        lines.append('# TYPE {0}{1} {2}'.format(PREFIX, family, kind))
+        suffix = '_total' if kind == 'counter' else ''
+        for cache, (hits, misses) in sorted(caches.items()):
+            lines.append('{0}{1}{2}{3} {4}'.format(
+                PREFIX, family, suffix, _labels((('cache', cache),)),
+                _number(value(hits, misses))))
+
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsListener(object):
+    """
+    Serves render() over HTTP from a background thread.
+    """
+
+    def __init__(self, address):
+        """
+        :param address: (host, port) tuple to listen on
+        """
+        self.server = _ThreadingHTTPServer(address, _MetricsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_listener(configinstance, logger):
+    """
+    Starts the listener configured under config: metrics_listener.
+    Returns None when it is not configured.
+    """
+    listen = configinstance.config['config'].get('metrics_listener')
+    if not listen:
+        return None
+    address = commons.get_hostport_tuple(DEFAULT_PORT, str(listen))
+    listener = MetricsListener(address).start()
+    logger.info("Serving OpenMetrics on http://{0}:{1}/metrics".format(
+        *address))
+    return listener
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+
+import yaml
+
+import aggregate
+
+__doc__ = """testSet fragments included from conf.d style directories"""
+
+CACHE_FILE = 'url_monitor.includes.json'
+EXTENSIONS = ('.yaml', '.yml')
+
+REQUIRED_KEYS = ('uri', 'response_type', 'identity_provider', 'ok_http_code',
+                 'testElements')
+REQUIRED_ELEMENT_KEYS = ('key', 'jsonvalue', 'datatype')
+
+
+def _validate(path, key, data):
+    missing = "{path}: Missing {error} under testSet item {item}"
+    if not isinstance(data, dict):
+        raise ValueError("{0}: testSet item {1} is not a mapping".format(
+            path, key))
+    for required in REQUIRED_KEYS:
+        if required not in data:
+            raise ValueError(missing.format(path=path, error=required,
+                                            item=key))
+    if not isinstance(data['testElements'], list):
+        raise ValueError("{0}: testElements of testSet item {1} is not a "
+                         "list".format(path, key))
+    for element in data['testElements']:
+        if not isinstance(element, dict):
+            raise ValueError("{0}: testElement of testSet item {1} is not a "
+                             "mapping".format(path, key))
+        for required in REQUIRED_ELEMENT_KEYS:
+            if required not in element:
+                raise ValueError(missing.format(
+                    path=path, error=required,
+                    item="{0} testElements".format(key)))
+        function = element.get('aggregate')
+        if function and not aggregate.is_valid(str(function)):
+            raise ValueError("{0}: Unknown aggregate {1} under testSet item "
+                             "{2} testElements".format(path, function, key))
+
+
+def compile_fragment(text, path):
+    """
+    Parses and validates the testSets of a fragment file. A fragment has
+    the testSet section of a config and nothing else.
+
+    :param text: contents of the file
+    :param path: of the file, for error messages
+    :raise ValueError: when the fragment can't be parsed or is invalid
+    :return list: checks in the format of ConfigObject.test_sets
+    """
+    try:
+        fragment = yaml.safe_load(text)
+    except yaml.YAMLError as err:
+        raise ValueError("{0}: YAML parse error: {1}".format(path, err))
+    if fragment is None:
+        return []
+    if not isinstance(fragment, dict) or set(fragment) - set(['testSet']):
+        raise ValueError("{0}: an included file may only have a testSet "
+                         "section".format(path))
+    test_sets = fragment.get('testSet') or {}
+    if not isinstance(test_sets, dict):
+        raise ValueError("{0}: testSet is not a mapping".format(path))
+
+    checks = []
+    for key in sorted(test_sets):
+        _validate(path, key, test_sets[key])
+        checks.append({'key': key, 'data': test_sets[key]})
+    return checks
+
+
+class Includes(object):
+    """
+    testSets of the fragment files (*.yaml and *.yml) in include
+    directories, in file name order.
+
+    Every file is parsed and validated on its own and kept with the stat
+    signature and digest of the text it was compiled from. A refresh only
+    reads the files whose signature changed and only compiles those whose
+    text did, the testSets of the other files are kept as they are. With a
+    cache directory the compiled fragments are also saved there, so later
+    runs don't parse unchanged files again.
+    """
+
+    def __init__(self, logging, directories, cache_dir=None):
+        self.logging = logging
+        self.directories = list(directories)
+        self.path = None
+        if cache_dir:
+            self.path = os.path.join(cache_dir, CACHE_FILE)
+
+        # path -> {'signature', 'digest', 'checks'}
+        self.fragments = {}
+        self.checks = []
+
+    def files(self):
+        """
+        :raise ValueError: when an include directory can't be listed
+        :return list: paths of the fragment files
+        """
+        files = []
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError as err:
+                raise ValueError("Could not list include directory {0}: "
+                                 "{1}".format(directory, err))
+            files.extend(sorted(os.path.join(directory, name)
+                                for name in names
+                                if name.endswith(EXTENSIONS)))
+        return files
+
+    def _load(self, path, entry):
+        """
+        Returns the fragment of path, entry itself when the file still has
+        its signature and a copy of it when the file still has its text.
+        """
+        stat = os.stat(path)
+        signature = [stat.st_ino, stat.st_size, stat.st_mtime]
+        if entry and entry['signature'] == signature:
+            return entry
+        with open(path, 'rb') as f:
+            text = f.read()
+        digest = hashlib.sha256(text).hexdigest()
+        if entry and entry['digest'] == digest:
+            return dict(entry, signature=signature)
+        return {'signature': signature, 'digest': digest,
+                'checks': compile_fragment(text, path)}
+
+    def refresh(self, reserved=(), strict=True):
+        """
+        Picks up added, changed and removed fragment files.
+
+        :param reserved: testSet keys of the config itself, which fragments
+            may not define again
+        :param strict: raise for an invalid fragment. Otherwise it is logged
+            and the testSets it had before are kept.
+        :raise ValueError: with strict, for an invalid fragment
+        :return list: paths of the fragments added, changed or removed
+        """
+        cached = {}
+        if self.path and not self.fragments:
+            cached = self._read()
+        try:
+            files = self.files()
+        except ValueError as err:
+            if strict:
+                raise
+            self.logging.error("{0}, keeping the included testSets".format(
+                err))
+            return []
+
+        keys = set(reserved)
+        fragments = {}
+        changed = []
+        dirty = False
+        for path in files:
+            previous = self.fragments.get(path)
+            source = previous or cached.get(path)
+            try:
+                fragment = self._load(path, source)
+                duplicates = keys.intersection(check['key']
+                                               for check in fragment['checks'])
+                if duplicates:
+                    raise ValueError("{0}: testSet item {1} is already "
+                                     "defined".format(path, ', '.join(
+                                         sorted(str(key)
+                                                for key in duplicates))))
+            except (IOError, OSError, ValueError) as err:
+                if strict:
+                    raise ValueError(str(err))
+                if previous is not None and previous['digest'] is None:
+                    # already reported, until the file changes again
+                    fragment = previous
+                else:
+                    self.logging.error("{0}, keeping its previous "
+                                       "testSets".format(err))
+                    try:
+                        stat = os.stat(path)
+                        signature = [stat.st_ino, stat.st_size,
+                                     stat.st_mtime]
+                    except OSError:
+                        signature = None
+                    fragment = {'signature': signature, 'digest': None,
+                                'checks': previous['checks']
+                                if previous else []}
+            keys.update(check['key'] for check in fragment['checks'])
+            fragments[path] = fragment
+            dirty = dirty or fragment is not source
+            if previous is None or \
+                    fragment['checks'] is not previous['checks']:
+                changed.append(path)
+        changed.extend(path for path in sorted(self.fragments)
+                       if path not in fragments)
+
+        if not strict:
+            for path in changed:
+                self.logging.info("Reloaded {0}: {1} testSets".format(
+                    path, len(fragments[path]['checks'])
+                    if path in fragments else 0))
+
+        self.fragments = fragments
+        self.checks = [check for path in files
+                       for check in fragments[path]['checks']]
+        if self.path and (dirty or changed):
+            self._write()
+        return changed
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def _write(self):
+        # entries of other configs sharing the state_dir are kept
+        entries = dict((path, entry) for path, entry in self._read().items()
+                       if os.path.dirname(path) not in self.directories)
+        entries.update((path, fragment)
+                       for path, fragment in self.fragments.items()
+                       if fragment['digest'] is not None)
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError, TypeError, ValueError) as err:
+            self.logging.warning("Could not save the include cache {0}: "
+                                 "{1}".format(self.path, err))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
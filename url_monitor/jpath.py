@@ -5,10 +5,17 @@ import json
 PATH_SEPARATOR = '/'
 CURRENT_NODE = '.'
 LIST_INDEX_INDICATORS = ('[', ']')
+WILDCARD = '*'
 
 
 def jpath(json_str, path, throw_error_or_mark_none='none'):
     """
+    Pulls the value at path out of a JSON document.
+
+    A `*` step, or `[*]` in place of a list index, selects every element
+    of a list (or every value of an object) and the rest of the path is
+    followed from each of them. A path with wildcards returns the list of
+    values found, elements the rest of the path doesn't match are left out.
 
     :param json_str:
     :param path:
@@ -21,22 +28,71 @@ def jpath(json_str, path, throw_error_or_mark_none='none'):
     if path_list and path_list[0] == CURRENT_NODE:
         path_list = path_list[1:]
 
-    for key in path_list:
+    value = _walk(value, path_list, throw_error_or_mark_none)
+    if isinstance(value, _Matches):
+        return list(value)
+    return value
+
+
+class _Matches(list):
+    """
+    Values selected by a wildcard step.
+    """
+    pass
+
+
+def _expand(value, path_list):
+    """
+    Follows path_list from every element of a list or value of an object.
+    """
+    if isinstance(value, dict):
+        items = value.values()
+    elif isinstance(value, list):
+        items = value
+    else:
+        return _Matches()
+
+    matches = _Matches()
+    for item in items:
+        try:
+            found = _walk(item, path_list, 'raise')
+        except (KeyError, IndexError, TypeError, ValueError,
+                AttributeError):
+            continue
+        if isinstance(found, _Matches):  # flatten nested wildcards
+            matches.extend(found)
+        elif found is not None:
+            matches.append(found)
+    return matches
+
+
+def _walk(value, path_list, throw_error_or_mark_none):
+    for position, key in enumerate(path_list):
+        if key == WILDCARD:
+            return _expand(value, path_list[position + 1:])
+
         index = None
         if key[-1] == LIST_INDEX_INDICATORS[1]:
             left_indicator = key.rfind(LIST_INDEX_INDICATORS[0])
             if left_indicator > -1:
-                index = int(key[left_indicator + 1:-1])
+                index = key[left_indicator + 1:-1]
+                if index != WILDCARD:
+                    index = int(index)
                 key = key[:left_indicator]
 
         if key not in value:
             if throw_error_or_mark_none == 'none':
                 value = None
             else:
-                raise KeyError
+                raise KeyError(key)
         else:
             value = value.get(key)
 
+        if index == WILDCARD:
+            if value is None:
+                break
+            return _expand(value, path_list[position + 1:])
+
         if index is not None:
             try:
                 value = value[index]
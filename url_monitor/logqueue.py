@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import copy
+import logging
+import os
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import stats
+
+__doc__ = """Log outputs written by a background thread"""
+
+# records waiting for the log outputs, further records are dropped
+DEFAULT_QUEUE_SIZE = 10000
+# seconds a stopping listener waits for the outputs to catch up
+STOP_TIMEOUT = 5.0
+
+_STOP = None
+
+
+class QueueListener(object):
+    """
+    Hands the records of a queue to the log outputs from a background
+    thread.
+    """
+
+    def __init__(self, records, handlers):
+        self.queue = records
+        self.handlers = handlers
+        self.thread = threading.Thread(target=self._monitor)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self):
+        """
+        Writes out the records still queued and stops the thread, giving up
+        after STOP_TIMEOUT seconds.
+        """
+        try:
+            self.queue.put(_STOP, timeout=STOP_TIMEOUT)
+        except queue.Full:
+            return
+        self.thread.join(STOP_TIMEOUT)
+
+
+class QueueHandler(logging.Handler):
+    """
+    Queues log records for a QueueListener writing them to the log outputs,
+    so a slow output (a syslog server over TCP, a busy disk) doesn't hold up
+    checks. A record logged while the queue is full is dropped and counted
+    in the log_records_dropped statistic.
+
+    The message is formatted when it is logged, with its arguments as they
+    are then, the outputs format the rest of the line in the background.
+    A forked worker process starts a listener of its own on first use.
+    """
+
+    def __init__(self, handlers, queue_size=DEFAULT_QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.handlers = list(handlers)
+        self.queue_size = int(queue_size)
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def _listener(self):
+        if self.pid != os.getpid():
+            with self.start_lock:
+                if self.pid != os.getpid():
+                    self.listener = QueueListener(
+                        queue.Queue(self.queue_size), self.handlers).start()
+                    self.pid = os.getpid()
+        return self.listener
+
+    def prepare(self, record):
+        # a copy, other handlers of the logger get the record as logged
+        message = self.format(record)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+    def emit(self, record):
+        try:
+            self._listener().queue.put_nowait(self.prepare(record))
+        except queue.Full:
+            stats.incr('log_records_dropped')
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """
+        Writes out the queued records of this process. Also called for
+        every handler by logging at exit.
+        """
+        with self.start_lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+            self.pid = None
+        logging.Handler.close(self)
+
+
+def close_handlers(logger):
+    """
+    Writes out the queued records of logger, for processes that leave
+    without running the exit handlers of logging (multiprocessing workers).
+    """
+    for handler in logger.handlers:
+        if isinstance(handler, QueueHandler):
+            handler.close()
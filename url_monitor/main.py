@@ -6,13 +6,23 @@ import argparse
 import json
 import logging
 import os
+import signal
 import sys
 import textwrap
+import time
 from exception import PidlockConflict
 
 import action
+import client
 import commons
 import configuration
+import control
+import exposition
+import profiling
+import sharding
+import stats
+import transport
+import workers
 
 import zbxsend as event
 from zbxsend import Metric
@@ -90,12 +100,44 @@ def main(arguments=None):
         " the config that have a particular datatype. This data is used by"
         " low level discovery in Zabbix."
     )
+    arg_parser.add_argument(
+        "--wait",
+        type=float,
+        default=0,
+        help="Optional with `check` command. Keep the process (and the "
+        "metrics_listener) up for this many seconds after the run."
+    )
+    arg_parser.add_argument(
+        "--workers",
+        nargs='?',
+        const='auto',
+        default=None,
+        help="Optional with `check` and `daemon` commands. Run checks in "
+        "this many worker processes, one per CPU core if no number is "
+        "given. Overrides config: workers."
+    )
+    arg_parser.add_argument(
+        "--testsets",
+        action='store_true',
+        default=False,
+        help="Optional with `discover` command. Discover one item per "
+        "testSet instead of testElements, for per check statistics."
+    )
     arg_parser.add_argument(
         "-c",
         "--config",
+        action='append',
         default=None,
         help="Specify custom config file, system default /etc/url_monitor."
-        "yaml"
+        "yaml. Can be given several times, or as a directory of .yaml "
+        "files, to run several configs as one job."
+    )
+    arg_parser.add_argument(
+        "--socket",
+        default=None,
+        help="Control socket of a resident daemon. The daemon listens on "
+        "it, check and discover ask the daemon listening on it instead of "
+        "making a full run. Overrides config: daemon: control_socket."
     )
     arg_parser.add_argument(
         "--loglevel",
@@ -103,117 +145,416 @@ def main(arguments=None):
         help="Specify custom loglevel override. Available options [debug,"
         " info, wrna, critical, error, exceptions]"
     )
+    arg_parser.add_argument(
+        "--profile",
+        default=None,
+        help="Profile this run. Comma seperated list of cpu (cProfile) and"
+        " mem (tracemalloc snapshots). A top-N summary is logged at info."
+    )
+    arg_parser.add_argument(
+        "--profile-stages",
+        default=None,
+        help="Comma seperated stages to profile with --profile: run (the"
+        " whole run, default), check, parse, send."
+    )
+    arg_parser.add_argument(
+        "--profile-dir",
+        default=None,
+        help="Directory for --profile output, defaults to config: "
+        "profiling: directory or the state_dir."
+    )
 
     inputflag = arg_parser.parse_args(args=arguments)
 
-    configinstance = configuration.ConfigObject()
-    configinstance.load_yaml_file(inputflag.config)
+    profiler = profiling.from_options(inputflag)
+    if profiler is None:
+        return execute(inputflag)
+
+    profiler.start()
+    try:
+        return execute(inputflag, profiler)
+    finally:
+        profiler.stop()
+
+
+def execute(inputflag, profiler=None):
+    """
+    Runs the COMMAND given on the command line.
+
+    :param inputflag: parsed arguments from main()
+    :param profiler: optional profiling.Profiler
+    :return:
+    """
+    run_started = time.time()
+    configinstances = []
+    for path in configuration.config_paths(inputflag.config):
+        configinstance = configuration.ConfigObject()
+        configinstance.load_yaml_file(path)
+        configinstances.append(configinstance)
+    if not configinstances:
+        logging.error("No config files found in {0}".format(
+            ', '.join(inputflag.config)))
+        exit(1)
+    # settings of the process itself (logging, workers, concurrency, the
+    # listener, DNS cache and daemon interval) come from the first config
+    configinstance = configinstances[0]
+    stats.incr('config_load_seconds', time.time() - run_started)
     logger = configinstance.get_logger(inputflag.loglevel)
+    if profiler:
+        profiler.configure(logger, configinstance)
+
+    for each in configinstances:
+        # logging is set up once, from the first config
+        each.logger = logger
+        each.pre_flight_check()
+
+    # skip if skip conditions exist (for standby nodes). Conditions are
+    # evaluated in the background while the config and checks are prepared.
+    skip_monitors = [start_skip_monitor(inputflag, each, logger)
+                     for each in configinstances]
+
+    compile_started = time.time()
+
+    selected_checks = select_checks(inputflag, configinstances)
+    stats.incr('config_load_seconds', time.time() - compile_started)
+
+    # a daemon stays up on standby nodes and re-checks every cycle
+    active = [index for index, skip_monitor in enumerate(skip_monitors)
+              if inputflag.COMMAND == "daemon" or
+              not skip_monitor.should_skip()]
+    if not active:
+        exit(0)
+
+    if profiler:
+        profiler.boundary('config')
+
+    if inputflag.COMMAND == "discover":
+        action.discover(inputflag, configinstances, logger)
+        return 0
+
+    if inputflag.COMMAND not in ("check", "daemon"):
+        logging.error("Unknown command {0}. Use --help for more "
+                      "information.".format(inputflag.COMMAND))
+        exit(1)
+
+    # establish single-run lockfiles (pid), one per distinct pidfile
+    lock_started = time.time()
+    runlocks = []
+    try:
+        for pidfile in sorted(set(each.load()['config']['pidfile']
+                                  for each in configinstances)):
+            runlocks.append(commons.AcquireRunLock(pidfile))
+    except PidlockConflict, err:
+        logging.error("Error: Could not acquire exclusive "
+                      "lock {0}".format(err))
+        for runlock in runlocks:
+            runlock.release()
+        print("1")
+        exit(1)
+    stats.incr('lock_wait_seconds', time.time() - lock_started)
+
+    # The metrics listener only makes sense while the process is around to
+    # be scraped: as a daemon or when asked to --wait after a check run.
+    listener = None
+    if inputflag.COMMAND == "daemon" or inputflag.wait:
+        listener = exposition.start_listener(configinstance, logger)
+
+    # a daemon can answer the check and discover external checks of thin
+    # clients, see client.py
+    controller = None
+    runs = None
+    if inputflag.COMMAND == "daemon":
+        path = inputflag.socket or configinstance.get_control_socket()
+        if path is True:
+            path = client.default_socket_path(inputflag.config)
+        if path:
+            runs = control.Runs()
+            controller = control.ControlListener(
+                path, lambda request: answer_control(
+                    request, configinstances, runs, logger),
+                logger).start()
+            logger.info("Answering thin clients on {0}".format(path))
+
+    # only a daemon lives long enough to benefit from DNS prefetching
+    transport.configure_dns(configinstance, logger,
+                            prefetch=inputflag.COMMAND == "daemon")
 
-    configinstance.pre_flight_check()
-    config = configinstance.load()
+    # worker processes are forked before any request is made, so they
+    # don't share connections with each other
+    pool = None
+    processes = configinstance.get_worker_count(inputflag.workers)
+    if profiler and processes > 1:
+        # profiles of forked workers would be lost
+        logger.info("Profiling, running the checks without workers")
+        processes = 1
+    if processes > 1 and len(selected_checks) > 1:
+        pool = workers.WorkerPool(processes, configinstance, logger,
+                                  configinstances).start()
+
+    try:
+        if inputflag.COMMAND == "check":
+            set_rc = run_checks(
+                assigned_checks(inputflag, selected_checks, configinstances,
+                                active, logger),
+                configinstances, logger, run_started, profiler, pool, active)
+            print(set_rc)
+            if inputflag.wait:
+                logger.info("Waiting {0}s before exit".format(
+                    inputflag.wait))
+                time.sleep(inputflag.wait)
+        else:
+            run_daemon(inputflag, selected_checks, configinstances, logger,
+                       run_started, skip_monitors, profiler, pool, runs)
+            set_rc = 0
+    finally:
+        if pool:
+            pool.stop()
+        # drop lockfile
+        if listener:
+            listener.stop()
+        if controller:
+            controller.stop()
+        for runlock in runlocks:
+            if runlock.islocked():
+                runlock.release()
+    exit(set_rc)
+
+
+def select_checks(inputflag, configinstances):
+    """
+    Compiles the list of checks to run, --key limits it to a single check.
+    Every testSet is tagged with the index of the config it comes from.
+    """
+    return [dict(thisscheck, config=index)
+            for index, each in enumerate(configinstances)
+            for thisscheck in each.load()['checks']
+            if not inputflag.key or thisscheck['key'] == inputflag.key]
+
+
+def assigned_checks(inputflag, selected_checks, configinstances, active,
+                    logger):
+    """
+    Returns the checks of the active configs this node runs, sharded with
+    the sharding settings of their own config. An explicit --key always
+    runs.
+
+    :param active: indexes of the configs not skipped by skip_run_when
+    """
+    assigned = []
+    for index in active:
+        config_checks = [thisscheck for thisscheck in selected_checks
+                         if thisscheck['config'] == index]
+        if not inputflag.key:
+            config_checks = sharding.assigned_checks(
+                configinstances[index].load(), config_checks, logger)
+        assigned.extend(config_checks)
+    return assigned
 
-    # stage return code
-    set_rc = 0
 
-    # skip if skip conditions exist (for standby nodes)
+def start_skip_monitor(inputflag, configinstance, logger):
+    """
+    Starts evaluating the skip_run_when conditions in the background.
+
+    :return commons.SkipConditionMonitor:
+    """
     conditional_skip_queue = configinstance.skip_conditions
     if inputflag.COMMAND == "discover":
         conditional_skip_queue = []  # no need to disable this
     if len(conditional_skip_queue) > 0:
         logger.info("Checking {0} standby conditions to see if test execution"
                     " should skip.".format(len(conditional_skip_queue)))
-    for test in conditional_skip_queue:
-        for condition, condition_args in test.items():
-            if commons.skip_on_external_condition(
-                    logger, condition, condition_args):
-                exit(0)
-
-    if inputflag.COMMAND == "check":
-        # establish single-run lockfile (pid)
-        try:
-            runlock = commons.AcquireRunLock(config['config']['pidfile'])
-        except PidlockConflict, err:
-            logging.error("Error: Could not acquire exclusive "
-                          "lock {0}".format(err))
-            print("1")
-            exit(1)
-
-        completed_runs = []
-        for thisscheck in config['checks']:
-            try:
-                if (inputflag.key != None and
-                        thisscheck['key'] == inputflag.key):
-                    # --key defined and name matched! only run 1 check
-                    rc, checkobj = action.check(
-                        thisscheck, configinstance, logger
-                    )
-                    completed_runs.append(
-                        (
-                            rc,
-                            thisscheck['key'],
-                            checkobj
-                        )
-                    )
-                elif not inputflag.key:
-                    # run all checks
-                    rc, checkobj = action.check(
-                        thisscheck, configinstance, logger
-                    )
-                    completed_runs.append(
-                        (
-                            rc,
-                            thisscheck['key'],
-                            checkobj
-                        )
-                    )
-            except Exception as e:
-                logger.exception(e)
-
-        for check in completed_runs:
-            rc, name, values = check
-            if rc == 0 and set_rc == 0:
-                set_rc = 0
-            else:
-                set_rc = 1
+    return commons.SkipConditionMonitor(
+        logger, commons.SkipConditionCache(configinstance.get_state_dir())
+    ).start(
+        [(condition, condition_args,
+          configinstance.get_skip_cache_ttl(condition))
+         for test in conditional_skip_queue
+         for condition, condition_args in test.items()]
+    )
 
-        badmsg = "with errors    [FAIL]"
-        if set_rc == 0:
-            badmsg = "without errors    [ OK ]"
-        logger.info("Checks have completed {0}".format(badmsg))
 
-        # Report final conditions to zabbix (so informational alerting can
-        # be built around failed script runs, exceptions, network errors,
-        # timeouts, etc)
-        logger.info(
-            "Sending execution summary to zabbix server as Metrics objects"
-        )
+def run_checks(selected_checks, configinstances, logger, run_started,
+               profiler=None, pool=None, active=None):
+    """
+    Runs a batch of checks, of one or several configs, and sends the
+    execution summary of every config. Summaries going to the same Zabbix
+    server are sent together.
+
+    :param pool: optional workers.WorkerPool to run the checks on
+    :param active: indexes of the configs to send a summary for, all of
+        them by default
+    :return: 0 if every check passed, 2 if the run_deadline was reached,
+        else 1
+    """
+    configinstance = configinstances[0]
+    if active is None:
+        active = range(len(configinstances))
+
+    deadline = configinstance.get_run_deadline()
+    if deadline is not None:
+        deadline += run_started
 
-        if not values:  # Do you see uncaught requests.exceptions?
-            values = {'EXECUTION_STATUS': 1}  # trigger an alert
+    if pool:
+        completed_runs = pool.run(selected_checks, deadline)
+    else:
+        completed_runs = action.check_all(selected_checks, configinstance,
+                                          logger, deadline=deadline,
+                                          configinstances=configinstances)
 
-        metrickey = config['config']['zabbix']['checksummary_key_format']
+    # stage return code per config
+    config_rc = dict((index, 0) for index in active)
+    cancelled = set()
+    for check in completed_runs:
+        rc, name, values, index = check
+        if rc == 2:
+            cancelled.add(index)
+        elif rc != 0:
+            config_rc[index] = 1
+            stats.incr('checks_failed')
 
-        check_completion_status = [Metric(
-            config['config']['zabbix']['host'], metrickey, set_rc
-        )]
+    if profiler:
+        profiler.boundary('checks')
 
-        logger.debug("Summary: {0}".format(check_completion_status))
-        if not action.transmitfacade(config, check_completion_status, logger=logger):
+    # checks were skipped or cut short, a config without failures reports
+    # its run as partial
+    for index in cancelled:
+        if config_rc.get(index) == 0:
+            config_rc[index] = 2
+
+    # url_monitor's own run statistics go out with the summary
+    run_seconds = time.time() - run_started
+    stats.set_value('run_seconds', run_seconds)
+    stats.set_value('peak_rss_kb', stats.peak_rss_kb())
+    stats.observe('run_seconds', run_seconds, buckets=stats.RUN_BUCKETS)
+
+    # Report final conditions to zabbix (so informational alerting can
+    # be built around failed script runs, exceptions, network errors,
+    # timeouts, etc)
+    logger.info(
+        "Sending execution summary to zabbix server as Metrics objects"
+    )
+    summaries = []
+    for index in active:
+        config = configinstances[index].load()
+        zabbix = config['config']['zabbix']
+        # sharded nodes report to the same host, each under its {node}
+        node = sharding.node_name(config['config'].get('sharding'))
+        metrics = [Metric(zabbix['host'],
+                          zabbix['checksummary_key_format'].format(node=node),
+                          config_rc[index])]
+        metrics += action.selfstats_metrics(config)
+        for summary in summaries:
+            if summary[0] == zabbix['server']:
+                summary[1].append(index)
+                summary[2].extend(metrics)
+                break
+        else:
+            summaries.append((zabbix['server'], [index], metrics))
+
+    for server, indexes, metrics in summaries:
+        logger.debug("Summary: %s", metrics)
+        if not action.transmitfacade(configinstances[indexes[0]].load(),
+                                     metrics, logger=logger):
             logger.critical(
                 "Sending execution summary to zabbix server failed!")
-            set_rc = 1
+            for index in indexes:
+                config_rc[index] = 1
+
+    for index in active:
+        badmsg = "with errors    [FAIL]"
+        if config_rc[index] == 0:
+            badmsg = "without errors    [ OK ]"
+        elif config_rc[index] == 2:
+            badmsg = "partially, run_deadline reached    [PART]"
+        logger.info("Checks{0} have completed {1}".format(
+            " of " + configinstances[index].path
+            if len(configinstances) > 1 else "", badmsg))
+
+    if 1 in config_rc.values():
+        return 1
+    return max(config_rc.values() or [0])
+
+
+def run_daemon(inputflag, selected_checks, configinstances, logger,
+               run_started, skip_monitors, profiler=None, pool=None,
+               runs=None):
+    """
+    Runs the checks every daemon: interval seconds until terminated.
+    Skip conditions are re-evaluated and changed include files reloaded at
+    the start of every cycle.
 
-    elif inputflag.COMMAND == "discover":
-        action.discover(inputflag, configinstance, logger)
+    :param runs: control.Runs of the control socket, whose clients also
+        start runs. An interval of 0 then only runs the checks when asked.
+    """
+    configinstance = configinstances[0]
+    interval = configinstance.get_daemon_interval()
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    logger.info("Running checks every {0}s as a daemon".format(interval))
+    while True:
+        if runs:
+            runs.started()
+        # only changed fragments are compiled again, the testSets of the
+        # others are kept as they are
+        if [path for each in configinstances
+                for path in each.reload_includes()]:
+            selected_checks = select_checks(inputflag, configinstances)
+        active = []
+        for index, skip_monitor in enumerate(skip_monitors):
+            if skip_monitor.should_skip():
+                logger.info("Skipping this cycle of {0} due to "
+                            "skip_run_when".format(
+                                configinstances[index].path))
+            else:
+                active.append(index)
         set_rc = 0
+        if active:
+            # membership is re-read every cycle to follow rebalancing
+            cycle_checks = assigned_checks(inputflag, selected_checks,
+                                           configinstances, active, logger)
+            set_rc = run_checks(cycle_checks, configinstances, logger,
+                                run_started, profiler, pool, active)
+        stats.reset()
 
-    # drop lockfile, then exit (if check mode is active)
-    if inputflag.COMMAND == "check":
-        print(set_rc)  # don't need print retcode in discover
-        if runlock.islocked():
-            runlock.release()
-            exit(set_rc)
+        if runs:
+            runs.finished(set_rc)
+            runs.wait_for_trigger(
+                max(0, interval - (time.time() - run_started))
+                if interval else None)
+        else:
+            time.sleep(max(0, interval - (time.time() - run_started)))
+        run_started = time.time()
+        skip_monitors = [start_skip_monitor(inputflag, each, logger)
+                         for each in configinstances]
+
+
+def answer_control(request, configinstances, runs, logger):
+    """
+    Answers a thin client on the control socket of the daemon, with what
+    the check or discover command would have printed.
+
+    :param runs: control.Runs of the daemon
+    :return dict: the response
+    """
+    if request.get('command') == 'check':
+        rc = runs.result()
+        if rc is None:
+            return {'error': "No check run completed within {0:.0f}s".format(
+                control.RUN_TIMEOUT)}
+        return {'rc': rc, 'output': "{0}\n".format(rc)}
+    if request.get('command') == 'discover':
+        discovery_dict = action.discovery(
+            argparse.Namespace(datatype=request.get('datatype'),
+                               testsets=bool(request.get('testsets'))),
+            configinstances, logger)
+        if discovery_dict is None:
+            return {'error': "Requires a datatype to discover"}
+        return {'rc': 0,
+                'output': json.dumps(discovery_dict, indent=3) + "\n"}
+    return {'error': "Unknown command {0}".format(request.get('command'))}
 
 
 def entry_point():
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+import action
+import commons
+
+__doc__ = """Optional CPU and memory profiling of a run (--profile)"""
+
+# Stages that can be profiled on their own, and the module attribute that
+# is wrapped for each. Wrapping only happens when profiling is enabled, so
+# a run without --profile executes exactly the same code as before.
+STAGES = {
+    'check': (action, 'check'),
+    'parse': (commons, 'omnipath'),
+    'send': (action, 'transmitfacade'),
+}
+
+
+class Profiler(object):
+    """
+    Collects a cProfile profile of the whole run or of selected stages, and
+    tracemalloc snapshots at stage boundaries. Without tracemalloc (Python
+    2) the resident set size is sampled at the boundaries instead.
+
+    cProfile only sees the thread that enabled it, so every thread gets its
+    own profile per stage (threads started during the run are profiled
+    from their start for the run stage) and they are merged when written.
+    """
+
+    def __init__(self, logging, modes, stages, directory, top=20):
+        """
+        :param logging: logger instance
+        :param modes: iterable of 'cpu' and/or 'mem'
+        :param stages: iterable of 'run' and/or names from STAGES
+        :param directory: where profiles and snapshots are written
+        :param top: number of entries in the logged summaries
+        """
+        self.logging = logging
+        self.cpu = 'cpu' in modes
+        self.mem = 'mem' in modes
+        self.stages = set(stages)
+        self.directory = directory
+        self.top = top
+        self.prefix = "url_monitor.{0}.{1}".format(
+            time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+        # stage -> profiles of the threads that ran it
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.snapshots = []
+        self.wrapped = []
+        self.local = threading.local()
+        # no tracemalloc, sample the resident set size instead
+        self.rss = self.mem and tracemalloc is None
+
+    def _push(self, stage):
+        """
+        Switches CPU profiling to stage. cProfile can't nest, so the
+        outer stage is paused and stage times are exclusive.
+        """
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+            self.local.profiles = {}
+        if stack:
+            self.local.profiles[stack[-1]].disable()
+        profile = self.local.profiles.get(stage)
+        if profile is None:
+            profile = self.local.profiles[stage] = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(stage, []).append(profile)
+        stack.append(stage)
+        profile.enable()
+
+    def _pop(self):
+        stack = self.local.stack
+        self.local.profiles[stack.pop()].disable()
+        if stack:
+            self.local.profiles[stack[-1]].enable()
+
+    def _thread_started(self, frame, event, arg):
+        # installed with threading.setprofile(), runs once in every new
+        # thread and hands it over to its own cProfile
+        sys.setprofile(None)
+        self._push('run')
+
+    def _wrap(self, stage, func):
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            if self.cpu:
+                self._push(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if self.cpu:
+                    self._pop()
+                if self.mem:
+                    self.boundary(stage, keep_latest=True)
+        return profiled
+
+    def configure(self, logger, configinstance):
+        """
+        Hands over the run's logger and the defaults from the profiling:
+        section of the config once they are loaded.
+        """
+        settings = configinstance.config['config'].get('profiling') or {}
+        self.logging = logger
+        if self.directory is None:
+            self.directory = settings.get('directory',
+                                          configinstance.get_state_dir())
+        self.top = int(settings.get('top', self.top))
+        for stage in self.stages:
+            if stage != 'run' and stage not in STAGES:
+                logger.warning("Unknown profile stage {0}, expected run or "
+                               "{1}".format(stage, ', '.join(sorted(STAGES))))
+
+    def start(self):
+        """
+        Installs stage wrappers and starts collecting.
+        """
+        if self.mem:
+            if not self.rss:
+                tracemalloc.start()
+            self.boundary('start')
+        for stage in self.stages:
+            if stage not in STAGES:
+                continue
+            module, attribute = STAGES[stage]
+            original = getattr(module, attribute)
+            self.wrapped.append((module, attribute, original))
+            setattr(module, attribute, self._wrap(stage, original))
+        if self.cpu and 'run' in self.stages:
+            threading.setprofile(self._thread_started)
+            self._push('run')
+
+    def boundary(self, name, keep_latest=False):
+        """
+        Takes a tracemalloc snapshot (or an RSS sample) at a stage boundary.
+        With keep_latest, a repeating stage only keeps its most recent one.
+        """
+        if not self.mem:
+            return
+        if keep_latest:
+            self.snapshots = [(n, s) for n, s in self.snapshots if n != name]
+        if self.rss:
+            self.snapshots.append((name, rss_kb()))
+        else:
+            self.snapshots.append((name, tracemalloc.take_snapshot()))
+
+    def stop(self):
+        """
+        Stops collecting, restores the wrapped functions, writes the
+        results and logs a top-N summary.
+        """
+        if self.cpu and 'run' in self.stages:
+            threading.setprofile(None)
+            self._pop()
+        for module, attribute, original in self.wrapped:
+            setattr(module, attribute, original)
+        self.wrapped = []
+        if self.mem:
+            self.boundary('end')
+        if self.mem and not self.rss:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.logging.info("Profile: traced memory current={0}KB "
+                              "peak={1}KB".format(current // 1024,
+                                                  peak // 1024))
+
+        if self.directory is None:
+            self.directory = "/var/lib/zabbixsrv/"
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        for stage, profiles in sorted(self.profiles.items()):
+            path = os.path.join(self.directory, "{0}.{1}.prof".format(
+                self.prefix, stage))
+            summary = StringIO()
+            merged = pstats.Stats(profiles[0], stream=summary)
+            for profile in profiles[1:]:
+                merged.add(profile)
+            merged.dump_stats(path)
+            merged.sort_stats('cumulative').print_stats(self.top)
+            self.logging.info("Profile: CPU {0} of {1} threads written to "
+                              "{2}\n{3}".format(stage, len(profiles), path,
+                                                summary.getvalue()))
+
+        if self.rss:
+            self._write_rss()
+            return
+
+        previous = None
+        for name, snapshot in self.snapshots:
+            path = os.path.join(self.directory, "{0}.{1}.tracemalloc".format(
+                self.prefix, name))
+            snapshot.dump(path)
+            if previous is not None:
+                lines = [str(stat) for stat in snapshot.compare_to(
+                    previous, 'lineno')[:self.top]]
+                self.logging.info("Profile: memory growth up to {0} "
+                                  "(snapshot {1})\n{2}".format(
+                                      name, path, "\n".join(lines)))
+            previous = snapshot
+
+    def _write_rss(self):
+        path = os.path.join(self.directory, "{0}.rss".format(self.prefix))
+        lines = ["{0:<10} {1:>12} {2:>12}".format('boundary', 'current_kb',
+                                                  'peak_kb')]
+        for name, (current, peak) in self.snapshots:
+            lines.append("{0:<10} {1:>12} {2:>12}".format(
+                name, '-' if current is None else current, peak))
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        self.logging.info("Profile: resident memory at stage boundaries "
+                          "(no tracemalloc) written to {0}\n{1}".format(
+                              path, "\n".join(lines)))
+
+
+def rss_kb():
+    """
+    Returns the current (None where /proc isn't available) and peak
+    resident set size of this process in kilobytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        current = pages * resource.getpagesize() // 1024
+    except (IOError, OSError, IndexError, ValueError):
+        current = None
+    return current, peak
+
+
+def from_options(inputflag):
+    """
+    Builds a Profiler from the --profile options, or returns None when
+    profiling is off. The output directory and summary size fall back to
+    the profiling: section of the config in Profiler.configure().
+    """
+    if not inputflag.profile:
+        return None
+    modes = [m.strip().lower() for m in inputflag.profile.split(',')]
+    stages = [s.strip().lower()
+              for s in (inputflag.profile_stages or 'run').split(',')]
+    return Profiler(logging.getLogger(), modes, stages,
+                    inputflag.profile_dir)
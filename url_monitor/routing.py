@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+import sharding
+import stats
+
+__doc__ = """Sends metrics to one of several Zabbix servers or proxies"""
+
+DEFAULT_PORT = 10051
+STRATEGIES = ('failover', 'distribute')
+DISTRIBUTE_BY = ('host', 'key')
+
+
+def _address(server):
+    host, _, port = str(server).strip().partition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+
+def settings(zabbix):
+    """
+    Reads the server settings of a config: zabbix section.
+
+    :raise ValueError: for an invalid setting
+    :return: (servers, strategy, cooldown, distribute_by), servers is a
+        list of (host, port) in the configured order
+    """
+    servers = zabbix['server']
+    if not isinstance(servers, (list, tuple)):
+        servers = [servers]
+    if not servers:
+        raise ValueError("server has no servers")
+    servers = [_address(server) for server in servers]
+
+    strategy = zabbix.get('server_strategy', 'failover')
+    if strategy not in STRATEGIES:
+        raise ValueError("server_strategy must be one of {0}".format(
+            ', '.join(STRATEGIES)))
+    distribute_by = zabbix.get('distribute_by', 'host')
+    if distribute_by not in DISTRIBUTE_BY:
+        raise ValueError("distribute_by must be one of {0}".format(
+            ', '.join(DISTRIBUTE_BY)))
+    return servers, strategy, float(zabbix.get('server_cooldown', 30)), \
+        distribute_by
+
+
+class Router(object):
+    """
+    Sends metrics to the servers of a zabbix config section.
+
+    With the failover strategy a batch goes to the first server in the
+    configured order. With distribute every metric goes to the server its
+    host (or item key with distribute_by: key) ranks first by rendezvous
+    hashing, which splits the items between the servers while an item
+    always reaches the same one. Metrics a server didn't accept are sent to
+    the next server in the same order.
+
+    A server that didn't accept a batch cools down for server_cooldown
+    seconds, it is only tried after the others until then.
+    """
+
+    def __init__(self, logging):
+        self.logging = logging
+        # (host, port) -> time.time() the cooldown ends
+        self.down_until = {}
+        self.lock = threading.Lock()
+
+    def _healthy_first(self, servers):
+        now = time.time()
+        with self.lock:
+            up = [server for server in servers
+                  if self.down_until.get(server, 0) <= now]
+        return up + [server for server in servers if server not in up]
+
+    def _record(self, server, ok, cooldown, alternatives):
+        with self.lock:
+            if ok:
+                self.down_until.pop(server, None)
+                return
+            self.down_until[server] = time.time() + cooldown
+        if alternatives:
+            self.logging.warning("Zabbix server {0}:{1} didn't accept "
+                                 "metrics, trying it last for {2:.0f}s".format(
+                                     server[0], server[1], cooldown))
+
+    def send(self, zabbix, metrics, send):
+        """
+        Sends metrics to the servers of zabbix.
+
+        :param zabbix: config: zabbix section
+        :param send: callable(metrics, host, port) returning True when the
+            server accepted the metrics
+        :raise ValueError: for invalid server settings
+        :return: True when every metric was accepted by a server
+        """
+        servers, strategy, cooldown, distribute_by = settings(zabbix)
+        names = dict(("{0}:{1}".format(*server), server)
+                     for server in servers)
+        orders = {}
+
+        def order(metric):
+            key = None
+            if strategy == 'distribute' and len(servers) > 1:
+                key = getattr(metric, distribute_by)
+            if key not in orders:
+                preferred = servers
+                if key is not None:
+                    preferred = [names[name] for name in
+                                 sharding.ranked(key, sorted(names))]
+                orders[key] = self._healthy_first(preferred)
+            return orders[key]
+
+        failed = set()
+        pending = list(metrics)
+        lost = 0
+        first = True
+        while pending:
+            batches = []
+            targets = {}
+            for metric in pending:
+                server = next((server for server in order(metric)
+                               if server not in failed), None)
+                if server is None:
+                    lost += 1
+                elif server in targets:
+                    targets[server].append(metric)
+                else:
+                    targets[server] = [metric]
+                    batches.append((server, targets[server]))
+            if not first:
+                stats.incr('sender_failovers', len(batches))
+            first = False
+
+            pending = []
+            for server, batch in batches:
+                ok = send(batch, server[0], server[1])
+                self._record(server, ok, cooldown, len(servers) > 1)
+                if not ok:
+                    failed.add(server)
+                    pending.extend(batch)
+        if lost:
+            self.logging.error("No Zabbix server accepted {0} "
+                               "metrics".format(lost))
+        return not lost
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router(logger):
+    """
+    Returns the router of this process, which keeps the server cooldowns.
+    """
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router(logger)
+        return _router
@@ -0,0 +1,179 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import collections
+import threading
+import time
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+__doc__ = """Runs checks concurrently within per origin host limits"""
+
+
+def origin_host(check):
+    """
+    Returns the host a testSet's uri points at, '' if it has no uri (the
+    check itself reports that).
+    """
+    try:
+        return urlparse(check['data']['uri']).netloc.split(':')[0]
+    except (KeyError, TypeError, AttributeError):
+        return ''
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, with bursts of up to burst
+    requests. Not thread safe, OriginScheduler serializes access.
+    """
+
+    def __init__(self, rate, burst=None, now=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.time() if now is None else now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """
+        Seconds until a request may be made, 0 if one may be made now.
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OriginScheduler(object):
+    """
+    Runs tasks on a fixed number of threads while keeping every origin
+    host within its max_concurrent and requests_per_second limits.
+
+    Whenever a thread is free it takes the next task of the first origin,
+    in round-robin order, that is within its limits. A throttled origin
+    only delays its own tasks, the other origins keep the threads busy.
+    """
+
+    def __init__(self, concurrency, limits=None, shared=None, deadline=None):
+        """
+        :param concurrency: number of tasks run at the same time. The
+            calling thread is one of them, so 1 runs everything inline.
+        :param limits: dict of origin host to dict with max_concurrent,
+            requests_per_second and burst. The 'default' entry applies to
+            every origin and is overridden per origin.
+        :param shared: dict of origin host to the number of processes its
+            tasks are split across, the limits are divided between them.
+        :param deadline: time.time() after which no task is started, the
+            items that were not started are left in skipped.
+        """
+        self.concurrency = max(1, int(concurrency))
+        self.limits = limits or {}
+        self.shared = shared or {}
+        self.deadline = deadline
+        self.skipped = []
+
+    def limit(self, origin):
+        """
+        Returns (max_concurrent, TokenBucket or None) for origin.
+        """
+        settings = dict(self.limits.get('default') or {})
+        settings.update(self.limits.get(origin) or {})
+        share = self.shared.get(origin, 1)
+
+        cap = self.concurrency
+        if settings.get('max_concurrent'):
+            cap = max(1, int(settings['max_concurrent']) // share)
+
+        bucket = None
+        if settings.get('requests_per_second'):
+            rate = float(settings['requests_per_second']) / share
+            burst = settings.get('burst')
+            bucket = TokenBucket(rate, burst and max(1.0,
+                                                     float(burst) / share))
+        return cap, bucket
+
+    def run(self, tasks, func):
+        """
+        Calls func(item) for every (origin, item) in tasks.
+
+        :return: list of the return values in the order of tasks
+        """
+        pending = collections.OrderedDict()
+        for index, (origin, item) in enumerate(tasks):
+            pending.setdefault(origin, collections.deque()).append(
+                (index, item))
+        origins = collections.deque(pending)
+        limits = dict((origin, self.limit(origin)) for origin in origins)
+        in_flight = dict((origin, 0) for origin in origins)
+        results = [None] * len(tasks)
+        condition = threading.Condition()
+
+        def next_task():
+            # called with condition held, waits until a task may start
+            while origins:
+                now = time.time()
+                if self.deadline is not None and now >= self.deadline:
+                    for origin in origins:
+                        self.skipped.extend(item for index, item
+                                            in pending[origin])
+                    origins.clear()
+                    break
+                soonest = None
+                for _ in range(len(origins)):
+                    origin = origins[0]
+                    origins.rotate(-1)
+                    cap, bucket = limits[origin]
+                    if in_flight[origin] >= cap:
+                        continue
+                    if bucket is not None:
+                        wait = bucket.wait_time(now)
+                        if wait > 0:
+                            soonest = min(soonest or wait, wait)
+                            continue
+                        bucket.take(now)
+                    index, item = pending[origin].popleft()
+                    if not pending[origin]:
+                        origins.remove(origin)
+                    in_flight[origin] += 1
+                    return origin, index, item
+                # woken up by a finished task, when a bucket refills or at
+                # the deadline
+                if self.deadline is not None:
+                    soonest = min(soonest or self.deadline - now,
+                                  self.deadline - now)
+                condition.wait(soonest)
+            return None
+
+        def work():
+            while True:
+                with condition:
+                    task = next_task()
+                if task is None:
+                    return
+                origin, index, item = task
+                try:
+                    results[index] = func(item)
+                finally:
+                    with condition:
+                        in_flight[origin] -= 1
+                        condition.notify_all()
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(self.concurrency, len(tasks)) - 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        work()
+        for thread in threads:
+            thread.join()
+        return results
@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import hashlib
+import socket
+
+__doc__ = """Active-active sharding of testSets across url_monitor nodes"""
+
+
+def _weight(node, key):
+    """
+    Rendezvous hashing weight of a node for a key.
+    """
+    digest = hashlib.md5(u"{0}\0{1}".format(node, key).encode('utf-8'))
+    return int(digest.hexdigest()[:16], 16)
+
+
+def owner(key, nodes):
+    """
+    Returns the node a key belongs to.
+
+    Every node computes a weight for every key and the highest weight wins
+    (rendezvous or highest random weight hashing). When a node leaves only
+    its own keys move, and a node that joins only takes the keys it now
+    wins, so a membership change moves the minimum number of checks.
+    """
+    return max(nodes, key=lambda node: (_weight(node, key), node))
+
+
+def ranked(key, nodes):
+    """
+    Returns the nodes in the order a key prefers them, owner() first. When
+    the owner is unavailable the key goes to the next one, which is the
+    same for every node.
+    """
+    return sorted(nodes, key=lambda node: (_weight(node, key), node),
+                  reverse=True)
+
+
+def read_membership(path):
+    """
+    Reads node ids from a membership file, one per line. Blank lines and
+    lines starting with # are ignored.
+    """
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.strip().startswith('#')]
+
+
+def get_nodes(sharding):
+    """
+    Returns (node_id, nodes) for a sharding config section, or None when
+    sharding is not configured.
+
+    :raise IOError: when the membership file can't be read
+    """
+    if not sharding:
+        return None
+    if sharding.get('membership_file'):
+        return node_name(sharding), read_membership(
+            sharding['membership_file'])
+    if 'node_count' in sharding:
+        nodes = [str(n) for n in range(int(sharding['node_count']))]
+        return node_name(sharding), nodes
+    return None
+
+
+def node_name(sharding):
+    """
+    Returns the id of this node for a sharding config section, '' when
+    sharding is not configured. It is the {node} of the summary keys, the
+    nodes share a Zabbix host and would overwrite each other's summaries.
+    """
+    if not sharding:
+        return ''
+    if sharding.get('membership_file'):
+        return str(sharding.get('node_id') or socket.gethostname())
+    if 'node_count' in sharding:
+        return str(sharding.get('node_id', 0))
+    return ''
+
+
+def assigned_checks(config, checks, logger):
+    """
+    Filters checks down to the testSets this node owns.
+
+    Runs every check if sharding is not configured or the membership
+    can't be read (a duplicate value is better than a monitoring gap), and
+    none if this node is not a member.
+
+    :param config: loaded config dict
+    :param checks: list of testSets as returned by ConfigObject.load()
+    """
+    try:
+        membership = get_nodes(config['config'].get('sharding'))
+    except (IOError, OSError) as err:
+        logger.error("Sharding membership unreadable, running all "
+                     "checks: {0}".format(err))
+        return checks
+    if membership is None:
+        return checks
+
+    node_id, nodes = membership
+    if node_id not in nodes:
+        logger.warning("Node {0} is not a member of {1}, running no "
+                       "checks".format(node_id, nodes))
+        return []
+
+    mine = [check for check in checks if owner(check['key'], nodes) == node_id]
+    logger.info("Node {0} of {1} owns {2}/{3} checks".format(
+        node_id, len(nodes), len(mine), len(checks)))
+    return mine
@@ -0,0 +1,256 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import contextlib
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+__doc__ = """Memory mapped store of the last value of items between runs"""
+
+STATE_FILE = 'url_monitor.state'
+MAGIC = b'UMSTATE1'
+# magic, capacity (slots), used slots
+HEADER = struct.Struct('<8sQQ')
+HEADER_SIZE = 64
+# key hash, value, timestamp, crc32 of the first three
+RECORD = struct.Struct('<QddI4x')
+KEY_HASH = struct.Struct('<Q')
+# the table is rebuilt twice as large beyond this fraction of used slots
+MAX_LOAD = 0.7
+
+# datatypes sent as the change of the value since the last run
+DERIVED_DATATYPES = ('rate', 'delta')
+
+
+def _key_hash(key):
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return KEY_HASH.unpack(digest[:8])[0] or 1  # 0 marks a free slot
+
+
+def _checksum(key_hash, value, timestamp):
+    return zlib.crc32(struct.pack('<Qdd', key_hash, value,
+                                  timestamp)) & 0xffffffff
+
+
+class StateStore(object):
+    """
+    Last value and timestamp of items, keyed by item key, kept in a file
+    in the state_dir so they carry over between runs.
+
+    The file is a header followed by an open addressing hash table of fixed
+    size records that is memory mapped, so reading or updating an item
+    touches one record however many items there are. Once the table is 70%
+    full it is rebuilt twice as large in a new file that replaces the old
+    one. Every record carries a checksum, a record torn by a crash reads as
+    missing rather than as a wrong value.
+
+    Reads and updates are made under an exclusive lock on the file, so
+    worker processes and overlapping runs can share it.
+    """
+
+    def __init__(self, logging, directory, capacity=4096):
+        self.logging = logging
+        self.path = os.path.join(directory, STATE_FILE)
+        self.initial_capacity = int(capacity)
+
+        self.file = None
+        self.map = None
+        self.capacity = 0
+        self.pid = None
+        self.inode = None
+        self.lock = threading.Lock()
+
+    def _close(self):
+        if self.map is not None:
+            self.map.close()
+        if self.file is not None:
+            self.file.close()
+        self.map = self.file = None
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _valid(self, f):
+        f.seek(0)
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return False
+        magic, capacity, used = HEADER.unpack(header)
+        size = os.fstat(f.fileno()).st_size
+        return magic == MAGIC and capacity > 0 and \
+            size == HEADER_SIZE + capacity * RECORD.size
+
+    def _initialize(self, f, capacity):
+        os.ftruncate(f.fileno(), 0)
+        os.ftruncate(f.fileno(), HEADER_SIZE + capacity * RECORD.size)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, capacity, 0))
+        f.flush()
+
+    def _open(self):
+        # a forked worker gets its own file description, flock() locks are
+        # shared by every process using the same one
+        if self.pid == os.getpid():
+            self._close()
+        else:
+            self.map = self.file = None
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            if not self._valid(self.file):
+                if os.fstat(fd).st_size:
+                    self.logging.warning("{0} is not a valid state file, "
+                                         "starting over".format(self.path))
+                self._initialize(self.file, self.initial_capacity)
+            self.map = mmap.mmap(fd, 0)
+            self.capacity = HEADER.unpack_from(self.map, 0)[1]
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.pid = os.getpid()
+        self.inode = os.fstat(fd).st_ino
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock:
+            while True:
+                if self.file is None or self.pid != os.getpid():
+                    self._open()
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+                try:
+                    inode = os.stat(self.path).st_ino
+                except OSError:
+                    inode = None
+                if inode == self.inode:
+                    break
+                # another process replaced the file with a larger table
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+                self._open()
+            try:
+                yield
+            finally:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def _find(self, key_hash, table=None, capacity=None):
+        """
+        Returns the offset of the slot of key_hash, or of the free slot it
+        belongs in, and the key hash stored there (0 when free).
+        """
+        table = table or self.map
+        mask = (capacity or self.capacity) - 1
+        slot = key_hash & mask
+        while True:
+            offset = HEADER_SIZE + slot * RECORD.size
+            stored = KEY_HASH.unpack_from(table, offset)[0]
+            if stored == key_hash or stored == 0:
+                return offset, stored
+            slot = (slot + 1) & mask
+
+    def _read(self, offset):
+        key_hash, value, timestamp, checksum = RECORD.unpack_from(self.map,
+                                                                  offset)
+        if checksum != _checksum(key_hash, value, timestamp):
+            return None
+        return value, timestamp
+
+    def get(self, key):
+        """
+        :return: (value, timestamp) stored for key, None if there is none
+        """
+        key_hash = _key_hash(key)
+        with self._locked():
+            offset, stored = self._find(key_hash)
+            return self._read(offset) if stored else None
+
+    def update(self, key, value, timestamp):
+        """
+        Stores value and timestamp for key.
+
+        :return: (value, timestamp) stored before, None if there was none
+        """
+        key_hash = _key_hash(key)
+        value = float(value)
+        timestamp = float(timestamp)
+        with self._locked():
+            offset, stored = self._find(key_hash)
+            previous = self._read(offset) if stored else None
+            RECORD.pack_into(self.map, offset, key_hash, value, timestamp,
+                             _checksum(key_hash, value, timestamp))
+            if not stored:
+                magic, capacity, used = HEADER.unpack_from(self.map, 0)
+                HEADER.pack_into(self.map, 0, magic, capacity, used + 1)
+                if used + 1 > capacity * MAX_LOAD:
+                    self._grow()
+        return previous
+
+    def _grow(self):
+        # called with the file locked
+        capacity = self.capacity * 2
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'r+b') as f:
+            self._initialize(f, capacity)
+            table = mmap.mmap(fd, 0)
+            used = 0
+            for slot in range(self.capacity):
+                offset = HEADER_SIZE + slot * RECORD.size
+                record = RECORD.unpack_from(self.map, offset)
+                if not record[0] or record[3] != _checksum(*record[:3]):
+                    continue
+                new_offset, stored = self._find(record[0], table, capacity)
+                if not stored:
+                    RECORD.pack_into(table, new_offset, *record)
+                    used += 1
+            HEADER.pack_into(table, 0, MAGIC, capacity, used)
+            table.flush()
+            table.close()
+        os.rename(tmp_path, self.path)
+        self.logging.debug("Grew {0} to {1} slots".format(self.path,
+                                                          capacity))
+
+
+def derive(store, key, value, timestamp, per_second=True):
+    """
+    Returns how much a counter changed since the value stored for key, per
+    second with per_second, and stores value for the next run.
+
+    :raise ValueError: when value is not a number
+    :return: None for the first value of key and when the counter went
+        backwards (it was reset)
+    """
+    if isinstance(value, bool):
+        raise ValueError("{0!r} is not a number".format(value))
+    value = float(value)
+    previous = store.update(key, value, timestamp)
+    if previous is None:
+        return None
+    last_value, last_timestamp = previous
+    change = value - last_value
+    if change < 0:
+        return None
+    if not per_second:
+        return change
+    elapsed = timestamp - last_timestamp
+    if elapsed <= 0:
+        return None
+    return change / elapsed
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store(configinstance, logger):
+    """
+    Returns the state store of this process, opened on first use.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StateStore(logger, configinstance.get_state_dir())
+        return _store
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import bisect
+import resource
+import threading
+
+__doc__ = """Process wide counters describing url_monitor's own work"""
+
+# Counters reported with the execution summary, always sent even when 0
+RUN_STATS = (
+    'run_seconds',
+    'checks_run',
+    'checks_failed',
+    'checks_skipped',
+    'http_bytes_in',
+    'http_wire_bytes_in',
+    'metrics_sent',
+    'sender_roundtrips',
+    'sender_failovers',
+    'lock_wait_seconds',
+    'config_load_seconds',
+    'peak_rss_kb',
+    'tls_handshakes',
+)
+
+# Histogram bucket upper bounds (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+RUN_BUCKETS = (1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+# _counters are per run and cleared by reset(), _totals only ever grow so
+# they can be exposed as monotonic counters by a long lived process.
+_counters = {}
+_totals = {}
+_gauges = {}
+_histograms = {}
+_caches = {}
+_lock = threading.Lock()
+
+
+def incr(name, value=1):
+    """
+    Adds value to a counter.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+        _totals[name] = _totals.get(name, 0) + value
+
+
+def gauge_add(name, value):
+    """
+    Moves a gauge (such as requests in flight) up or down.
+    """
+    with _lock:
+        _gauges[name] = _gauges.get(name, 0) + value
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Records value in a histogram. Only the matching bucket is touched,
+    buckets are made cumulative when exposed.
+    """
+    key = (name, tuple(sorted(labels.items())))
+    index = bisect.bisect_left(buckets, value)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {
+                'buckets': buckets, 'counts': [0] * (len(buckets) + 1),
+                'sum': 0.0, 'count': 0}
+        histogram['counts'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def cache_event(cache, hit):
+    """
+    Counts a hit or miss of one of url_monitor's caches.
+    """
+    with _lock:
+        events = _caches.setdefault(cache, [0, 0])
+        events[0 if hit else 1] += 1
+
+
+def set_value(name, value):
+    """
+    Sets a counter to an absolute value.
+    """
+    with _lock:
+        _counters[name] = value
+
+
+def get(name, default=0):
+    """
+    Returns the current value of a counter.
+    """
+    with _lock:
+        return _counters.get(name, default)
+
+
+def snapshot():
+    """
+    Returns a copy of every counter.
+    """
+    with _lock:
+        return dict(_counters)
+
+
+def totals():
+    """
+    Returns copies of the long lived totals, gauges, histograms and cache
+    events for exposition.
+    """
+    with _lock:
+        return (dict(_totals),
+                dict(_gauges),
+                dict((key, dict(h, counts=list(h['counts'])))
+                     for key, h in _histograms.items()),
+                dict((cache, list(events))
+                     for cache, events in _caches.items()))
+
+
+def reset():
+    """
+    Clears the per run counters, used between runs of a long lived process.
+    """
+    with _lock:
+        _counters.clear()
+
+
+def discard():
+    """
+    Drops every counter, gauge and histogram. Used by a forked worker
+    process so it only reports its own work back with export().
+    """
+    with _lock:
+        for storage in (_counters, _totals, _gauges, _histograms, _caches):
+            storage.clear()
+
+
+def export():
+    """
+    Returns the per run counters, histograms and cache events in a form
+    that can be pickled and handed to merge() in another process.
+    """
+    with _lock:
+        return (dict(_counters),
+                dict((key, dict(h, counts=list(h['counts'])))
+                     for key, h in _histograms.items()),
+                dict((cache, list(events))
+                     for cache, events in _caches.items()))
+
+
+def merge(exported):
+    """
+    Adds the output of export() from a worker process to this process.
+    """
+    counters, histograms, caches = exported
+    with _lock:
+        for name, value in counters.items():
+            _counters[name] = _counters.get(name, 0) + value
+            _totals[name] = _totals.get(name, 0) + value
+        for key, theirs in histograms.items():
+            ours = _histograms.get(key)
+            if ours is None:
+                _histograms[key] = dict(theirs, counts=list(theirs['counts']))
+                continue
+            ours['counts'] = [a + b for a, b in zip(ours['counts'],
+                                                    theirs['counts'])]
+            ours['sum'] += theirs['sum']
+            ours['count'] += theirs['count']
+        for cache, (hits, misses) in caches.items():
+            events = _caches.setdefault(cache, [0, 0])
+            events[0] += hits
+            events[1] += misses
+
+
+def peak_rss_kb():
+    """
+    Peak resident set size in kilobytes (on Linux) of this process or of
+    its largest finished child (such as a worker), whichever is higher.
+    """
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
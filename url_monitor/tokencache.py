@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+__doc__ = """Identity provider tokens cached on disk between checks and runs"""
+
+TOKEN_FILE = 'url_monitor.tokens.json'
+
+
+def fingerprint(auth_kwargs):
+    """
+    Identifies the credentials a token was fetched with, so a token isn't
+    used any more once they change in the config.
+    """
+    blob = json.dumps(auth_kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+class BearerTokenAuth(object):
+    """
+    Base for identity providers that exchange their credentials for a
+    bearer token. Subclasses implement fetch_token().
+
+    With config: token_cache set, url_monitor fills in token from the
+    cache before each request. Otherwise the token is fetched on first use.
+    """
+    token = None
+
+    def fetch_token(self):
+        """
+        :return: (token, seconds until it expires or None if unknown)
+        """
+        raise NotImplementedError
+
+    def __call__(self, request):
+        if self.token is None:
+            self.token = self.fetch_token()[0]
+        request.headers['Authorization'] = 'Bearer {0}'.format(self.token)
+        return request
+
+
+class TokenCache(object):
+    """
+    Tokens of identity providers, keyed by provider alias.
+
+    Tokens are kept in a JSON file in the state_dir readable by its owner
+    only, so every check, worker process and later cron invocation uses the
+    same token until it is within refresh_ahead seconds of expiring. Tokens
+    are refreshed under an exclusive lock on that file: concurrent workers
+    wait for the one refreshing and then use its token rather than fetching
+    their own.
+    """
+
+    def __init__(self, logging, directory, refresh_ahead=60.0,
+                 default_ttl=300.0):
+        self.logging = logging
+        self.path = os.path.join(directory, TOKEN_FILE)
+        self.refresh_ahead = float(refresh_ahead)
+        self.default_ttl = float(default_ttl)
+
+        # alias -> {'token', 'expires', 'fingerprint'}
+        self.tokens = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, tokens):
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tokens, f)
+        os.rename(tmp_path, self.path)
+
+    def _usable(self, entry, fingerprint, margin):
+        return bool(entry) and entry.get('fingerprint') == fingerprint and \
+            entry['expires'] - margin > time.time()
+
+    def get(self, alias, fingerprint, fetch):
+        """
+        Returns the token of alias, fetching a new one when the cached one
+        is missing, about to expire or was fetched with other credentials.
+
+        A failed refresh falls back to the cached token while it is valid.
+
+        :param fingerprint: of the provider's credentials, see fingerprint()
+        :param fetch: callable returning (token, expires_in)
+        """
+        entry = self.tokens.get(alias)
+        if self._usable(entry, fingerprint, self.refresh_ahead):
+            return entry['token']
+
+        with self.lock:
+            alias_lock = self.locks.setdefault(alias, threading.Lock())
+        # threads of this process queue up here, processes on the file lock
+        with alias_lock:
+            entry = self.tokens.get(alias)
+            if self._usable(entry, fingerprint, self.refresh_ahead):
+                return entry['token']
+            try:
+                fd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT,
+                             0o600)
+            except (IOError, OSError) as err:
+                self.logging.warning("Could not lock the token cache {0}, "
+                                     "not persisting tokens: {1}".format(
+                                         self.path, err))
+                return self._refresh(alias, fingerprint, fetch, entry)
+            with os.fdopen(fd, 'w') as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                tokens = self._read()
+                entry = tokens.get(alias) or entry
+                if self._usable(entry, fingerprint, self.refresh_ahead):
+                    self.tokens[alias] = entry
+                    return entry['token']
+                token = self._refresh(alias, fingerprint, fetch, entry)
+                tokens[alias] = self.tokens[alias]
+                try:
+                    self._write(tokens)
+                except (IOError, OSError) as err:
+                    self.logging.warning("Could not save the token cache "
+                                         "{0}: {1}".format(self.path, err))
+                return token
+
+    def _refresh(self, alias, fingerprint, fetch, entry):
+        try:
+            token, expires_in = fetch()
+        except Exception:
+            if self._usable(entry, fingerprint, 0):
+                self.logging.exception("Refreshing the token of {0} failed, "
+                                       "using the cached one".format(alias))
+                self.tokens[alias] = entry
+                return entry['token']
+            raise
+        if expires_in is None:
+            expires_in = self.default_ttl
+        self.logging.debug("Fetched a token for {0} valid for "
+                           "{1:.0f}s".format(alias, float(expires_in)))
+        self.tokens[alias] = {'token': token,
+                              'expires': time.time() + float(expires_in),
+                              'fingerprint': fingerprint}
+        return token
+
+
+_tokens = None
+_tokens_lock = threading.Lock()
+
+
+def get_tokens(configinstance, logger):
+    """
+    Returns the token cache of this process, or None when
+    config: token_cache is not configured.
+    """
+    global _tokens
+    settings = configinstance.get_token_cache()
+    if settings is None:
+        return None
+    with _tokens_lock:
+        if _tokens is None:
+            _tokens = TokenCache(
+                logger, configinstance.get_state_dir(),
+                refresh_ahead=settings.get('refresh_ahead', 60),
+                default_ttl=settings.get('default_ttl', 300))
+        return _tokens
@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import socket
+import ssl
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.connection import HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.exceptions import NewConnectionError
+from requests.packages.urllib3.exceptions import SSLError
+from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+from requests.packages.urllib3.util.ssl_ import resolve_cert_reqs
+
+import dnscache
+import stats
+
+__doc__ = """Instrumented requests transport shared by every WebCaller"""
+
+# Per-thread phase timings of the request in flight
+_phases = threading.local()
+
+
+def begin_phases():
+    """
+    Starts recording connection phases for the current thread and returns
+    the dict they are recorded into.
+    """
+    _phases.current = {'dns': 0.0, 'connect': 0.0, 'tls': 0.0}
+    return _phases.current
+
+
+def record_phase(phase, seconds):
+    """
+    Adds seconds to a phase of the request in flight on this thread.
+    """
+    current = getattr(_phases, 'current', None)
+    if current is not None:
+        current[phase] = current.get(phase, 0.0) + seconds
+
+
+# dnscache.DNSCache set up by configure_dns(), None resolves every time
+_dns_cache = None
+
+
+def configure_dns(configinstance, logger, prefetch=False):
+    """
+    Sets up the DNS cache configured under config: dns_cache for every
+    connection made by this process (and worker processes forked later).
+
+    :param prefetch: refresh entries before they expire, for daemons
+    """
+    global _dns_cache
+    settings = configinstance.get_dns_cache()
+    if settings is None:
+        _dns_cache = None
+        return
+    _dns_cache = dnscache.DNSCache(
+        logger,
+        min_ttl=settings.get('min_ttl', 10),
+        max_ttl=settings.get('max_ttl', 300),
+        default_ttl=settings.get('default_ttl', 60),
+        prefetch=prefetch and settings.get('prefetch', True))
+
+
+def resolve(host, port):
+    """
+    Resolves host for a new connection.
+    """
+    if _dns_cache is not None:
+        return _dns_cache.resolve(host, port)
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+
+def _timed_new_conn(conn):
+    """
+    Replacement for urllib3's HTTPConnection._new_conn() that records the
+    dns and connect phases separately.
+    """
+    started = time.time()
+    try:
+        addresses = resolve(conn.host, conn.port)
+    except socket.gaierror as err:
+        raise NewConnectionError(
+            conn, "Failed to establish a new connection: %s" % err)
+    resolved = time.time()
+    record_phase('dns', resolved - started)
+
+    err = None
+    sock = None
+    for family, socktype, proto, canonname, address in addresses:
+        try:
+            sock = socket.socket(family, socktype, proto)
+            for option in conn.socket_options or []:
+                sock.setsockopt(*option)
+            if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(conn.timeout)
+            if conn.source_address:
+                sock.bind(conn.source_address)
+            sock.connect(address)
+            break
+        except socket.error as e:
+            err = e
+            if sock is not None:
+                sock.close()
+                sock = None
+
+    connected = time.time()
+    record_phase('connect', connected - resolved)
+    conn._setup_seconds = connected - started
+
+    if sock is None:
+        if isinstance(err, socket.timeout):
+            raise ConnectTimeoutError(
+                conn, "Connection to %s timed out. (connect timeout=%s)" %
+                (conn.host, conn.timeout))
+        raise NewConnectionError(
+            conn, "Failed to establish a new connection: %s" % err)
+    return sock
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """
+    HTTPConnection recording dns and connect phases.
+    """
+    _new_conn = _timed_new_conn
+
+
+_tls_contexts = {}
+_tls_lock = threading.Lock()
+
+
+def tls_context(cert_reqs, ca_certs, ca_cert_dir, cert_file, key_file):
+    """
+    Returns the SSL context shared by every connection with the same
+    verification and client certificate settings, so the CA bundle is
+    loaded once instead of on every connection.
+    """
+    key = (cert_reqs, ca_certs, ca_cert_dir, cert_file, key_file)
+    with _tls_lock:
+        context = _tls_contexts.get(key)
+        if context is not None:
+            return context
+        cert_reqs = resolve_cert_reqs(cert_reqs)
+        context = create_urllib3_context(cert_reqs=cert_reqs)
+        try:
+            if ca_certs or ca_cert_dir:
+                context.load_verify_locations(ca_certs, ca_cert_dir)
+            elif cert_reqs != ssl.CERT_NONE:
+                context.load_default_certs()
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+        except (IOError, OSError) as err:
+            raise SSLError(err)
+        _tls_contexts[key] = context
+        return context
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """
+    HTTPSConnection recording dns, connect and tls phases, using the
+    shared SSL contexts.
+    """
+    _new_conn = _timed_new_conn
+
+    def connect(self):
+        self._setup_seconds = 0.0
+        shared = self.ssl_context is None
+        if shared:
+            self.ssl_context = tls_context(
+                self.cert_reqs, self.ca_certs,
+                getattr(self, 'ca_cert_dir', None), self.cert_file,
+                self.key_file)
+            # already loaded into the shared context
+            self.ca_certs = self.cert_file = self.key_file = None
+            if hasattr(self, 'ca_cert_dir'):
+                self.ca_cert_dir = None
+        started = time.time()
+        HTTPSConnection.connect(self)
+        record_phase('tls', time.time() - started - self._setup_seconds)
+        if shared:
+            stats.incr('tls_handshakes')
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    requests adapter using the timed connection pools.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+
+_adapter = None
+_adapter_lock = threading.Lock()
+
+
+def get_adapter(pool_maxsize=None):
+    """
+    Returns the adapter shared by every session, so connections are kept
+    alive and reused between checks against the same origin.
+
+    :param pool_maxsize: connections kept per origin, only used by the
+        first call. Should be at least the number of concurrent checks.
+    """
+    global _adapter
+    with _adapter_lock:
+        if _adapter is None:
+            _adapter = TimedHTTPAdapter(
+                pool_maxsize=max(10, pool_maxsize or 0))
+        return _adapter
+
+
+def mount(session):
+    """
+    Mounts the shared adapter on a requests session.
+    """
+    adapter = get_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
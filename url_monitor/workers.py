@@ -0,0 +1,261 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import multiprocessing
+import signal
+import time
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+import action
+import logqueue
+import scheduler
+import stats
+
+__doc__ = """Prefork worker processes running checks for a coordinator"""
+
+# Most metrics one coalesced send to Zabbix carries
+MAX_BATCH = 1000
+
+# Seconds past the run_deadline after which workers still busy are killed
+DEADLINE_GRACE = 5.0
+
+
+def partition(checks, count):
+    """
+    Splits checks into count lists for worker processes of one node.
+
+    Checks against the same origin host are kept in the same list, so
+    anything kept per origin (connections, limits) stays in one process,
+    unless the origin has more than a fair share of the checks, then it is
+    cut into fair share sized pieces. Pieces are handed out largest first
+    to the least loaded list, which keeps the lists close to even.
+
+    :param checks: list of testSets as returned by ConfigObject.load()
+    :param count: number of lists to return
+    """
+    origins = {}
+    for check in checks:
+        origins.setdefault(scheduler.origin_host(check), []).append(check)
+
+    share = max(1, -(-len(checks) // count))
+    pieces = [(host, group[start:start + share])
+              for host, group in origins.items()
+              for start in range(0, len(group), share)]
+
+    chunks = [[] for _ in range(count)]
+    for host, piece in sorted(pieces, key=lambda item: (-len(item[1]),
+                                                       item[0])):
+        min(chunks, key=len).extend(piece)
+    return chunks
+
+
+def _unfinished(checks, statcode):
+    """
+    Results like action.check_all() returns for checks a worker didn't
+    report back on, so their configs get the right return code.
+    """
+    return [(statcode, check['key'], None, check.get('config', 0))
+            for check in checks]
+
+
+def _worker(index, tasks, results, configinstance, logger,
+            configinstances=None):
+    """
+    Worker process main loop. Runs each list of checks it is handed and
+    streams their metrics back to the coordinator instead of sending them,
+    together with the zabbix section of the config they are for.
+    """
+    # the coordinator decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    def sender(configinstance, metrics, logger):
+        results.put(('metrics', configinstance['config']['zabbix'], metrics))
+        return True
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            # workers leave with os._exit(), skipping logging.shutdown()
+            logqueue.close_handlers(logger)
+            return
+        checks, shared, deadline = task
+        stats.discard()
+        completed_runs = action.check_all(checks, configinstance, logger,
+                                          sender, shared, deadline,
+                                          configinstances)
+        results.put(('done', index, completed_runs, stats.export()))
+
+
+class WorkerPool(object):
+    """
+    Forks worker processes once and splits every batch of checks between
+    them. Metrics produced by the workers are sent by the coordinator, so
+    there is still a single Zabbix sender.
+    """
+
+    def __init__(self, processes, configinstance, logger,
+                 configinstances=None):
+        """
+        :param processes: number of worker processes
+        :param configinstance: loaded configuration.ConfigObject
+        :param logger: logger instance
+        :param configinstances: every config of a job running several, see
+            action.check_all()
+        """
+        self.processes = processes
+        self.configinstance = configinstance
+        self.configinstances = configinstances
+        self.logger = logger
+        self.results = multiprocessing.Queue()
+        self.workers = []
+
+    def _spawn(self, index):
+        tasks = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_worker,
+            name="url_monitor-worker-{0}".format(index),
+            args=(index, tasks, self.results, self.configinstance,
+                  self.logger, self.configinstances))
+        process.daemon = True
+        process.start()
+        return process, tasks
+
+    def start(self):
+        self.workers = [self._spawn(index)
+                        for index in range(self.processes)]
+        self.logger.info("Started {0} worker processes".format(
+            self.processes))
+        return self
+
+    def run(self, checks, deadline=None):
+        """
+        Runs checks on the workers, sending their metrics as they arrive.
+        Workers that are still busy DEADLINE_GRACE seconds after the
+        deadline are killed and the pool is restarted.
+
+        :return: list of (statcode, testSet key, check, config) like
+            action.check_all()
+        """
+        for index, (process, tasks) in enumerate(self.workers):
+            if not process.is_alive():
+                self.logger.warning("Restarting worker {0}".format(index))
+                self.workers[index] = self._spawn(index)
+
+        chunks = partition(checks, self.processes)
+
+        # an origin split across workers shares its origin_limits
+        shared = {}
+        for chunk in chunks:
+            for origin in set(scheduler.origin_host(c) for c in chunk):
+                shared[origin] = shared.get(origin, 0) + 1
+
+        # the checks each worker is running, until it reports back
+        pending = {}
+        for index, ((process, tasks), chunk) in enumerate(
+                zip(self.workers, chunks)):
+            tasks.put((chunk, shared, deadline))
+            pending[index] = chunk
+
+        completed_runs = []
+        while pending:
+            if deadline is not None and \
+                    time.time() > deadline + DEADLINE_GRACE:
+                self._cancel(pending, completed_runs)
+                break
+            try:
+                message = self.results.get(timeout=1)
+            except Empty:
+                self._reap(pending, completed_runs)
+                continue
+            self._handle(message, pending, completed_runs)
+        return completed_runs
+
+    def _handle(self, message, pending, completed_runs):
+        while message is not None:
+            if message[0] == 'metrics':
+                # coalescing may take the next message off the queue
+                message = self._transmit(message[1], message[2])
+            else:
+                _, index, runs, exported = message
+                completed_runs.extend(runs)
+                stats.merge(exported)
+                pending.pop(index, None)
+                message = None
+
+    def _cancel(self, pending, completed_runs):
+        """
+        Flushes what the workers already produced, then kills the workers
+        still running checks past the deadline and restarts the pool.
+        """
+        while True:
+            try:
+                message = self.results.get_nowait()
+            except Empty:
+                break
+            self._handle(message, pending, completed_runs)
+        for index, chunk in pending.items():
+            process, tasks = self.workers[index]
+            self.logger.error("Worker {0} still busy with up to {1} checks "
+                              "past the run_deadline, killing it".format(
+                                  index, len(chunk)))
+            process.terminate()
+            stats.incr('checks_run', len(chunk))
+            stats.incr('checks_cancelled', len(chunk))
+            completed_runs.extend(_unfinished(chunk, 2))
+        # a worker killed while writing may leave the queue unusable
+        self.stop()
+        self.results = multiprocessing.Queue()
+        self.start()
+
+    def _transmit(self, zabbix, metrics):
+        """
+        Sends metrics together with whatever else is already queued for the
+        same Zabbix server, so workers finishing at the same time share one
+        Zabbix round-trip.
+
+        :param zabbix: zabbix section of the config the metrics are for
+        :return: the message that ended the batch, taken off the queue and
+            left for the caller to handle, None if there was none
+        """
+        following = None
+        while len(metrics) < MAX_BATCH:
+            try:
+                message = self.results.get_nowait()
+            except Empty:
+                break
+            if message[0] != 'metrics' or message[1] != zabbix:
+                following = message
+                break
+            metrics = metrics + message[2]
+        if not action.transmitfacade(configinstance={'config': {
+                'zabbix': zabbix}}, metrics=metrics, logger=self.logger):
+            self.logger.critical("Sending telemetry to zabbix failed!")
+        return following
+
+    def _reap(self, pending, completed_runs):
+        """
+        Gives up on workers that died with checks outstanding.
+        """
+        for index in list(pending):
+            process, tasks = self.workers[index]
+            if process.is_alive():
+                continue
+            self.logger.error("Worker {0} exited with code {1} before "
+                              "finishing {2} checks".format(
+                                  index, process.exitcode,
+                                  len(pending[index])))
+            stats.incr('checks_run', len(pending[index]))
+            completed_runs.extend(_unfinished(pending.pop(index), 1))
+
+    def stop(self):
+        for process, tasks in self.workers:
+            tasks.put(None)
+        for process, tasks in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
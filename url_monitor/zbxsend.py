@@ -5,6 +5,8 @@ import socket
 import struct
 import time
 
+import stats
+
 try:
     import json
 except:
@@ -25,14 +27,10 @@ class Metric(object):
         return 'Metric(%r, %r, %r, %r)' % (self.host, self.key, self.value, self.clock)
 
 
-def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051, timeout=15):
+def build_packet(metrics):
     """
-    Send set of metrics to Zabbix server.
-    :param: logger:
+    Build the ZBXD sender packet for a set of metrics.
     :param metrics:
-    :param zabbix_host:
-    :param zabbix_port:
-    :param timeout:
     :return:
     """
 
@@ -53,14 +51,31 @@ def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051,
                  '}') % (',\n'.join(metrics_data))
 
     data_len = struct.pack('<Q', len(json_data))
-    packet = 'ZBXD\1' + data_len + json_data
+    return 'ZBXD\1' + data_len + json_data
+
+
+def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051, timeout=15):
+    """
+    Send set of metrics to Zabbix server.
+    :param: logger:
+    :param metrics:
+    :param zabbix_host:
+    :param zabbix_port:
+    :param timeout:
+    :return:
+    """
+
+    packet = build_packet(metrics)
+    stats.gauge_add('sender_queue_depth', len(metrics))
     try:
         zabbix = socket.socket()
-        zabbix.connect((zabbix_host, zabbix_port))
+        # a server that doesn't answer shouldn't hold up the failover
         zabbix.settimeout(timeout)
+        zabbix.connect((zabbix_host, zabbix_port))
         # send metrics to zabbix
-        logger.debug('Sent payload: %s' % str(packet))
+        logger.debug('Sent payload: %s', packet)
         zabbix.sendall(packet)
+        stats.incr('sender_roundtrips')
         # get response header from zabbix
         resp_hdr = _recv_all(zabbix, 13)
         if not resp_hdr.startswith('ZBXD\1') or len(resp_hdr) != 13:
@@ -70,19 +85,25 @@ def send_to_zabbix(logger, metrics, zabbix_host='127.0.0.1', zabbix_port=10051,
         # get response body from zabbix
         resp_body = zabbix.recv(resp_body_len)
         resp = json.loads(resp_body)
-        logger.debug('Got response from Zabbix: %s' % resp)
+        logger.debug('Got response from Zabbix: %s', resp)
         logger.info(resp.get('info'))
         if resp.get('response') != 'success':
             logger.error('Got error from Zabbix: %s', resp)
             return False
+        stats.incr('metrics_sent', len(metrics))
         return True
     except socket.timeout as e:
         logger.error("zabbix timeout: " + str(e))
         return False
+    except socket.error as e:
+        logger.error('Could not send data to Zabbix %s:%s: %s',
+                     zabbix_host, zabbix_port, e)
+        return False
     except Exception as e:
         logger.exception('Error while sending data to Zabbix: ' + str(e))
         return False
     finally:
+        stats.gauge_add('sender_queue_depth', -len(metrics))
         zabbix.close()
 
 logger = logging.getLogger('zbxsender')